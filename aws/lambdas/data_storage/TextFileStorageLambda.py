@@ -14,12 +14,18 @@
 #	address: unsigned integer that represents the 8-bit slave address contained in the query on the bus
 #	function: unsigned integer that represents the 8-bit function contained in the query sent on the bus
 #	data (optional): an array of unsigned integers that represent the data payload received on the bus
+#
+# Batches of messages published by the Modbus Trace Lambda are also accepted, as a 'msgs' element
+# containing compact arrays of [received, address, function, data (hexadecimal string)].
 
 import greengrasssdk
 import logging
 import os
 import json
 from igsdk.storage.managed_file import managed_file_init, managed_file_write, get_storage_status
+from igsdk.storage.write_behind import WriteBehindConfig
+from igsdk.storage.codec import codec_from_str
+from igsdk.modbus.message import ModbusMessage
 from time import time
 
 node_id = os.getenv('AWS_IOT_THING_NAME') or 'NO_THING_NAME'
@@ -30,6 +36,8 @@ base_name = os.getenv('BASE_NAME') or 'modbus'
 file_ext = os.getenv('FILE_EXT') or '.csv'
 max_file_size = int(os.getenv('MAX_FILE_SIZE') or '268435456') # 256 MB
 log_level = int(os.getenv('MODBUS_LOG_LEVEL') or '20') # 20 = 'logging.INFO'
+write_behind = WriteBehindConfig.from_str(os.getenv('WRITE_BEHIND')) # e.g., 'periodic:30' (default: direct writes)
+compression = codec_from_str(os.getenv('COMPRESSION')) # e.g., 'gzip' (default: not compressed)
 
 # Managed file handle
 hfile = None
@@ -72,7 +80,17 @@ def function_handler(event, context):
     if context.client_context.custom and context.client_context.custom['subject']:
         topics = context.client_context.custom['subject'].split('/')
         if len(topics) >= 2 and topics[0] == 'modbus' and topics[1] == 'msg':
-            if 'received' in event and 'address' in event and 'function' in event:
+            if 'msgs' in event:
+                # Batch of messages in compact form (see ModbusMessage.to_compact())
+                records = []
+                for m in event['msgs']:
+                    msg = ModbusMessage.from_compact(m)
+                    record = str(msg.received) + ',' + str(msg.address) + ',' + str(msg.function)
+                    if msg.data:
+                        record += ',' + ','.join(str(d) for d in msg.data)
+                    records.append(record + '\n')
+                managed_file_write(hfile, ''.join(records), len(records))
+            elif 'received' in event and 'address' in event and 'function' in event:
                 record = str(event['received']) + ',' + str(event['address']) + ',' + str(event['function'])
                 if 'data' in event:
                     # Convert the array of integers into a string of comma-separated values
@@ -96,6 +114,8 @@ logging.getLogger().setLevel(log_level)
 client = greengrasssdk.client('iot-data')
 
 # Initialize the managed file
-logging.info('Starting text file storage: unit={}, basename={}, ext={}, maxsize={}'.format(
-    unit_name, base_name, file_ext, max_file_size))
-hfile = managed_file_init(unit_name, base_name, file_ext, max_file_size, extstorage_status_callback, filemove_status_callback)
+logging.info('Starting text file storage: unit={}, basename={}, ext={}, maxsize={}, write_behind={}, compression={}'.format(
+    unit_name, base_name, file_ext, max_file_size, write_behind.fsync if write_behind else None,
+    compression.name if compression else None))
+hfile = managed_file_init(unit_name, base_name, file_ext, max_file_size, extstorage_status_callback, filemove_status_callback,
+    write_behind=write_behind, compression=compression)
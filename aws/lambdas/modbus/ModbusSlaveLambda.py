@@ -7,11 +7,13 @@ import logging
 import os
 import signal
 import sys
-import copy
 import json
 import threading
+import time
 from igsdk.modbus.message import ModbusMessage
 from igsdk.modbus.modbus_slave import modbus_slave_start, modbus_slave_stop
+from igsdk.modbus.state_util import merge_state, diff_state
+from igsdk.modbus.stats import monotonic
 
 node_id = os.getenv('AWS_IOT_THING_NAME') or 'NO_THING_NAME'
 
@@ -24,12 +26,59 @@ serial_term = int(os.getenv('SERIAL_TERM') or '0')
 slave_addr = int(os.getenv('MODBUS_SLAVE_ADDR') or '1')
 log_level = int(os.getenv('MODBUS_LOG_LEVEL') or '20') # 20 = 'logging.INFO'
 
-# Keep a local copy of the current device shadow
+# Keep a local copy of the current device shadow; this is an immutable
+# snapshot (it is never modified once published), so the slave callbacks
+# can read it without locking.  Updates build a new snapshot that shares
+# all unchanged elements with the previous one, and replace the reference.
 device_shadow = None
 
-# Use a lock to maintain a consistent view of the shaddow
+# Version of the shadow document of the snapshot (if known)
+shadow_version = None
+
+# Use a lock to serialize shadow updates (readers do not take the lock)
 shadow_lock = threading.Lock()
 
+# Time the shadow lock has been held for updates (in seconds; see
+# igsdk.modbus.shadowbench for a comparison with the full-copy update)
+shadow_lock_stats = { 'count' : 0, 'total' : 0.0, 'max' : 0.0 }
+
+def update_shadow(state, version, delta=None, prev_version=None):
+    """Publish a new shadow snapshot
+
+    If 'delta' (the changes from the previous document version, see
+    diff_state()) is specified, and the snapshot is that previous version
+    ('prev_version'), only the changed elements are applied to the
+    snapshot; otherwise, 'state' replaces the snapshot entirely (e.g., if
+    an update was missed).  Documents older than the snapshot are ignored.
+    The delta is computed by the caller, so only the version check, the
+    merge of the changed elements and the reference swap are done with
+    the lock held.
+    """
+    global device_shadow, shadow_version
+    shadow_lock.acquire()
+    lock_start = monotonic()
+    if version is not None and shadow_version is not None and version <= shadow_version:
+        delta = {}
+    elif delta is not None and device_shadow is not None and (prev_version is None or prev_version == shadow_version):
+        if delta:
+            device_shadow = merge_state(device_shadow, delta)
+        shadow_version = version
+    else:
+        delta = state
+        device_shadow = state
+        shadow_version = version
+    lock_time = monotonic() - lock_start
+    # The statistics are updated by concurrent handler calls, so only with the lock held
+    shadow_lock_stats['count'] += 1
+    shadow_lock_stats['total'] += lock_time
+    shadow_lock_stats['max'] = max(shadow_lock_stats['max'], lock_time)
+    lock_max = shadow_lock_stats['max']
+    lock_mean = shadow_lock_stats['total'] / shadow_lock_stats['count']
+    shadow_lock.release()
+    logging.debug('Shadow lock held for {:.3f} ms (max {:.3f} ms, mean {:.3f} ms)'.format(lock_time * 1000,
+        lock_max * 1000, lock_mean * 1000))
+    return delta
+
 #
 # This handler receives all incoming messages (based on the topic subscription
 # that was specified in the deployment).  The Modbus slave functionality
@@ -39,7 +88,6 @@ shadow_lock = threading.Lock()
 #   $aws/things/<node_id>/shadow/documents
 #
 def function_handler(event, context):
-    global device_shadow
     # Determine the topic
     if context.client_context.custom and context.client_context.custom['subject']:
         topic_el = context.client_context.custom['subject'].split('/')
@@ -47,16 +95,17 @@ def function_handler(event, context):
         if len(topic_el) >= 4 and topic_el[2] == node_id and topic_el[3] == 'shadow':
             if len(topic_el) == 6 and topic_el[4] == 'get' and topic_el[5] == 'accepted':
                 # This is a 'get' response on '$aws/<node_id>/shadow/get/accepted'
-                shadow_lock.acquire()
-                device_shadow = copy.deepcopy(event['state'])
-                shadow_lock.release()
+                # (the event is a new object, so it is used as the snapshot directly)
+                update_shadow(event['state'], event.get('version'))
                 logging.info('Received shadow get response: {}'.format(device_shadow))
             elif len(topic_el) == 6 and topic_el[4] == 'update' and topic_el[5] == 'documents':
-                # This is a shadow update on '$aws/<node_id>/shadow/update/documents'
-                shadow_lock.acquire()
-                device_shadow = copy.deepcopy(event['current']['state'])
-                shadow_lock.release()
-                logging.info('Received shadow update: {}'.format(device_shadow))
+                # This is a shadow update on '$aws/<node_id>/shadow/update/documents';
+                # compute the changes from the previous document before taking the lock
+                previous = event.get('previous') or {}
+                current = event['current']
+                delta = diff_state(previous['state'], current['state']) if previous.get('state') is not None else None
+                delta = update_shadow(current['state'], current.get('version'), delta, previous.get('version'))
+                logging.info('Received shadow update: {}'.format(delta))
     return
 
 #
@@ -65,10 +114,9 @@ def function_handler(event, context):
 #
 def get_read_cb():
     ret = None
-    shadow_lock.acquire()
-    if device_shadow:
-        ret = device_shadow.get('desired', None)
-    shadow_lock.release()
+    shadow = device_shadow
+    if shadow:
+        ret = shadow.get('desired', None)
     return ret
         
 #
@@ -77,10 +125,9 @@ def get_read_cb():
 #
 def get_write_cb():
     ret = None
-    shadow_lock.acquire()
-    if device_shadow:
-        ret = device_shadow.get('reported', None)
-    shadow_lock.release()
+    shadow = device_shadow
+    if shadow:
+        ret = shadow.get('reported', None)
     return ret
 
 #
@@ -8,8 +8,16 @@ import logging
 import os
 import signal
 import sys
+import json
+import threading
 from igsdk.modbus.message import ModbusMessage
-from igsdk.modbus.modbus_trace import modbus_trace_start, modbus_trace_stop
+from igsdk.modbus.modbus_trace import modbus_trace_start, modbus_trace_stop, modbus_trace_set_filter, modbus_trace_port_stats
+from igsdk.modbus.capture import CaptureWriter, capture_file_header, CAPTURE_SUFFIX
+from igsdk.storage.managed_file import managed_file_init, managed_file_deinit
+from igsdk.batcher import MessageBatcher
+from igsdk.modbus.trace_decoder import TraceDecoder
+from igsdk.modbus.bus_stats import BusStats
+from igsdk.modbus.realtime import RealtimeConfig
 
 node_id = os.getenv('AWS_IOT_THING_NAME') or 'NO_THING_NAME'
 
@@ -20,6 +28,32 @@ modbus_mode = int(os.getenv('MODBUS_MODE') or '0') # 0 = ASCII, 1 = RTU
 serial_mode = int(os.getenv('SERIAL_MODE') or '0') # 0 = RS-232, 1 = RS-485/422 HD, 2 = RS-485/422 FD
 serial_term = int(os.getenv('SERIAL_TERM') or '0')
 log_level = int(os.getenv('MODBUS_LOG_LEVEL') or '20') # 20 = 'logging.INFO'
+trace_publish = int(os.getenv('TRACE_PUBLISH') or '1') # 0 = Do not publish messages
+capture_enable = int(os.getenv('CAPTURE_ENABLE') or '0') # 1 = Write binary capture files
+capture_max_file_size = int(os.getenv('CAPTURE_MAX_FILE_SIZE') or '67108864') # 64 MB
+batch_enable = int(os.getenv('BATCH_ENABLE') or '0') # 1 = Publish messages in batches
+batch_max_count = int(os.getenv('BATCH_MAX_COUNT') or '100')
+batch_max_age = float(os.getenv('BATCH_MAX_AGE') or '1.0') # Seconds
+batch_max_bytes = int(os.getenv('BATCH_MAX_BYTES') or '129024') # 126 KB
+batch_stats_interval = 100 # Log batch statistics every N batches
+trace_filter = json.loads(os.getenv('TRACE_FILTER') or '{}') # Initial message filter (JSON)
+trace_decode = int(os.getenv('TRACE_DECODE') or '0') # 1 = Decode register values and publish changes
+trace_deadbands = json.loads(os.getenv('TRACE_DEADBANDS') or '[]') # Register deadbands (JSON)
+stats_interval = float(os.getenv('STATS_INTERVAL') or '0') # Seconds between bus statistics summaries (0 = disabled)
+realtime = RealtimeConfig.from_str(os.getenv('REALTIME')) # Real-time serial reader: '<priority>[:<cpus>]' (default disabled)
+
+# Register decoder (if decoding or statistics are enabled)
+decoder = None
+
+# Bus statistics (if enabled), and the timer to publish them
+bus_stats = None
+stats_timer = None
+
+# Message batcher (if batching is enabled)
+batcher = None
+
+# Managed file for binary capture
+capture_file = None
 
 def trace_callback(msg):
     """Callback for received messages
@@ -37,11 +71,64 @@ def trace_callback(msg):
     logging.debug('Publishing message on {}, address={}, function={}'.format(msg_topic, msg.address, msg.function))
     client.publish(topic = msg_topic, payload = msg.to_JSON())
 
+def change_callback(changes):
+    """Callback for register value changes decoded from the trace
+    """
+    changes_topic = 'modbus/trace/{}/changes'.format(node_id)
+    client.publish(topic = changes_topic, payload = json.dumps({ 'changes' : changes }, separators=(',',':')))
+
+def publish_stats():
+    """Publish the bus statistics for the current window, and start the next window
+    """
+    global stats_timer
+    stats_topic = 'modbus/trace/{}/stats'.format(node_id)
+    # Count the requests not answered within the timeout in this window
+    decoder.expire()
+    summary = bus_stats.summary(reset=True)
+    summary['port'] = modbus_trace_port_stats(trace)
+    client.publish(topic = stats_topic, payload = json.dumps(summary, separators=(',',':')))
+    stats_timer = threading.Timer(stats_interval, publish_stats)
+    stats_timer.daemon = True
+    stats_timer.start()
+
+def batch_callback(msg):
+    """Callback for received messages, when batching is enabled
+
+    Each message is added to the current batch in compact form (see
+    ModbusMessage.to_compact()); the batcher publishes the batches.
+    """
+    batcher.add(json.dumps(msg.to_compact(), separators=(',',':')))
+
+def publish_batch(payload):
+    """Publish a batch of trace messages
+    """
+    batch_topic = 'modbus/msg/trace/{}/batch'.format(node_id)
+    client.publish(topic = batch_topic, payload = payload)
+    stats = batcher.get_stats()
+    if stats['batches'] % batch_stats_interval == 0:
+        logging.info('Trace batch statistics: {}'.format(stats))
+
+#
+# This handler receives messages to change the trace filter, on the topic
+# 'modbus/trace/<node_id>/filter'.  The event is the filter specification
+# (an empty object removes the filter); the current filter and the counts of
+# accepted and rejected messages are published on 'modbus/trace/<node_id>/filter/status'.
 #
-# This is a dummy handler and will not be invoked, since this Lambda does
-# not handle incoming messages
+# If register decoding is enabled, any message on 'modbus/trace/<node_id>/image'
+# publishes the current register image on 'modbus/trace/<node_id>/image/status'.
 #
 def function_handler(event, context):
+    if context.client_context.custom and context.client_context.custom['subject']:
+        topic_el = context.client_context.custom['subject'].split('/')
+        if len(topic_el) == 4 and topic_el[0] == 'modbus' and topic_el[1] == 'trace' and topic_el[2] == node_id:
+            if topic_el[3] == 'filter':
+                try:
+                    modbus_trace_set_filter(trace, event)
+                except ValueError as e:
+                    logging.error('Invalid trace filter: {}'.format(e))
+                client.publish(topic = 'modbus/trace/{}/filter/status'.format(node_id), payload = json.dumps(trace.get_filter_stats()))
+            elif topic_el[3] == 'image' and decoder:
+                client.publish(topic = 'modbus/trace/{}/image/status'.format(node_id), payload = json.dumps(decoder.image.snapshot()))
     return
 
 # Termination handler
@@ -49,6 +136,11 @@ def on_sigterm(signal, frame):
     global trace
     logging.warn('SIGTERM received, calling modbus_trace_stop.')
     modbus_trace_stop(trace)
+    if stats_timer:
+        stats_timer.cancel()
+    if batcher:
+        batcher.batch_stop()
+    managed_file_deinit(capture_file)
     # Need to exit since this overrides the framework handler
     sys.exit(0)
 
@@ -66,6 +158,39 @@ client = greengrasssdk.client('iot-data')
 # Register termination handler
 signal.signal(signal.SIGTERM, on_sigterm)
 
+# Create the capture file, if enabled
+capture = None
+if capture_enable:
+    logging.info('Starting binary capture: maxsize={}'.format(capture_max_file_size))
+    capture_file = managed_file_init('modbus_capture', 'capture', CAPTURE_SUFFIX, capture_max_file_size,
+        header=capture_file_header(modbus_mode, baudrate))
+    capture = CaptureWriter(capture_file)
+
+# Create the message batcher, if enabled
+callback = trace_callback
+if batch_enable:
+    logging.info('Starting trace batching: count={}, age={}, bytes={}'.format(batch_max_count, batch_max_age, batch_max_bytes))
+    batcher = MessageBatcher(publish_batch, batch_max_count, batch_max_age, batch_max_bytes)
+    batcher.batch_start()
+    callback = batch_callback
+
+# Create the register decoder, if decoding or statistics are enabled
+if stats_interval > 0:
+    logging.info('Starting bus statistics: interval={}'.format(stats_interval))
+    bus_stats = BusStats(baudrate)
+if trace_decode or bus_stats:
+    logging.info('Starting register decoding: enabled={}, deadbands={}'.format(trace_decode, trace_deadbands))
+    decoder = TraceDecoder(change_callback, stats=bus_stats, decode=bool(trace_decode))
+    for d in trace_deadbands:
+        decoder.image.set_deadband(d['table'], d['first'], d['last'], d['deadband'], d.get('slave'))
+
 # Start the modbus trace function with our callback
 logging.info('Starting modbus_trace function.')
-trace = modbus_trace_start(port, baudrate, modbus_mode, serial_mode, serial_term, trace_callback)
+trace = modbus_trace_start(port, baudrate, modbus_mode, serial_mode, serial_term,
+    callback if trace_publish else None, capture, trace_filter, decoder, realtime=realtime)
+
+# Start publishing bus statistics
+if bus_stats:
+    stats_timer = threading.Timer(stats_interval, publish_stats)
+    stats_timer.daemon = True
+    stats_timer.start()
@@ -0,0 +1,185 @@
+#
+# batcher.py
+#
+# Collects messages into size-limited batches for publishing
+#
+
+from .modbus.stats import LatencyHistogram, monotonic
+import threading
+import logging
+
+# AWS IoT limits messages to 128 KB; leave room for the topic and protocol overhead
+BATCH_MAX_BYTES_DEFAULT = 126 * 1024
+BATCH_MAX_COUNT_DEFAULT = 100
+BATCH_MAX_AGE_DEFAULT = 1.0
+
+class MessageBatcher(threading.Thread):
+    """Collects encoded messages into batches, and publishes them via callback
+
+    Each message is added as an encoded JSON value; a batch is published as
+    a single JSON object (by default, '{"msgs":[<msg>,<msg>,...]}') when any
+    of the following occurs:
+
+        - The batch contains 'max_count' messages
+        - Adding a message would make the payload exceed 'max_bytes'
+        - The oldest message in the batch has waited 'max_age' seconds
+
+    The publish callback is called on the batcher thread (for age flushes)
+    or the calling thread (for count/size flushes), with a single argument,
+    the payload string; flush_async() requests a flush on the batcher
+    thread.  Statistics of batch sizes and flush latency (time
+    from the first message being added until the batch is published) are
+    available from get_stats().
+    """
+    def __init__(self, publish_cb, max_count=BATCH_MAX_COUNT_DEFAULT, max_age=BATCH_MAX_AGE_DEFAULT,
+            max_bytes=BATCH_MAX_BYTES_DEFAULT, prefix='{"msgs":[', suffix=']}'):
+        self.logger = logging.getLogger(__name__)
+        self.publish_cb = publish_cb
+        self.max_count = max_count
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.suffix = suffix
+        self.cond = threading.Condition()
+        self.publish_lock = threading.Lock()
+        self.msgs = []
+        self.nbytes = 0
+        self.first_time = None
+        self.flush_requests = []
+        self.running = False
+        self.batch_count = 0
+        self.msg_count = 0
+        self.byte_count = 0
+        self.dropped_count = 0
+        self.batch_size = LatencyHistogram(min_value=1, buckets_per_doubling=4, num_buckets=64)
+        self.flush_reasons = { 'count' : 0, 'bytes' : 0, 'age' : 0, 'stop' : 0 }
+        self.flush_latency = LatencyHistogram()
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def batch_start(self):
+        self.running = True
+        self.start()
+
+    def batch_stop(self):
+        """Stop the batcher, publishing any remaining messages.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.flush('stop')
+
+    def add(self, msg):
+        """Add an encoded message (JSON string) to the batch.
+        """
+        size = len(msg) + 1 # Include separator
+        if size + len(self.prefix) + len(self.suffix) > self.max_bytes:
+            self.logger.warning('Message of {} bytes exceeds batch size limit, dropped.'.format(len(msg)))
+            self.dropped_count += 1
+            return
+        batch = None
+        with self.cond:
+            if self.msgs and self.nbytes + size + len(self.prefix) + len(self.suffix) > self.max_bytes:
+                batch = self._take('bytes')
+            self.msgs.append(msg)
+            self.nbytes += size
+            if len(self.msgs) == 1:
+                self.first_time = monotonic()
+                self.cond.notify()
+            if batch is None and len(self.msgs) >= self.max_count:
+                batch = self._take('count')
+        if batch:
+            self._publish(*batch)
+
+    def flush(self, reason='stop'):
+        """Publish the current batch immediately (if not empty).
+        """
+        with self.cond:
+            batch = self._take(reason) if self.msgs else None
+        if batch:
+            self._publish(*batch)
+
+    def flush_async(self, reason='stop', done_cb=None):
+        """Publish the current batch (if not empty) on the batcher thread, then call done_cb() on that thread.
+
+        For use from threads that must not block on the publish callback
+        (e.g., a D-Bus main loop).
+        """
+        with self.cond:
+            self.flush_requests.append((reason, done_cb))
+            self.cond.notify()
+
+    def _take(self, reason):
+        batch = (self.msgs, self.first_time, reason)
+        self.msgs = []
+        self.nbytes = 0
+        self.first_time = None
+        return batch
+
+    def publish(self, payload, msgs):
+        """Publish the payload of a batch of messages ('msgs', the list of encoded messages) via the callback.
+
+        Subclasses can override this method to use the messages of each batch.
+        """
+        self.publish_cb(payload)
+
+    def _publish(self, msgs, first_time, reason):
+        payload = self.prefix + ','.join(msgs) + self.suffix
+        with self.publish_lock:
+            try:
+                self.publish(payload, msgs)
+            except Exception as e:
+                self.logger.error('Failed to publish batch: {}'.format(e))
+            self.batch_count += 1
+            self.msg_count += len(msgs)
+            self.byte_count += len(payload)
+            self.batch_size.add(len(msgs))
+            self.flush_reasons[reason] += 1
+            self.flush_latency.add(monotonic() - first_time)
+        self.logger.debug('Published batch of {} messages, {} bytes ({})'.format(len(msgs), len(payload), reason))
+
+    def run(self):
+        """Method run on the thread to publish batches that reach the maximum age.
+        """
+        while True:
+            batch = None
+            done_cb = None
+            with self.cond:
+                if not self.running:
+                    break
+                if self.flush_requests:
+                    reason, done_cb = self.flush_requests.pop(0)
+                    batch = self._take(reason) if self.msgs else None
+                elif not self.msgs:
+                    self.cond.wait()
+                elif monotonic() - self.first_time < self.max_age:
+                    self.cond.wait(self.max_age - (monotonic() - self.first_time))
+                else:
+                    batch = self._take('age')
+            if batch:
+                self._publish(*batch)
+            if done_cb:
+                try:
+                    done_cb()
+                except Exception as e:
+                    self.logger.error('Flush callback failed: {}'.format(e))
+
+    def get_stats(self):
+        """Return the batch statistics.
+
+        Returns:
+            A dictionary containing the count of batches, messages, payload bytes
+            and dropped (oversize) messages, the count of flushes per reason, and
+            summaries of the messages per batch and the flush latency (see
+            LatencyHistogram.summary()).
+        """
+        with self.publish_lock:
+            return {
+                'batches' : self.batch_count,
+                'msgs' : self.msg_count,
+                'bytes' : self.byte_count,
+                'dropped' : self.dropped_count,
+                'flush_reasons' : dict(self.flush_reasons),
+                'batch_size' : self.batch_size.summary(),
+                'flush_latency' : self.flush_latency.summary()
+            }
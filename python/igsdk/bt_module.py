@@ -6,18 +6,11 @@
 
 import dbus
 import dbus.exceptions
-import threading
-import dbus.mainloop.glib
 import logging
-import sys
 import json
 
-PYTHON3 = sys.version_info >= (3, 0)
-if PYTHON3:
-    from gi.repository import GObject as gobject
-    from gi.repository import GLib as glib
-else:
-    import gobject
+from .runtime import get_runtime, completed_future
+from .properties import PropertyStore
 
 BT_OBJ='org.bluez'
 BT_OBJ_PATH='/org/bluez/hci0'
@@ -31,7 +24,7 @@ DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
 result_success = 0
 result_err = -1
 
-class BtMgr(threading.Thread):
+class BtMgr:
     """
     Class that manages all bluetooth API functionality
     """
@@ -40,29 +33,23 @@ class BtMgr(threading.Thread):
         self.logger.info('Initalizing BtMgr')
 
         self.devices = {}
+        # Devices being connected (not yet reported as connected)
+        self.connecting = {}
 
-        # Set up DBus loop
-        self.loop = None
-        dbus.mainloop.glib.threads_init()
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        if PYTHON3:
-            self.loop = glib.MainLoop()
-        else:
-            self.loop = gobject.MainLoop()
-            gobject.threads_init()
+        # Use the shared DBus connection and main loop
+        self.runtime = get_runtime()
 
         # Get DBus objects
-        self.manager = dbus.Interface(dbus.SystemBus().get_object(BT_OBJ,
-            "/"), DBUS_OBJ_MGR_IFACE)
-        self.adapter = dbus.Interface(dbus.SystemBus().get_object(BT_OBJ,
-            BT_OBJ_PATH), BT_ADAPTER_IFACE)
-        self.adapter_props = dbus.Interface(dbus.SystemBus().get_object(BT_OBJ,
-            BT_OBJ_PATH), DBUS_PROP_IFACE)
+        self.manager = self.runtime.get_interface(BT_OBJ,
+            "/", DBUS_OBJ_MGR_IFACE)
+        self.adapter = self.runtime.get_interface(BT_OBJ,
+            BT_OBJ_PATH, BT_ADAPTER_IFACE)
+        self.adapter_props = self.runtime.get_interface(BT_OBJ,
+            BT_OBJ_PATH, DBUS_PROP_IFACE)
         self.objects = self.manager.GetManagedObjects()
 
         # Register signal handlers
-        self.manager.connect_to_signal('InterfacesAdded', discovery_callback)
-        super(BtMgr, self).__init__()
+        self.discovery_signal = self.manager.connect_to_signal('InterfacesAdded', discovery_callback)
 
         # Save custom callbacks with the client
         self.characteristic_property_change_callback = characteristic_property_change_callback
@@ -72,24 +59,31 @@ class BtMgr(threading.Thread):
         # Power on the bluetooth module
         self.adapter_props.Set(BT_ADAPTER_IFACE, "Powered", dbus.Boolean(1))
 
-        # Run main loop
-        self.start()
+        # Run the shared main loop
+        self.runtime.register(self, on_stop=self.remove_signals)
 
-    def run(self):
-        """
-        Method to run the DBus main loop (on a thread)
-        """
-        self.logger.info('Starting main loop.')
-        self.loop.run()
-        self.logger.info('Main loop has exited.')
+    def remove_signals(self):
+        if self.discovery_signal:
+            self.discovery_signal.remove()
+            self.discovery_signal = None
 
     def quit_loop(self):
-        if self.loop:
-            self.loop.quit()
+        self.runtime.unregister(self)
 
     def deinit(self):
-        if self.loop:
-            gobject.timeout_add(0, self.quit_loop)
+        for address in list(self.connecting):
+            self.abandon_connection(address)
+        self.quit_loop()
+
+    def abandon_connection(self, address):
+        """
+        Stop tracking a device that was not reported as connected, releasing its signals
+        """
+        device = self.connecting.pop(address, None)
+        if device is not None:
+            self.logger.info('Abandoning connection to {}'.format(address))
+            device.disconnect_signal()
+        return device
 
     def start_discovery(self):
         """
@@ -147,8 +141,11 @@ class BtMgr(threading.Thread):
                 if device and str(device['Address']) == address:
                     # Found it; create and connect
                     # NOTE: The 'mgr_connection_callback' will store the device locally if it connects successfully
+                    self.abandon_connection(address)
                     device = Device(address, path, self.characteristic_property_change_callback, self.mgr_connection_callback, self.write_notification_callback)
-                    device.connect()
+                    self.connecting[address] = device
+                    if not device.connect():
+                        self.abandon_connection(address)
                     success = True
 
         if not success:
@@ -167,8 +164,14 @@ class BtMgr(threading.Thread):
             device.disconnect()
             if purge:
                 self.adapter.RemoveDevice(device_path)
+                self.runtime.forget(BT_OBJ, device_path)
         else:
-            self.logger.error('Device {} was not found'.format(address))
+            device = self.abandon_connection(address)
+            if device is not None:
+                # Cancel the connection in progress
+                device.disconnect()
+            else:
+                self.logger.error('Device {} was not found'.format(address))
 
     def build_device_services(self, address):
         """
@@ -236,6 +239,30 @@ class BtMgr(threading.Thread):
 
         return value
 
+    def read_characteristic_async(self, address, service_uuid, char_uuid, offset = 0):
+        """
+        Read the characteristic value for the given device/service, without waiting
+        Returns a DBusFuture (see runtime.py) for the value; the result is None if
+        the characteristic was not found, and the DBusException if the read failed
+        """
+        self.logger.info('Reading characteristic {} in service {} for device {}'.format(char_uuid, service_uuid, address))
+
+        device = self.devices.get(address)
+        if device is not None:
+            service = device.get_service(service_uuid)
+            if service:
+                char = service.get_characteristic(char_uuid)
+                if char:
+                    return char.read_value_async(offset)
+                else:
+                    self.logger.error('Characteristic UUID {} not found for service {} and device {}'.format(char_uuid, service_uuid, address))
+            else:
+                self.logger.error('Service UUID {} not found for device {}'.format(service_uuid, address))
+        else:
+            self.logger.error('Device {} was not found'.format(address))
+
+        return completed_future(None)
+
     def write_characteristic(self, address, service_uuid, char_uuid, value, offset = 0):
         """
         Write a value to the given characteristic for the given device/service
@@ -300,6 +327,8 @@ class BtMgr(threading.Thread):
         data = {}
         data['connected'] = device.is_connected()
         data['address'] = device.get_address()
+        if self.connecting.get(data['address']) is device:
+            del self.connecting[data['address']]
         if data['connected']:
             # Add the new connected device to the managed device array
             self.devices[data['address']] = device
@@ -333,14 +362,17 @@ class Device():
         self.services = []
 
         self.path = path
-        self.object = dbus.SystemBus().get_object(BT_OBJ, path)
+        self.object = get_runtime().get_object(BT_OBJ, path)
         self.interface = dbus.Interface(self.object, BT_DEVICE_IFACE)
         self.properties = dbus.Interface(self.object, DBUS_PROP_IFACE)
         self.properties_signal = None
+        self.props = PropertyStore(BT_OBJ, path, BT_DEVICE_IFACE)
 
     def connect(self):
         """
         Connect to the device
+
+        Returns True if the connection was started, False if it failed
         """
         try:
             # Connect to the device property signals to receive notifications
@@ -350,6 +382,8 @@ class Device():
             self.interface.Connect()
         except dbus.exceptions.DBusException as e:
             self.logger.error('Failed to connect device {}: {}'.format(self.address, e))
+            return False
+        return True
 
     def disconnect(self):
         """
@@ -409,7 +443,7 @@ class Device():
         """
         uuids = []
         try:
-            uuids = self.properties.Get(BT_DEVICE_IFACE, 'UUIDs')
+            uuids = self.props.get('UUIDs', [])
         except:
             # Ignore; means we are not connected
             pass
@@ -422,7 +456,7 @@ class Device():
         """
         connected = False
         try:
-            connected = self.properties.Get(BT_DEVICE_IFACE, 'Connected') == 1
+            connected = self.props.get('Connected') == 1
         except:
             # Ignore; means we are not connected
             pass
@@ -435,7 +469,7 @@ class Device():
         """
         resolved = False
         try:
-            resolved = self.properties.Get(BT_DEVICE_IFACE, 'ServicesResolved') == 1
+            resolved = self.props.get('ServicesResolved') == 1
         except:
             # Ignore; means we are not connected
             pass
@@ -449,6 +483,7 @@ class Device():
         if self.properties_signal is not None:
             self.properties_signal.remove()
             self.properties_signal = None
+        self.props.close()
 
         for service in self.services:
             service.disconnect_signal()
@@ -460,6 +495,8 @@ class Device():
         Notifies the client when the device has been both connected
         and all services have been discovered
         """
+        if interface == self.props.iface:
+            self.props.update(changed_properties, invalidated_properties)
         if 'Connected' in changed_properties and changed_properties['Connected'] == 0:
             # Send notification that device disconnected
             self.connection_callback(self)
@@ -498,7 +535,7 @@ class Service():
         self.write_notification_callback = write_notification_callback
         self.characteristics = []
 
-        self.object = dbus.SystemBus().get_object(BT_OBJ, path)
+        self.object = get_runtime().get_object(BT_OBJ, path)
         self.interface = dbus.Interface(self.object, BT_SERVICE_IFACE)
         self.properties = dbus.Interface(self.object, DBUS_PROP_IFACE)
         self.properties_signal = None
@@ -581,10 +618,11 @@ class Characteristic():
         self.property_change_callback = property_change_callback
         self.write_notification_callback = write_notification_callback
 
-        self.object = dbus.SystemBus().get_object(BT_OBJ, path)
+        self.object = get_runtime().get_object(BT_OBJ, path)
         self.interface = dbus.Interface(self.object, BT_CHARACTERISTIC_IFACE)
         self.properties = dbus.Interface(self.object, DBUS_PROP_IFACE)
         self.properties_signal = self.properties.connect_to_signal('PropertiesChanged', self.characteristic_property_change_callback)
+        self.props = PropertyStore(BT_OBJ, path, BT_CHARACTERISTIC_IFACE)
 
     def get_uuid(self):
         """
@@ -596,13 +634,13 @@ class Characteristic():
         """
         Returns all of the characteristic flags
         """
-        return self.properties.Get(BT_CHARACTERISTIC_IFACE, 'Flags')
+        return self.props.get('Flags')
 
     def is_notifying(self):
         """
         Returns whether or not the characteristic is notifying on its value changes
         """
-        return self.properties.Get(BT_CHARACTERISTIC_IFACE, 'Notifying') == 1
+        return self.props.get('Notifying') == 1
 
     def read_value(self, offset):
         """
@@ -612,6 +650,14 @@ class Characteristic():
         return self.object.ReadValue({'offset': dbus.UInt16(offset, variant_level=1)},
             dbus_interface=BT_CHARACTERISTIC_IFACE)
 
+    def read_value_async(self, offset):
+        """
+        Read the value associated with this characteristic, without waiting
+        Returns a DBusFuture (see runtime.py) for the value (an array of bytes)
+        """
+        return get_runtime().call_async(self.interface.ReadValue,
+            ({'offset': dbus.UInt16(offset, variant_level=1)},))
+
     def write_value(self, value, offset):
         """
         Write a value to this characteristic
@@ -641,6 +687,7 @@ class Characteristic():
         if self.properties_signal is not None:
             self.properties_signal.remove()
             self.properties_signal = None
+        self.props.close()
 
     def write_characteristic_success_callback(self):
         """
@@ -671,6 +718,8 @@ class Characteristic():
         On value changes, package the characteristic's UUID and new value
         and forward the notification to the client
         """
+        if interface == self.props.iface:
+            self.props.update(changed_properties, invalidated_properties)
         for property in changed_properties:
             if property == 'Value':
                 data = {}
@@ -737,6 +786,16 @@ def bt_read_characteristic(bt, address, service_uuid, char_uuid):
     if bt:
         bt.read_characteristic(address, service_uuid, char_uuid)
 
+def bt_read_characteristic_async(bt, address, service_uuid, char_uuid, offset = 0):
+    """
+    Read the value of the given characteristic for the given device/service, without waiting
+    Returns a DBusFuture (see runtime.py) for the value
+    """
+    if bt:
+        return bt.read_characteristic_async(address, service_uuid, char_uuid, offset)
+    else:
+        return completed_future(None)
+
 def bt_write_characteristic(bt, address, service_uuid, char_uuid, value):
     """
     Write a value to the given characteristic for the given device/service
@@ -6,17 +6,9 @@
 
 import dbus
 import dbus.exceptions
-import threading
-import dbus.mainloop.glib
 import logging
 
-import sys
-PYTHON3 = sys.version_info >= (3, 0)
-if PYTHON3:
-    from gi.repository import GObject as gobject
-    from gi.repository import GLib as glib
-else:
-    import gobject
+from .runtime import get_runtime
 
 IGCONFD_SVC = 'com.lairdtech.security.ConfigService'
 IGCONFD_IFACE = 'com.lairdtech.security.ConfigInterface'
@@ -40,46 +32,36 @@ ACTIVATION_NO_SIM = -8
 AP_SCANNING_SUCCESS = 0
 AP_SCANNING = 1
 
-class ConfigManager(threading.Thread):
+class ConfigManager:
     """Class that encapsulates the config API functionality
     """
     def __init__(self,  lte_status_callback = None):
         self.logger = logging.getLogger(__name__)
-        self.loop = None
 
         self.lte_status_callback = lte_status_callback
 
-        # Set up DBus loop
-        dbus.mainloop.glib.threads_init()
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        if PYTHON3:
-            self.loop = glib.MainLoop()
-        else:
-            self.loop = gobject.MainLoop()
-            gobject.threads_init()
+        self.runtime = get_runtime()
 
         # Get DBus objects
-        self.conf = dbus.Interface(dbus.SystemBus().get_object(IGCONFD_SVC, IGCONFD_OBJ), IGCONFD_IFACE)
+        self.conf = self.runtime.get_interface(IGCONFD_SVC, IGCONFD_OBJ, IGCONFD_IFACE)
 
         # Register signal handlers if using callback
-        self.conf.connect_to_signal('LTEStatusChanged', self.cb_lte)
+        self.signal = self.conf.connect_to_signal('LTEStatusChanged', self.cb_lte)
 
         self.logger.info('Config Manager starting.')
-        super(ConfigManager, self).__init__()
-        # Run main loop if using callback
-        self.start()
-
-    def run(self):
-        """Method to run the DBus main loop (on a thread)
-        """
-        self.logger.info('Starting main loop.')
-        self.loop.run()
-        self.logger.info('Main loop has exited.')
+        # Run the shared main loop to receive the signals
+        self.runtime.register(self, on_stop=self.remove_signals)
 
     def quit_loop(self):
+        """Remove the signal handlers, and release the shared main loop
+        """
         self.logger.info('Quitting')
-        if self.loop:
-            self.loop.quit()
+        self.runtime.unregister(self)
+
+    def remove_signals(self):
+        if self.signal:
+            self.signal.remove()
+            self.signal = None
 
     def cb_lte(self, status):
         if status == ACTIVATION_SUCCESS:
@@ -104,5 +86,23 @@ class ConfigManager(threading.Thread):
         self.logger.info('Updating APs')
         self.conf.SetWifiConfigurations(config)
 
+    def connect_lte_async(self, config):
+        """Send a command to the config service to initiate an LTE Connection, without waiting
+
+        Returns:
+            A DBusFuture (see runtime.py) for the completion of the command
+        """
+        self.logger.info('Connecting to LTE')
+        return self.runtime.call_async(self.conf.ConnectLTE, (config,))
+
+    def update_aps_async(self, config):
+        """Modify the Wi-Fi profiles in NetworkManagers connection list, without waiting
+
+        Returns:
+            A DBusFuture (see runtime.py) for the completion of the update
+        """
+        self.logger.info('Updating APs')
+        return self.runtime.call_async(self.conf.SetWifiConfigurations, (config,))
+
 
 
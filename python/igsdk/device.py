@@ -7,16 +7,11 @@
 import dbus
 import dbus.exceptions
 import threading
-import dbus.mainloop.glib
 import logging
+import time
 
-import sys
-PYTHON3 = sys.version_info >= (3, 0)
-if PYTHON3:
-    from gi.repository import GObject as gobject
-    from gi.repository import GLib as glib
-else:
-    import gobject
+from .runtime import get_runtime, completed_future
+from .properties import PropertyStore
 
 DEVICE_SERVICE='com.lairdtech.device.DeviceService'
 DEVICE_SERVICE_OBJ_PATH='/com/lairdtech/device/DeviceService'
@@ -48,61 +43,138 @@ EXT_STORAGE_STATUS_STOPPED = 5
 EXT_STORAGE_NOT_AVAILABLE = 0
 EXT_STORAGE_AVAILABLE = 1
 
-class DeviceMgr(threading.Thread):
+#
+# Device LED activity signalling
+#
+ACTIVITY_PERIOD_DEFAULT = 0.25 # Seconds (LED blink period)
+LED_STATE_ENABLED = 'DeviceEnabled'
+LED_STATE_EXCEPTION = 'DeviceException'
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+class ActivityNotifier:
+    """Coalesces device LED indications into a minimum of D-Bus calls
+
+    Activity is signalled at most once per blink 'period' (activity during
+    a blink is shown by that blink), and the enabled/exception state is
+    only signalled when it changes.  The calls are sent without waiting
+    for a reply, so callers (e.g., the serial reader) are never blocked by
+    the Device Service.  The count of calls requested, sent and avoided is
+    available from get_stats().
+    """
+    def __init__(self, dev, period=ACTIVITY_PERIOD_DEFAULT):
+        self.logger = logging.getLogger(__name__)
+        self.dev = dev
+        self.period = period
+        self.lock = threading.Lock()
+        self.last_activity = None
+        self.state = None
+        self.activity_requests = 0
+        self.activity_sent = 0
+        self.state_requests = 0
+        self.state_sent = 0
+
+    def _send(self, method):
+        try:
+            getattr(self.dev, method)(ignore_reply=True)
+        except dbus.exceptions.DBusException as e:
+            self.logger.warning('{} failed: {}'.format(method, e))
+
+    def activity(self):
+        """Signal activity (sent only if the last activity was sent at least one period ago).
+        """
+        self.activity_requests += 1
+        now = monotonic()
+        last = self.last_activity
+        if last is not None and now - last < self.period:
+            return
+        # Only one caller can send; others are coalesced into its blink
+        if not self.lock.acquire(False):
+            return
+        try:
+            if self.last_activity != last:
+                return
+            self.last_activity = now
+            self.activity_sent += 1
+        finally:
+            self.lock.release()
+        self._send('DeviceActivity')
+
+    def set_state(self, state):
+        """Signal the enabled or exception state (LED_STATE_*), if it has changed.
+        """
+        self.state_requests += 1
+        with self.lock:
+            if state == self.state:
+                return
+            self.state = state
+            self.state_sent += 1
+        self._send(state)
+
+    def get_stats(self):
+        """Return the LED signalling statistics.
+
+        Returns:
+            A dictionary containing the count of activity and state
+            indications requested and sent, and the count of D-Bus
+            calls avoided ('avoided').
+        """
+        requests = self.activity_requests + self.state_requests
+        sent = self.activity_sent + self.state_sent
+        return {
+            'activity_requests' : self.activity_requests,
+            'activity_sent' : self.activity_sent,
+            'state_requests' : self.state_requests,
+            'state_sent' : self.state_sent,
+            'avoided' : requests - sent
+        }
+
+class DeviceMgr:
     """Class that encapsulates the device API functionality
+
+    The D-Bus connection, proxies and main loop are shared with the other
+    managers (see runtime.py); the manager registers with the main loop
+    only if a callback is used.  The Device Service properties are read
+    from a PropertyStore (see properties.py), refreshed at most every
+    'props_max_age' seconds (or only from the change signals, if None).
     """
-    def __init__(self, cb_ext_storage_available):
+    def __init__(self, cb_ext_storage_available, activity_period=ACTIVITY_PERIOD_DEFAULT, props_max_age=None):
         self.logger = logging.getLogger(__name__)
         self.cb_ext_storage_available = cb_ext_storage_available
-        self.loop = None
-        if (cb_ext_storage_available):
-            self.cb_ext_storage_available = cb_ext_storage_available
-            # Set up DBus loop
-            dbus.mainloop.glib.threads_init()
-            dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-            if PYTHON3:
-                self.loop = glib.MainLoop()
-            else:
-                self.loop = gobject.MainLoop()
-                gobject.threads_init()
+        self.runtime = get_runtime()
 
         # Get DBus objects
-        self.dev = dbus.Interface(dbus.SystemBus().get_object(DEVICE_SERVICE,
-            DEVICE_SERVICE_OBJ_PATH), DEVICE_SERVICE_PUBLIC_IFACE)
-        self.dev_props = dbus.Interface(dbus.SystemBus().get_object(DEVICE_SERVICE,
-            DEVICE_SERVICE_OBJ_PATH), DBUS_PROP_IFACE)
+        self.dev = self.runtime.get_interface(DEVICE_SERVICE,
+            DEVICE_SERVICE_OBJ_PATH, DEVICE_SERVICE_PUBLIC_IFACE)
+        self.dev_props = self.runtime.get_interface(DEVICE_SERVICE,
+            DEVICE_SERVICE_OBJ_PATH, DBUS_PROP_IFACE)
+        self.notifier = ActivityNotifier(self.dev, activity_period)
+        self.props = PropertyStore(DEVICE_SERVICE, DEVICE_SERVICE_OBJ_PATH,
+            DEVICE_SERVICE_PUBLIC_IFACE, props_max_age)
         # Get current state of external storage
-        if self.dev_props.Get(DEVICE_SERVICE_PUBLIC_IFACE, EXT_STORAGE_STATUS_PROP) == EXT_STORAGE_STATUS_READY:
+        if self.props.get(EXT_STORAGE_STATUS_PROP) == EXT_STORAGE_STATUS_READY:
             self.ext_storage_available = EXT_STORAGE_AVAILABLE
-            self.ext_storage_path = self.dev_props.Get(DEVICE_SERVICE_PUBLIC_IFACE, EXT_STORAGE_PATH_PROP)
+            self.ext_storage_path = self.props.get(EXT_STORAGE_PATH_PROP)
         else:
             self.ext_storage_available = EXT_STORAGE_NOT_AVAILABLE
             self.ext_storage_path = None
         self.logger.info('External storage available: {}'.format(self.ext_storage_available))
-        # Register signal handlers if using callback
+        self.signals = []
+        # Register signal handlers and run main loop if using callback
         if (self.cb_ext_storage_available):
-            self.dev.connect_to_signal('ExtStorageStopping', self.ext_storage_stopping)
-            self.dev_props.connect_to_signal('PropertiesChanged', self.dev_props_changed)
-        super(DeviceMgr, self).__init__()
-        # Run main loop if using callback
-        if (self.cb_ext_storage_available):
-            self.start()
-
-    def run(self):
-        """Method to run the DBus main loop (on a thread)
-        """
-        self.logger.info('Starting main loop.')
-        self.loop.run()
-        self.logger.info('Main loop has exited.')
+            self.signals.append(self.dev.connect_to_signal('ExtStorageStopping', self.ext_storage_stopping))
+            self.signals.append(self.dev_props.connect_to_signal('PropertiesChanged', self.dev_props_changed))
+            self.runtime.register(self, on_stop=self.remove_signals)
 
-    def quit_loop(self):
-        if self.loop:
-            self.loop.quit()
+    def remove_signals(self):
+        for match in self.signals:
+            match.remove()
+        self.signals = []
 
     def deinit(self):
-        # Schedule call to stop DBus loop
-        if self.loop:
-            gobject.timeout_add(0, self.quit_loop)
+        self.props.close()
+        if self.signals:
+            self.runtime.unregister(self)
 
     def ext_storage_stopping(self):
         """Callback for ExtStorageStopping signal from IG Device Service
@@ -112,6 +184,8 @@ class DeviceMgr(threading.Thread):
     def dev_props_changed(self, iface, props_changed, props_invalidated):
         """Callback for PropertiesChanged signal from IG Device Service
         """
+        if iface == DEVICE_SERVICE_PUBLIC_IFACE:
+            self.props.update(props_changed, props_invalidated)
         if props_changed and EXT_STORAGE_STATUS_PROP in props_changed:
             if props_changed[EXT_STORAGE_STATUS_PROP] == EXT_STORAGE_STATUS_READY:
                 self.update_ext_storage_available(EXT_STORAGE_AVAILABLE)
@@ -125,7 +199,7 @@ class DeviceMgr(threading.Thread):
             self.ext_storage_available = ext_storage_available
             # Get path if external storage is available
             if self.ext_storage_available == EXT_STORAGE_AVAILABLE:
-                self.ext_storage_path = self.dev_props.Get(DEVICE_SERVICE_PUBLIC_IFACE, EXT_STORAGE_PATH_PROP)
+                self.ext_storage_path = self.props.get(EXT_STORAGE_PATH_PROP)
                 self.logger.info('External storage available at {}'.format(self.ext_storage_path))
             else:
                 self.ext_storage_path = None
@@ -166,26 +240,65 @@ class DeviceMgr(threading.Thread):
     def get_int_storage_path(self):
         """Return path to internal storage
         """
-        return self.dev_props.Get(DEVICE_SERVICE_PUBLIC_IFACE, INT_STORAGE_PATH_PROP)
+        return self.props.get(INT_STORAGE_PATH_PROP)
 
     def get_storage_status(self):
         """Return storage status via IG Device Service
         """
-        return self.dev_props.GetAll(DEVICE_SERVICE_PUBLIC_IFACE)
+        return self.props.get_all()
+
+    def get_props_stats(self):
+        """Return the property cache statistics (see PropertyStore.get_stats())
+        """
+        return self.props.get_stats()
 
     def Reboot(self):
         """Reboot
         """
         return self.dev.Reboot()
 
-def device_init(cb_ext_storage_available = None):
+    def SetSerialPortTypeAsync(self, port_type):
+        """Set serial port type via IG Device Service, without waiting (returns a DBusFuture)
+        """
+        return self.runtime.call_async(self.dev.SetSerialPortType, (port_type,))
+
+    def SetSerialTerminationAsync(self, term):
+        """Set serial termination via IG Device Service, without waiting (returns a DBusFuture)
+        """
+        return self.runtime.call_async(self.dev.SetSerialTermination, (term,))
+
+    def RebootAsync(self):
+        """Reboot, without waiting (returns a DBusFuture)
+        """
+        return self.runtime.call_async(self.dev.Reboot)
+
+_shared_dev = None
+_shared_dev_refs = 0
+_shared_dev_lock = threading.Lock()
+
+def device_init(cb_ext_storage_available = None, activity_period = ACTIVITY_PERIOD_DEFAULT, props_max_age = None):
     """Initialize the IG device API
+
+    Without a callback, a single device instance is shared by all callers
+    (e.g., every serial port), and released when all have called
+    device_deinit().
+
+    Args:
+        cb_ext_storage_available: Optional callback for external storage changes
+        activity_period: Minimum time between LED activity indications (see device_activity())
+        props_max_age: Optional maximum age (seconds) of the cached Device Service properties
     Returns:
         Device instance, to be used in device_* calls
     """
+    global _shared_dev, _shared_dev_refs
     try:
-        dev = DeviceMgr(cb_ext_storage_available)
-        return dev
+        if cb_ext_storage_available:
+            return DeviceMgr(cb_ext_storage_available, activity_period, props_max_age)
+        with _shared_dev_lock:
+            if _shared_dev is None:
+                _shared_dev = DeviceMgr(None, activity_period, props_max_age)
+            _shared_dev_refs += 1
+            return _shared_dev
     except dbus.exceptions.DBusException as e:
         logging.getLogger(__name__).error('Cannot open Device interface: {}'.format(e))
         return None
@@ -193,24 +306,53 @@ def device_init(cb_ext_storage_available = None):
 def device_deinit(dev):
     """De-initialize the IG device API
     """
-    if dev:
+    global _shared_dev, _shared_dev_refs
+    if dev is not None and dev is _shared_dev:
+        with _shared_dev_lock:
+            _shared_dev_refs -= 1
+            if _shared_dev_refs <= 0:
+                _shared_dev.deinit()
+                _shared_dev = None
+                _shared_dev_refs = 0
+    elif dev:
         dev.deinit()
 
 def device_enabled(dev):
-    """Activate device LED as enabled
+    """Activate device LED as enabled (only signalled if the state changes)
     """
     if dev:
-        dev.DeviceEnabled()
+        dev.notifier.set_state(LED_STATE_ENABLED)
 
 def device_activity(dev):
     """Indicate device LED activity
+
+    This does not block; activity is signalled at most once per blink
+    period (see ActivityNotifier), so it can be called for every message.
     """
     if dev:
-        dev.DeviceActivity()
+        dev.notifier.activity()
 
 def device_exception(dev):
+    """Activate device LED exception (only signalled if the state changes)
+    """
     if dev:
-        dev.DeviceException()
+        dev.notifier.set_state(LED_STATE_EXCEPTION)
+
+def device_props_stats(dev):
+    """Return the Device Service property cache statistics (see PropertyStore.get_stats())
+    """
+    if dev:
+        return dev.get_props_stats()
+    else:
+        return None
+
+def device_activity_stats(dev):
+    """Return the LED signalling statistics (see ActivityNotifier.get_stats())
+    """
+    if dev:
+        return dev.notifier.get_stats()
+    else:
+        return None
 
 def set_serial_port_type(dev, port_type):
     """Set serial port type
@@ -228,6 +370,28 @@ def set_serial_termination(dev, term):
     else:
         return DEVICE_ERR_UNINIT
 
+def set_serial_port_type_async(dev, port_type):
+    """Set serial port type, without waiting
+
+    Returns:
+        A DBusFuture (see runtime.py) for the result of set_serial_port_type()
+    """
+    if dev:
+        return dev.SetSerialPortTypeAsync(port_type)
+    else:
+        return completed_future(DEVICE_ERR_UNINIT)
+
+def set_serial_termination_async(dev, term):
+    """Set serial port termination, without waiting
+
+    Returns:
+        A DBusFuture (see runtime.py) for the result of set_serial_termination()
+    """
+    if dev:
+        return dev.SetSerialTerminationAsync(term)
+    else:
+        return completed_future(DEVICE_ERR_UNINIT)
+
 def get_ext_storage_available(dev):
     """Return state of external storage, and path
     """
@@ -257,3 +421,14 @@ def reboot(dev):
     """
     if dev:
         dev.Reboot()
+
+def reboot_async(dev):
+    """Reboot, without waiting
+
+    Returns:
+        A DBusFuture (see runtime.py) for the completion of the request
+    """
+    if dev:
+        return dev.RebootAsync()
+    else:
+        return completed_future(DEVICE_ERR_UNINIT)
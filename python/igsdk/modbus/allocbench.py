@@ -0,0 +1,149 @@
+#
+# allocbench.py
+#
+# Check of the memory allocated by the serial receive path, per received
+# chunk, using tracemalloc (Python 3.4+).
+#
+# Run as: python -m igsdk.modbus.allocbench [--chunks N] [--serial]
+#
+# Each stage is measured in steady state (after a warm-up): the memory
+# blocks retained per chunk (sys.getallocatedblocks()), and the peak of
+# the memory allocated during each call, including objects freed before
+# it returns (tracemalloc, with the peak reset before each call).  Each
+# stage runs with a short and a long frame; the difference of the peaks,
+# less the decoded message data, is the memory that grows with the chunk,
+# i.e., copies of the received bytes.  Small fixed-size objects (e.g.,
+# memoryview slices) are not copies.  With --serial, the data is read
+# from a pseudo-terminal by SerialTimeoutFix; otherwise only the buffer
+# and parser stages are measured.
+#
+# Exits with status 1 if the reused-buffer or parse stages copy the data
+# or retain memory per chunk, or if the allocating stage (read()/get(),
+# the control) is not detected.
+#
+
+from igsdk.modbus.ring_buffer import ChunkRing
+from igsdk.modbus.rtuparser import ModbusRTUParser
+from igsdk.modbus.message import ModbusMessage
+import argparse
+import os
+import sys
+import threading
+import tracemalloc
+import tty
+
+WARMUP_CHUNKS = 100
+
+# Read holding registers responses (16 and 125 registers)
+bench_frame = ModbusMessage(1, ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS, [32] + list(range(32))).rtu_frame()
+bench_frame_long = ModbusMessage(1, ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS, [250] + list(range(250))).rtu_frame()
+
+# Retained blocks per chunk, and share of the frame size difference, above which a stage allocates per chunk
+MAX_BLOCKS_PER_CHUNK = 0.01
+MAX_COPIED_SHARE = 0.5
+
+def measure(fn, count):
+    """Run fn() 'count' times after a warm-up.
+
+    Returns:
+        Tuple (blocks, peak): the memory blocks retained per call, and the
+        smallest peak of the memory allocated during a call (bytes).
+    """
+    for i in range(WARMUP_CHUNKS):
+        fn()
+    tracemalloc.start()
+    peak_min = None
+    blocks_start = sys.getallocatedblocks()
+    for i in range(count):
+        # Also resets the peak
+        tracemalloc.clear_traces()
+        fn()
+        current, peak = tracemalloc.get_traced_memory()
+        if peak_min is None or peak < peak_min:
+            peak_min = peak
+    blocks = sys.getallocatedblocks() - blocks_start
+    tracemalloc.stop()
+    return float(blocks) / count, peak_min
+
+def ring_stages(source):
+    """Return the stages as tuples (name, fn, decodes, control)"""
+    ring = ChunkRing()
+    buf = bytearray(1024)
+    view = memoryview(buf)
+    parser = ModbusRTUParser()
+    def reused():
+        n = source(view)
+        ring.put(view, 0, n)
+        n, rx_time = ring.get_into(view, 0)
+        return n
+    def allocating():
+        b = bytes(view[:source(view)])
+        ring.put(b, 0)
+        b, rx_time = ring.get(0)
+        return len(b)
+    def parse():
+        n = reused()
+        parser.msgs_from_bytes(view[:n])
+    return [
+        ('receive (reused buffers)', reused, False, False),
+        ('receive (allocating)', allocating, False, True),
+        ('receive + RTU parse', parse, True, False)
+    ]
+
+def memory_source(frame):
+    def source(view):
+        n = len(frame)
+        view[:n] = frame
+        return n
+    return source
+
+def serial_source(frame, baudrate=115200):
+    """Return a source that reads frames from a pseudo-terminal, fed by a writer thread"""
+    from igsdk.modbus.serial_queue import SerialTimeoutFix
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    serial = SerialTimeoutFix(port=os.ttyname(slave_fd), baudrate=baudrate, timeout=1, inter_byte_timeout=0.01)
+    sem = threading.Semaphore(0)
+    def writer():
+        while True:
+            sem.acquire()
+            os.write(master_fd, frame)
+    t = threading.Thread(target=writer)
+    t.daemon = True
+    t.start()
+    def source(view):
+        sem.release()
+        return serial.readinto(view)
+    return source
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=10000, help='Chunks to measure per stage and frame')
+    parser.add_argument('--serial', action='store_true', help='Read the chunks from a pseudo-terminal')
+    args = parser.parse_args()
+    frames = (bench_frame, bench_frame_long)
+    results = {}
+    for frame in frames:
+        source = serial_source(frame) if args.serial else memory_source(frame)
+        for name, fn, decodes, control in ring_stages(source):
+            results.setdefault(name, []).append(measure(fn, args.chunks))
+    growth = len(bench_frame_long) - len(bench_frame)
+    # The decoded register data (a list per message) grows with the frame, but is not a copy of the chunk
+    decoded = sys.getsizeof(list(range(len(bench_frame_long) - 4))) - sys.getsizeof(list(range(len(bench_frame) - 4)))
+    print('Allocations per chunk ({} and {} byte frames, {} chunks):'.format(len(bench_frame), len(bench_frame_long), args.chunks))
+    print('  stage                        blocks  peak (bytes)  peak (bytes)  copied (bytes)')
+    result = 0
+    for name, fn, decodes, control in ring_stages(memory_source(bench_frame)):
+        (blocks_short, peak_short), (blocks_long, peak_long) = results[name]
+        blocks = max(blocks_short, blocks_long)
+        copied = peak_long - peak_short - (decoded if decodes else 0)
+        allocates = blocks > MAX_BLOCKS_PER_CHUNK or copied > growth * MAX_COPIED_SHARE
+        print('  {:28s} {:6.3f} {:13d} {:13d} {:15d}  {}'.format(name, blocks, peak_short, peak_long, copied,
+            'allocates' if allocates else 'no copies'))
+        if allocates != control:
+            result = 1
+    print('FAIL' if result else 'PASS')
+    sys.exit(result)
+
+if __name__ == "__main__":
+    main()
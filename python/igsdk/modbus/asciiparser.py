@@ -51,19 +51,23 @@ class ModbusASCIIParser(ModbusBaseParser):
         """
         msgs = []
         # User remainder bytes
-        parse_bytes = self.remainder + b.decode('ascii')
+        parse_bytes = self.remainder + bytearray(b).decode('ascii')
         # Find the first frame delimiter
         i = parse_bytes.find('\r\n')
         while i >= 0:
             # Try to parse a single message
             m = self._parse_msg(parse_bytes[:i])
             # Remove parsed bytes and delimter
+            frame = parse_bytes[:i+2]
             parse_bytes = parse_bytes[i+2:]
+            if self.frame_cb:
+                self.frame_cb(frame.encode('ascii'), m)
             # Add parsed message, if any
             if m:
                 msgs.append(m)
                 self.logger.debug('Parsed ASCII frame: address={}, function={}, len={}'.format(m.address, m.function, len(m.data) if m.data else 0))
-            #else - warn?
+            else:
+                self.check_errors += 1
             i = parse_bytes.find('\r\n')
         # Store any remaining bytes for the next pass
         self.remainder = parse_bytes
@@ -6,9 +6,16 @@
 
 class ModbusBaseParser:
     """Base class for Modbus message parsing.
+
+    Parsers count the frames that fail the CRC/LRC check (or cannot
+    be framed) in 'check_errors'.  If 'frame_cb' is set, it is called
+    with each raw frame as it was received, as frame_cb(frame, msg),
+    where 'msg' is the parsed ModbusMessage, or None if the frame failed
+    the check (e.g., to capture the received bytes).
     """ 
     def __init__(self):
-        pass
+        self.check_errors = 0
+        self.frame_cb = None
 
     def msgs_from_bytes(self, b):
         """Parse messages from a byte string
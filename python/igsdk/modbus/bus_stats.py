@@ -0,0 +1,135 @@
+#
+# bus_stats.py
+#
+# Per-slave Modbus bus statistics, computed from traced messages
+#
+
+from .stats import LatencyHistogram, monotonic
+import threading
+
+BUS_STATS_MAX_ENTRIES_DEFAULT = 64
+BUS_STATS_OTHER = 'other'
+
+class SlaveFunctionStats:
+    """Statistics for a single slave address and function code.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.unanswered = 0
+        self.exceptions = {}
+        self.latency = LatencyHistogram()
+
+    def summary(self):
+        lat = self.latency.summary()
+        return {
+            'requests' : self.requests,
+            'responses' : self.responses,
+            'unanswered' : self.unanswered,
+            'exceptions' : dict(self.exceptions),
+            'latency' : { 'p50' : lat['p50'], 'p90' : self.latency.percentile(90), 'p99' : lat['p99'], 'max' : lat['max'] }
+        }
+
+class BusStats:
+    """Statistics of the traffic on a Modbus bus, by slave and function code.
+
+    Statistics are collected over a window, which starts when the object
+    is created and restarts each time summary() is called with reset=True
+    (for example, each time a periodic summary is published).  Each
+    (slave, function) entry uses a fixed amount of memory, and the number
+    of entries is limited to 'max_entries' (additional slaves/functions are
+    counted together under BUS_STATS_OTHER).
+
+    The add_*() methods are called by a TraceDecoder (see trace_decoder.py)
+    on the trace thread; summary() can be called from any thread.
+    """
+    def __init__(self, baudrate=None, max_entries=BUS_STATS_MAX_ENTRIES_DEFAULT):
+        self.lock = threading.Lock()
+        self.char_time = 10.0 / baudrate if baudrate else None
+        self.max_entries = max_entries
+        self._reset()
+
+    def _reset(self):
+        self.start_time = monotonic()
+        self.entries = {}
+        self.frames = 0
+        self.bytes = 0
+        self.check_errors = 0
+
+    def _entry(self, address, function):
+        key = (address, function & 0x7F)
+        e = self.entries.get(key)
+        if e is None:
+            if len(self.entries) >= self.max_entries:
+                key = (BUS_STATS_OTHER, BUS_STATS_OTHER)
+                e = self.entries.get(key)
+            if e is None:
+                e = SlaveFunctionStats()
+                self.entries[key] = e
+        return e
+
+    def add_frame(self, nbytes):
+        """Count a received frame of 'nbytes' bytes.
+        """
+        with self.lock:
+            self.frames += 1
+            self.bytes += nbytes
+
+    def add_check_errors(self, count, nbytes=0):
+        """Count frames that failed the CRC/LRC check (or could not be framed).
+        """
+        with self.lock:
+            self.check_errors += count
+            self.bytes += nbytes
+
+    def add_pair(self, pair):
+        """Count a request paired with its response (see trace_decoder.TracePair).
+        """
+        with self.lock:
+            e = self._entry(pair.req.address, pair.req.function)
+            e.requests += 1
+            e.responses += 1
+            e.latency.add(max(0, pair.latency()))
+            if pair.resp.function & 0x80:
+                code = pair.resp.data[0] if pair.resp.data else 0
+                e.exceptions[code] = e.exceptions.get(code, 0) + 1
+
+    def add_unanswered(self, req, t):
+        """Count a request that was not answered.
+        """
+        with self.lock:
+            e = self._entry(req.address, req.function)
+            e.requests += 1
+            e.unanswered += 1
+
+    def summary(self, reset=False):
+        """Return a summary of the statistics for the current window.
+
+        Args:
+            reset: If True, a new window is started
+
+        Returns:
+            A dictionary containing the window length ('window', in seconds),
+            the count of frames, bytes and check errors, the bus utilization
+            (fraction of the window used to transmit the bytes, if the baud
+            rate is known), and a 'slaves' dictionary keyed by slave address,
+            containing a dictionary keyed by function code, of the request,
+            response, unanswered and exception counts (by exception code),
+            and response latency percentiles (in seconds).
+        """
+        with self.lock:
+            window = monotonic() - self.start_time
+            slaves = {}
+            for (address, function), e in self.entries.items():
+                slaves.setdefault(address, {})[function] = e.summary()
+            result = {
+                'window' : window,
+                'frames' : self.frames,
+                'bytes' : self.bytes,
+                'check_errors' : self.check_errors,
+                'utilization' : min(1.0, self.bytes * self.char_time / window) if self.char_time and window > 0 else None,
+                'slaves' : slaves
+            }
+            if reset:
+                self._reset()
+        return result
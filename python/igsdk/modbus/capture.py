@@ -0,0 +1,174 @@
+#
+# capture.py
+#
+# Binary capture file format for Modbus traffic
+#
+# A capture file begins with a file header, followed by a sequence of
+# records, each containing a single raw frame.  All values are little-endian.
+#
+#   File header (12 bytes):
+#       magic       4 bytes     b'IGMC'
+#       version     uint16      CAPTURE_VERSION
+#       mode        uint8       0 = ASCII, 1 = RTU
+#       reserved    uint8       0
+#       baudrate    uint32      Baud rate of the captured port
+#
+#   Record header (19 bytes), followed by 'length' bytes of raw frame:
+#       length      uint16      Length of the frame
+#       flags       uint8       CAPTURE_FLAG_* bits
+#       wall_us     uint64      Wall-clock time (microseconds since the Unix epoch)
+#       mono_us     uint64      Monotonic time (microseconds)
+#
+# Since each file (including each file in a ManagedFile sequence) starts
+# with a header, and records are only ever appended, a file that is
+# truncated (e.g., by a power failure) can be read up to the last
+# complete record.
+#
+
+import struct
+import time
+import argparse
+from .stats import monotonic
+
+CAPTURE_MAGIC = b'IGMC'
+CAPTURE_VERSION = 1
+CAPTURE_FILE_HEADER = struct.Struct('<4sHBBI')
+CAPTURE_RECORD_HEADER = struct.Struct('<HBQQ')
+CAPTURE_SUFFIX = '.igcap'
+
+# Record flags
+CAPTURE_FLAG_TX = 0x01          # Frame was transmitted (otherwise received)
+CAPTURE_FLAG_CHECK_ERROR = 0x02 # Frame failed the CRC/LRC check (or could not be framed)
+CAPTURE_FLAG_REQUEST = 0x04     # Frame is a request (from the master)
+CAPTURE_FLAG_RESPONSE = 0x08    # Frame is a response (from a slave); neither flag if unknown
+
+# Link types for pcap export; there is no registered link type for Modbus
+# RTU, so the first user-defined link type is used by default (in Wireshark,
+# map it to the 'mbrtu' dissector under Preferences -> Protocols -> DLT_USER).
+PCAP_LINKTYPE_USER0 = 147
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_SNAPLEN = 65535
+
+class CaptureRecord:
+    """Class representing a single captured frame.
+    """
+    def __init__(self, frame, flags=0, wall_us=0, mono_us=0):
+        self.frame = frame
+        self.flags = flags
+        self.wall_us = wall_us
+        self.mono_us = mono_us
+
+    def is_tx(self):
+        return (self.flags & CAPTURE_FLAG_TX) != 0
+
+    def check_ok(self):
+        return (self.flags & CAPTURE_FLAG_CHECK_ERROR) == 0
+
+    def is_request(self):
+        return (self.flags & CAPTURE_FLAG_REQUEST) != 0
+
+    def is_response(self):
+        return (self.flags & CAPTURE_FLAG_RESPONSE) != 0
+
+def capture_file_header(modbus_mode, baudrate):
+    """Return the header bytes for a new capture file.
+    """
+    return CAPTURE_FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 1 if modbus_mode and modbus_mode > 0 else 0, 0, baudrate)
+
+class CaptureWriter:
+    """Writes captured frames to a file
+
+    The file can be a ManagedFile (created with the header from
+    capture_file_header(), so that each file in the sequence can be read
+    independently), or any file object opened for binary writing (in which
+    case the header is written when the writer is created).
+    """
+    def __init__(self, f, modbus_mode=1, baudrate=0, write_header=False):
+        self.f = f
+        if write_header:
+            self.f.write(capture_file_header(modbus_mode, baudrate))
+
+    def write_frame(self, frame, flags=0, mono_time=None, wall_time=None):
+        """Append a single frame to the capture.
+
+        Args:
+            frame: Raw frame bytes
+            flags: CAPTURE_FLAG_* bits
+            mono_time: Monotonic time the frame was received/sent (see stats.monotonic); default is now
+            wall_time: Wall-clock time the frame was received/sent; default is computed from mono_time
+        """
+        now = monotonic()
+        if mono_time is None:
+            mono_time = now
+        if wall_time is None:
+            wall_time = time.time() - (now - mono_time)
+        self.f.write(CAPTURE_RECORD_HEADER.pack(len(frame), flags, int(wall_time * 1000000), int(mono_time * 1000000)) + bytes(frame))
+
+def read_capture_header(f):
+    """Read the header of a capture file.
+
+    Returns:
+        Tuple: (modbus_mode, baudrate)
+
+    Raises ValueError if the file is not a valid capture file.
+    """
+    b = f.read(CAPTURE_FILE_HEADER.size)
+    if len(b) < CAPTURE_FILE_HEADER.size:
+        raise ValueError('Capture file header is truncated.')
+    magic, version, mode, reserved, baudrate = CAPTURE_FILE_HEADER.unpack(b)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError('Not a capture file, or unsupported version.')
+    return mode, baudrate
+
+def read_capture(f):
+    """Read all records from a capture file (after the header)
+
+    Args:
+        f: File object opened for binary reading, positioned after the header
+
+    Returns:
+        Generator of CaptureRecord instances; a truncated final record is ignored.
+    """
+    while True:
+        b = f.read(CAPTURE_RECORD_HEADER.size)
+        if len(b) < CAPTURE_RECORD_HEADER.size:
+            return
+        length, flags, wall_us, mono_us = CAPTURE_RECORD_HEADER.unpack(b)
+        frame = f.read(length)
+        if len(frame) < length:
+            return
+        yield CaptureRecord(frame, flags, wall_us, mono_us)
+
+def capture_to_pcap(capture_path, pcap_path, linktype=PCAP_LINKTYPE_USER0):
+    """Export a capture file to pcap format
+
+    Args:
+        capture_path: Path to the capture file
+        pcap_path: Path to the pcap file to create
+        linktype: pcap link type for the frames
+
+    Returns:
+        The number of frames exported
+    """
+    count = 0
+    with open(capture_path, 'rb') as fin:
+        read_capture_header(fin)
+        with open(pcap_path, 'wb') as fout:
+            fout.write(struct.pack('<IHHiIII', PCAP_MAGIC, 2, 4, 0, 0, PCAP_SNAPLEN, linktype))
+            for r in read_capture(fin):
+                fout.write(struct.pack('<IIII', r.wall_us // 1000000, r.wall_us % 1000000, len(r.frame), len(r.frame)))
+                fout.write(r.frame)
+                count = count + 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', help='Capture file')
+    parser.add_argument('pcap', help='pcap file to create')
+    parser.add_argument('--linktype', type=int, default=PCAP_LINKTYPE_USER0, help='pcap link type')
+    args = parser.parse_args()
+    count = capture_to_pcap(args.capture, args.pcap, args.linktype)
+    print('Exported {} frames.'.format(count))
+
+if __name__ == "__main__":
+    main()
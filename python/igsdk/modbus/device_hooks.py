@@ -0,0 +1,100 @@
+#
+# device_hooks.py
+#
+# Pluggable device integration (LEDs, serial port configuration) for the
+# serial and Modbus modules
+#
+
+import logging
+
+class DeviceHooks:
+    """Device integration for a serial port (no-op implementation).
+
+    A SerialQueue calls open() when it is created (to configure the port
+    mode and termination), enabled(), activity() and exception() to
+    signal its state, and close() when it is stopped.  This class does
+    nothing, so the serial and Modbus modules can be used (and tested)
+    on any Linux host; see IGDeviceHooks for the Sentrius IG device.
+    """
+    def open(self, serial_mode, serial_term):
+        pass
+
+    def close(self):
+        pass
+
+    def enabled(self):
+        pass
+
+    def activity(self):
+        pass
+
+    def exception(self):
+        pass
+
+    def get_stats(self):
+        """Return the device signalling statistics (or None).
+        """
+        return None
+
+class IGDeviceHooks(DeviceHooks):
+    """Device integration with the Sentrius IG Device Service (see device.py).
+
+    The device module (and D-Bus) is only imported when the port is
+    opened; if it is not available, the hooks do nothing.
+    """
+    def __init__(self):
+        self.device = None
+        self.dev = None
+
+    def open(self, serial_mode, serial_term):
+        try:
+            from .. import device
+        except ImportError as e:
+            logging.getLogger(__name__).warning('Device integration not available: {}'.format(e))
+            return
+        self.device = device
+        self.dev = device.device_init()
+        device.device_enabled(self.dev)
+        # Disable termination temporarily to prevent error on setting mode
+        device.set_serial_termination(self.dev, 0)
+        device.set_serial_port_type(self.dev, serial_mode)
+        device.set_serial_termination(self.dev, serial_term)
+
+    def close(self):
+        if self.device:
+            self.device.device_deinit(self.dev)
+            self.dev = None
+
+    def enabled(self):
+        if self.dev:
+            self.device.device_enabled(self.dev)
+
+    def activity(self):
+        if self.dev:
+            self.device.device_activity(self.dev)
+
+    def exception(self):
+        if self.dev:
+            self.device.device_exception(self.dev)
+
+    def get_stats(self):
+        if self.dev:
+            return self.device.device_activity_stats(self.dev)
+        return None
+
+_default_factory = IGDeviceHooks
+
+def set_default_device_hooks(factory):
+    """Set the class (or function) that creates the device hooks of each new serial port.
+
+    Args:
+        factory: Callable with no arguments returning a DeviceHooks instance
+            (e.g., DeviceHooks to disable the device integration)
+    """
+    global _default_factory
+    _default_factory = factory
+
+def default_device_hooks():
+    """Create the device hooks for a new serial port (see set_default_device_hooks()).
+    """
+    return _default_factory()
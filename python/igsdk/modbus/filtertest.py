@@ -0,0 +1,95 @@
+#
+# filtertest.py
+#
+# Checks of the trace message direction, filter specifications,
+# request/response pairing and unanswered request expiry
+#
+# Run as: python -m igsdk.modbus.filtertest
+#
+
+from .message import ModbusMessage
+from .trace_filter import msg_direction, compile_filter, DIRECTION_REQUEST, DIRECTION_RESPONSE
+from .trace_decoder import TracePairer, TraceDecoder
+from .bus_stats import BusStats
+import sys
+
+failures = 0
+
+def check(name, value, expected):
+    global failures
+    if value == expected:
+        print('  ok    {}'.format(name))
+    else:
+        failures += 1
+        print('  FAIL  {}: {!r} (expected {!r})'.format(name, value, expected))
+
+def check_direction():
+    print('Message direction:')
+    # Read holding/input registers, start address 0x0300 (first data byte is 3)
+    check('FC3 request at 0x0300', msg_direction(ModbusMessage(1, 0x03, [0x03, 0x00, 0x00, 0x02])), DIRECTION_REQUEST)
+    check('FC4 request at 0x03FF', msg_direction(ModbusMessage(1, 0x04, [0x03, 0xFF, 0x00, 0x01])), DIRECTION_REQUEST)
+    check('FC3 response', msg_direction(ModbusMessage(1, 0x03, [0x04, 0x00, 0x01, 0x00, 0x02])), DIRECTION_RESPONSE)
+    # Read coils: a response with 3 data bytes has the same length as a request
+    check('FC1 request at 0x0300 (ambiguous)', msg_direction(ModbusMessage(1, 0x01, [0x03, 0x00, 0x00, 0x10])), None)
+    check('FC1 request at 0x0100', msg_direction(ModbusMessage(1, 0x01, [0x01, 0x00, 0x00, 0x10])), DIRECTION_REQUEST)
+    check('FC3 exception', msg_direction(ModbusMessage(1, 0x83, [0x02])), DIRECTION_RESPONSE)
+
+def filter_error(spec):
+    """Return the name of the exception raised by compile_filter(spec), or None"""
+    try:
+        compile_filter(spec)
+    except Exception as e:
+        return type(e).__name__
+    return None
+
+def check_filter_spec():
+    print('Filter specifications:')
+    check('Empty filter', compile_filter({}), None)
+    check('Address filter', compile_filter({ 'addresses' : [1] })(ModbusMessage(1, 0x03, [0, 0, 0, 1])), True)
+    # Malformed payloads are rejected with ValueError (reported by the trace Lambda)
+    check('List', filter_error([1, 2]), 'ValueError')
+    check('String', filter_error('x'), 'ValueError')
+    check('Number', filter_error(5), 'ValueError')
+    check('Invalid addresses', filter_error({ 'addresses' : 5 }), 'ValueError')
+    check('Unknown key', filter_error({ 'slaves' : [1] }), 'ValueError')
+
+def check_pairing():
+    print('Request/response pairing:')
+    unanswered = []
+    pairer = TracePairer(timeout=1.0, unanswered_cb=lambda msg, t: unanswered.append(msg))
+    req = ModbusMessage(1, 0x03, [0x03, 0x00, 0x00, 0x02])
+    resp = ModbusMessage(1, 0x03, [0x04, 0x00, 0x01, 0x00, 0x02])
+    check('FC3 request at 0x0300 is pending', pairer.add(req, 0.0), None)
+    pair = pairer.add(resp, 0.05)
+    check('FC3 response pairs with it', pair is not None and pair.req is req and pair.resp is resp, True)
+    # An unanswered request followed by the next poll is not taken as its response
+    check('Unanswered request', pairer.add(req, 0.2), None)
+    check('Next poll is not a response', pairer.add(req, 0.4), None)
+    check('Reported as unanswered', len(unanswered), 1)
+    # A request that is never followed by another frame expires
+    pairer.expire(2.0)
+    check('Expired as unanswered', len(unanswered), 2)
+
+def check_expire():
+    print('Unanswered requests in the bus statistics:')
+    stats = BusStats(9600)
+    decoder = TraceDecoder(stats=stats, decode=False, timeout=1.0)
+    # A slave that is polled once and never answers
+    decoder.add(ModbusMessage(7, 0x03, [0x00, 0x10, 0x00, 0x02]), 0.0, 8)
+    decoder.expire(0.5)
+    check('Not expired within the timeout', stats.summary()['slaves'].get(7), None)
+    decoder.expire(1.5)
+    check('Counted after the timeout', stats.summary()['slaves'][7][3]['unanswered'], 1)
+
+def main():
+    check_direction()
+    check_filter_spec()
+    check_pairing()
+    check_expire()
+    if failures:
+        print('{} check(s) failed.'.format(failures))
+        sys.exit(1)
+    print('All checks passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#
+# importbench.py
+#
+# Measurement of the import time of the Modbus modules, each in a new
+# interpreter, and of whether D-Bus and GLib are loaded by the import.
+# The device module (D-Bus) is measured for comparison.
+#
+# Run as: python -m igsdk.modbus.importbench [--runs N] [module ...]
+#
+
+import argparse
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    'igsdk.device',
+    'igsdk.modbus.serial_queue',
+    'igsdk.modbus.modbus_master',
+    'igsdk.modbus.modbus_slave',
+    'igsdk.modbus.modbus_trace'
+]
+
+# Run in the child interpreter: import the module, and report the time and D-Bus/GLib modules loaded
+CHILD = '''
+import sys, time
+t = time.time()
+try:
+    __import__({module!r})
+    ok = True
+except ImportError as e:
+    ok = False
+print('%d %f %d %d' % (ok, time.time() - t, 'dbus' in sys.modules, 'gi' in sys.modules or 'gobject' in sys.modules))
+'''
+
+def measure(module, runs):
+    times = []
+    result = None
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', CHILD.format(module=module)])
+        ok, t, dbus, glib = out.split()
+        if not int(ok):
+            return None
+        times.append(float(t))
+        result = (bool(int(dbus)), bool(int(glib)))
+    times.sort()
+    return times[len(times) // 2], result[0], result[1]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='Runs per module (the median is reported)')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES, help='Modules to import')
+    args = parser.parse_args()
+    print('Import time (median of {} runs, new interpreter each):'.format(args.runs))
+    print('  module                          time (ms)  D-Bus  GLib')
+    for module in args.modules:
+        r = measure(module, args.runs)
+        if r is None:
+            print('  {:30s} {:>10s}'.format(module, 'n/a'))
+        else:
+            print('  {:30s} {:10.1f}  {:5s}  {:5s}'.format(module, r[0] * 1000, 'yes' if r[1] else 'no', 'yes' if r[2] else 'no'))
+
+if __name__ == "__main__":
+    main()
@@ -81,12 +81,10 @@ class ModbusMessage:
         Returns:
             The CRC (16-bit) of the message, based on the Modbus CRC16 polynomial (0xA001).
         """
-        msg = self.data[:] # Make a copy!
-        msg.insert(0, self.function)
-        msg.insert(0, self.address)
         crc = 0xffff
-        for i in msg:
-            old_crc = crc
+        for i in (self.address, self.function):
+            crc = (crc >> 8) ^ self.CRC_TABLE[((crc ^ i) % 256)]
+        for i in self.data:
             crc = (crc >> 8) ^ self.CRC_TABLE[((crc ^ i) % 256)]
         return crc
 
@@ -130,6 +128,22 @@ class ModbusMessage:
         else:
             return json.dumps(my_obj, separators=(',',':'))
 
+    def to_compact(self):
+        """Convert the Modbus message to a compact array, for batched encoding
+
+        Returns:
+            A list: [received, address, function, data], where data is
+            the data payload encoded as a hexadecimal string.
+        """
+        return [self.received, self.address, self.function, ''.join('{:02x}'.format(d) for d in self.data)]
+
+    @staticmethod
+    def from_compact(arr):
+        """Construct a ModbusMessage instance from a compact array (see to_compact()).
+        """
+        data = arr[3]
+        return ModbusMessage(arr[1], arr[2], [int(data[i:i+2], 16) for i in range(0, len(data), 2)], arr[0])
+
     @staticmethod
     def from_obj(obj):
         """Construct a ModbusMessage instance from an object.
@@ -4,17 +4,22 @@
 
 from .message import ModbusMessage
 from .modbus_queue import ModbusQueue
+from .utilization import PollThrottle
+from .stats import monotonic
 import logging
-import time
 
 _master = None
 
 class ModbusMaster:
     """Class that encapsulates the Modbus master function.
+
+    The response timeout of each request starts when the request has been
+    completely transmitted (see SerialQueue.send_drain()), so that it does
+    not include the transmission time of the request itself.
     """
-    def __init__(self, port, baudrate, modbus_mode, serial_mode, serial_term):
+    def __init__(self, port, baudrate, modbus_mode, serial_mode, serial_term, reactor=None, realtime=None):
         self.logger = logging.getLogger(__name__)
-        self.queue = ModbusQueue(port, baudrate, modbus_mode, serial_mode, serial_term, except_on_timeout=True)
+        self.queue = ModbusQueue(port, baudrate, modbus_mode, serial_mode, serial_term, except_on_timeout=True, reactor=reactor, realtime=realtime)
 
     def start(self):
         self.queue.receive_start()
@@ -24,30 +29,34 @@ class ModbusMaster:
         
     def await_resp(self, req_address, req_function, resp_timeout):
         self.logger.debug('Awaiting slave response for address {}, function {}'.format(req_address, req_function))
-        resp_start = time.time()
         resp_msgs = self.queue.await_modbus_msgs(resp_timeout)
-        resp_end = time.time()
         if resp_msgs and len(resp_msgs) > 0:
             if resp_msgs[0].address == req_address and resp_msgs[0].function & 0x7F == req_function:
                 self.logger.debug('Got slave response: {}, {}, {}'.format(resp_msgs[0].address, resp_msgs[0].function, resp_msgs[0].data))
-                return resp_msgs[0], 0
+                return resp_msgs[0]
             else:
                 self.logger.debug('Invalid or mismatched slave response')
-                return None, resp_timeout - (resp_start - resp_end)
         else:
             # No bytes received, we exceeded the timeout
             self.logger.debug('Slave response timed out.')
-            return None, 0
+        return None
         
+    def poll_throttle(self, threshold, max_stretch):
+        return PollThrottle(self.queue.meter, threshold, max_stretch)
+
     def send_await(self, req, resp_timeout):
-        self.queue.send_modbus_msg(req)
-        resp, timeout_remain = self.await_resp(req.address, req.function, resp_timeout)
-        while not resp and timeout_remain > 0:
-            resp, timeout_remain = self.await_resp(req.address, req.function, timeout_remain)
-        return resp
+        # The response deadline starts when the request has left the wire
+        deadline = self.queue.send_modbus_msg(req, wait_tx=True) + resp_timeout
+        timeout_remain = resp_timeout
+        while timeout_remain > 0:
+            resp = self.await_resp(req.address, req.function, timeout_remain)
+            if resp:
+                return resp
+            timeout_remain = deadline - monotonic()
+        return None
 
 
-def modbus_master_start(port, baudrate, modbus_mode, serial_mode, serial_term):
+def modbus_master_start(port, baudrate, modbus_mode, serial_mode, serial_term, reactor=None, realtime=None):
     """Initialize and start the Modbus Master function.
 
     This function initializes the Modbus Master function on a specified serial port.
@@ -59,12 +68,14 @@ def modbus_master_start(port, baudrate, modbus_mode, serial_mode, serial_term):
         modbus_mode: 0 for ASCII, 1 for RTU
         serial_mode: 0: RS-232, 1: RS-485/422 half duplex, 2: RS485/422 full duplex
         serial_term: 0 for no termination, 1 to enable termination (RS485/422 only)
+        reactor: Optional Reactor (see reactor.py); the port is read on the reactor thread instead of a reader thread.
+        realtime: Optional RealtimeConfig (see realtime.py); the serial reader runs with real-time scheduling.
 
     Returns:
 
         An object instance to be used in the modbus_master_*() functions.
     """
-    master = ModbusMaster(port, baudrate, modbus_mode, serial_mode, serial_term)
+    master = ModbusMaster(port, baudrate, modbus_mode, serial_mode, serial_term, reactor, realtime)
     master.start()
     return master
 
@@ -84,9 +95,34 @@ def modbus_master_send_await(master, req, resp_timeout=5):
     
         master: The object returned from modbus_master_init()
         req: Request message (instance of a ModbusMessage)
-        resp_timeout: Timeout to await response (in seconds); default is 5 seconds.
+        resp_timeout: Timeout to await response (in seconds), from the end of the transmission of the request; default is 5 seconds.
         
     Returns:
         A ModbusMessage representing the response, or None if no message was received within the timeout.
     """
     return master.send_await(req, resp_timeout)
+
+def modbus_master_poll_throttle(master, threshold=0.7, max_stretch=4.0):
+    """Create a poll throttle based on the bus utilization.
+
+    A poller that sends requests periodically should use the returned
+    object to compute each poll period, as throttle.period(base_period).
+    While the (smoothed) bus utilization in both directions is above the
+    threshold, the period is stretched by the ratio of the utilization to
+    the threshold, up to max_stretch.
+
+    Args:
+
+        master: The object returned from modbus_master_init()
+        threshold: Utilization (0.0 - 1.0) above which poll periods are stretched
+        max_stretch: Maximum factor by which poll periods are stretched
+
+    Returns:
+        A PollThrottle instance (see utilization.py); call close() to unsubscribe.
+    """
+    return master.poll_throttle(threshold, max_stretch)
+
+def modbus_master_utilization(master):
+    """Return the bus utilization time series, as a list of objects (oldest first).
+    """
+    return [s.to_obj() for s in master.queue.meter.get_history()]
@@ -5,7 +5,6 @@ from .serial_queue import SerialQueue
 from .message import ModbusMessage
 from .asciiparser import ModbusASCIIParser
 from .rtuparser import ModbusRTUParser
-from ..device import device_enabled, device_activity, device_exception
 import logging
 
 class ModbusQueue(SerialQueue):
@@ -14,8 +13,8 @@ class ModbusQueue(SerialQueue):
     ModbusQueue (based on SerialQueue) manages continuously receiving
     Modbus messages (either ASCII or RTU frames).
     """
-    def __init__(self, port, baudrate, modbus_mode, serial_mode=0, serial_term=0, except_on_timeout=False):
-        super(ModbusQueue, self).__init__(port, baudrate, serial_mode, serial_term)
+    def __init__(self, port, baudrate, modbus_mode, serial_mode=0, serial_term=0, except_on_timeout=False, reactor=None, realtime=None, device_hooks=None):
+        super(ModbusQueue, self).__init__(port, baudrate, serial_mode, serial_term, reactor=reactor, realtime=realtime, device_hooks=device_hooks)
         self.logger = logging.getLogger(__name__)
         self.modbus_mode = modbus_mode
         self.except_on_timeout = except_on_timeout
@@ -26,20 +25,51 @@ class ModbusQueue(SerialQueue):
             self.parser = ModbusASCIIParser()
             self.logger.info('Created ASCII parser.')
 
-    def send_modbus_msg(self, msg):
+    def send_modbus_msg(self, msg, wait_tx=False):
         """Send a Modbus message.
         
         Args:
             msg: The message to send (instance of ModbusMessage)
+            wait_tx: If True, wait until the message has been transmitted
+
+        Returns:
+            The (monotonic) time at which the transmission completed, if
+            'wait_tx' is True; otherwise, None.
+        """
+        self.logger.debug('Sending Modbus message: {}, {}, {}'.format(msg.address, msg.function, msg.data))
+        return self.send_modbus_frame(self.encode_modbus_msg(msg), wait_tx)
+
+    def encode_modbus_msg(self, msg):
+        """Encode a Modbus message as a frame.
+
+        Args:
+            msg: The message to encode (instance of ModbusMessage)
+
+        Returns:
+            Byte string containing the RTU or ASCII frame
         """
-        self.receive_flush()
         if self.modbus_mode > 0:
-            msg_bytes = msg.rtu_frame()
+            return msg.rtu_frame()
         else:
-            msg_bytes = msg.ascii_frame()
-        self.logger.debug('Sending Modbus message: {}, {}, {}'.format(msg.address, msg.function, msg.data))
+            return msg.ascii_frame()
+
+    def send_modbus_frame(self, msg_bytes, wait_tx=False):
+        """Send an encoded Modbus frame.
+
+        Args:
+            msg_bytes: The frame to send (from encode_modbus_msg())
+            wait_tx: If True, wait until the frame has been transmitted (see send_drain())
+
+        Returns:
+            The (monotonic) time at which the transmission completed, if
+            'wait_tx' is True; otherwise, None.
+        """
+        self.receive_flush()
         self.send_msg(msg_bytes)
-        device_activity(self.device)
+        self.device.activity()
+        if wait_tx:
+            return self.send_drain()
+        return None
 
     def await_modbus_msgs(self, timeout=None):
         """Await Modbus messages from the queue.
@@ -50,14 +80,34 @@ class ModbusQueue(SerialQueue):
         Returns:
             List of ModbusMessages (can be empty, in case of a timeout)
         """
-        msgs = []
-        b = self.await_msg(timeout)
-        if b:
-            msgs = self.parser.msgs_from_bytes(b)
+        msg, rx_time = self.await_msg_view(timeout)
+        msgs = self.parse_modbus_msgs(msg)
         if self.except_on_timeout:
             if not msgs or len(msgs) == 0:
-                device_exception(self.device)
+                self.device.exception()
             else:
-                device_enabled(self.device) # Remove exception indication
-                device_activity(self.device)
+                self.device.enabled() # Remove exception indication
+                self.device.activity()
+        return msgs
+
+    def get_port_stats(self):
+        """Return the error statistics for the port, including the count of
+        frames that failed the CRC/LRC check ('check_errors').
+        """
+        stats = super(ModbusQueue, self).get_port_stats()
+        stats['check_errors'] = self.parser.check_errors
+        return stats
+
+    def parse_modbus_msgs(self, b):
+        """Parse Modbus messages from bytes received from the queue.
+
+        Args:
+            b: Received bytes (can be None)
+
+        Returns:
+            List of ModbusMessages (can be empty)
+        """
+        msgs = []
+        if b:
+            msgs = self.parser.msgs_from_bytes(b)
         return msgs
@@ -6,19 +6,43 @@ import threading
 from .message import ModbusMessage
 from .modbus_queue import ModbusQueue
 from .state_util import read_registers, read_bits, write_registers, write_bits, mask_write_register
+from .stats import LatencyHistogram, monotonic
 import logging
 
 class ModbusSlave(threading.Thread):
     """Class that encapsulates the Modbus slave function.
+
+    The slave measures the turnaround time of each request it answers,
+    from the end of the request frame to the end of the response frame,
+    as histograms for each request function code and processing phase:
+
+        queue: From the end of the request frame until it is dequeued
+            (this includes the inter-byte timeout used to frame requests)
+        parse: Parsing the request frame
+        state: Handling the request (including the state callbacks)
+        encode: Encoding the response frame
+        write: Writing the response to the serial port
+        drain: Waiting until the response has been transmitted (tcdrain)
+        total: The complete turnaround time
+
+    If a reactor is specified (see reactor.py), the port is read on the
+    reactor thread; requests are still handled (and the state callbacks
+    are called, and the responses written and drained) on the slave
+    thread, so that they never block the reactor.
     """
-    def __init__(self, port, baudrate, modbus_mode, serial_mode, serial_term, addr, get_read_cb, get_write_cb, set_write_cb):
+    STATS_PHASES = ('queue', 'parse', 'state', 'encode', 'write', 'drain', 'total')
+
+    def __init__(self, port, baudrate, modbus_mode, serial_mode, serial_term, addr, get_read_cb, get_write_cb, set_write_cb, reactor=None, realtime=None):
         self.logger = logging.getLogger(__name__)
-        self.queue = ModbusQueue(port, baudrate, modbus_mode, serial_mode, serial_term)
+        self.queue = ModbusQueue(port, baudrate, modbus_mode, serial_mode, serial_term, reactor=reactor, realtime=realtime)
+        self.reactor = reactor
         self.addr = addr
         self.get_read_cb = get_read_cb
         self.get_write_cb = get_write_cb
         self.set_write_cb = set_write_cb
         self.running = False
+        self.stats_lock = threading.Lock()
+        self.stats = {}
         threading.Thread.__init__(self)
 
     def slave_start(self):
@@ -33,18 +57,73 @@ class ModbusSlave(threading.Thread):
     def run(self):
         while self.running:
             self.logger.debug('Awaiting request for address {}'.format(self.addr))
-            msgs = self.queue.await_modbus_msgs()
-            if msgs and len(msgs) > 0:
-                if msgs[0].address == self.addr:
-                    resp = self.handle_request(msgs[0])
-                    if resp:
-                        self.send_resp(resp)
-                else:
-                    self.logger.info('Ignoring request for slave address {}'.format(msgs[0].address))
+            b, rx_time = self.queue.await_msg_view()
+            self.handle_chunk(b, rx_time)
         self.logger.debug('Message receive stopped.')
 
+    def handle_chunk(self, b, rx_time):
+        """Parse a received chunk, and respond to a request for this slave
+        """
+        t_parse = monotonic()
+        msgs = self.queue.parse_modbus_msgs(b)
+        if msgs and len(msgs) > 0:
+            if msgs[0].address == self.addr:
+                t_state = monotonic()
+                resp = self.handle_request(msgs[0])
+                if resp:
+                    t_encode = monotonic()
+                    times = self.send_resp(resp)
+                    self.add_stats(msgs[0].function, [rx_time or t_parse, t_parse, t_state, t_encode] + times)
+            else:
+                self.logger.info('Ignoring request for slave address {}'.format(msgs[0].address))
+
     def send_resp(self, resp):
-        self.queue.send_modbus_msg(resp)
+        """Send a response message, and wait until it is transmitted
+
+        Returns:
+            List of the (monotonic) times at which the encoding of the
+            response finished, the write finished, and the drain finished
+        """
+        msg_bytes = self.queue.encode_modbus_msg(resp)
+        t_write = monotonic()
+        self.queue.send_modbus_frame(msg_bytes)
+        t_drain = monotonic()
+        return [t_write, t_drain, self.queue.send_drain()]
+
+    def add_stats(self, function, times):
+        """Add turnaround times for a request to the statistics
+
+        Args:
+            function: Function code of the request
+            times: List of the (monotonic) times at which the request frame
+                ended, followed by the end times of each phase
+        """
+        with self.stats_lock:
+            hists = self.stats.get(function)
+            if hists is None:
+                hists = dict((phase, LatencyHistogram()) for phase in self.STATS_PHASES)
+                self.stats[function] = hists
+            for i, phase in enumerate(self.STATS_PHASES[:-1]):
+                hists[phase].add(times[i + 1] - times[i])
+            hists['total'].add(times[-1] - times[0])
+
+    def get_stats(self):
+        """Return the turnaround statistics
+
+        Returns:
+            Dictionary keyed by request function code, containing
+            a dictionary keyed by phase (see STATS_PHASES) of histogram
+            summaries (see LatencyHistogram.summary()), in seconds.
+        """
+        with self.stats_lock:
+            return dict((function, dict((phase, h.summary()) for phase, h in hists.items()))
+                for function, hists in self.stats.items())
+
+    def reset_stats(self):
+        """Clear the turnaround statistics
+        """
+        with self.stats_lock:
+            self.stats = {}
 
     def get_read_state(self, key):
         """Get read state key using callback
@@ -195,7 +274,7 @@ class ModbusSlave(threading.Thread):
             self.logger.info('Returning Exception response (Illegal address)')
             return ModbusMessage(req.address, req.function | 0x80, [2]) # Exception response - Illegal address
 
-def modbus_slave_start(port, baudrate, modbus_mode, serial_mode, serial_term, slave_addr, get_read_cb, get_write_cb, set_write_cb):
+def modbus_slave_start(port, baudrate, modbus_mode, serial_mode, serial_term, slave_addr, get_read_cb, get_write_cb, set_write_cb, reactor=None, realtime=None):
     """Perform Modbus Slave function, responding to Modbus requests based on state
 
     This function listens for Modbus requests from a master, and responds
@@ -221,6 +300,8 @@ def modbus_slave_start(port, baudrate, modbus_mode, serial_mode, serial_term, sl
         get_read_cb: Callback function to get readable values
         get_write_cb: Callback function to get writeable values
         set_write_cb: Callback function to set writeable values
+        reactor: Optional Reactor (see reactor.py); the port is read on the reactor thread instead of a reader thread.
+        realtime: Optional RealtimeConfig (see realtime.py); the serial reader runs with real-time scheduling.
 
     get_read_cb() takes no parameters, and should return a Python
     dictionary with the readable elements (see Schema, below).
@@ -268,10 +349,29 @@ def modbus_slave_start(port, baudrate, modbus_mode, serial_mode, serial_term, sl
         An object instance to be used in the modbus_slave_*() functions.
     """
     # Create Slave object
-    slave = ModbusSlave(port, baudrate, modbus_mode, serial_mode, serial_term, slave_addr, get_read_cb, get_write_cb, set_write_cb)
+    slave = ModbusSlave(port, baudrate, modbus_mode, serial_mode, serial_term, slave_addr, get_read_cb, get_write_cb, set_write_cb, reactor, realtime)
     # Start processing requests
     slave.slave_start()
     return slave
 
 def modbus_slave_stop(slave):
     slave.slave_stop()
+
+def modbus_slave_get_stats(slave, reset=False):
+    """Return the slave request turnaround statistics.
+
+    Args:
+
+        slave: The object returned from modbus_slave_start()
+        reset: If True, the statistics are cleared after they are returned
+
+    Returns:
+
+        A dictionary keyed by request function code, with a summary
+        (count, min, max, mean, p50, p99, p999; in seconds) for each
+        processing phase (queue, parse, state, encode, write, drain, total).
+    """
+    stats = slave.get_stats()
+    if reset:
+        slave.reset_stats()
+    return stats
@@ -5,27 +5,169 @@
 import threading
 from .message import ModbusMessage
 from .modbus_queue import ModbusQueue
+from .capture import CAPTURE_FLAG_CHECK_ERROR, CAPTURE_FLAG_REQUEST, CAPTURE_FLAG_RESPONSE
+from .trace_filter import compile_filter, msg_direction, DIRECTION_REQUEST, DIRECTION_RESPONSE
+from .stats import monotonic
 import logging
 
 class ModbusTrace(threading.Thread):
     """Class that encapsulates the Modbus trace function.
+
+    An optional filter (see trace_filter.compile_filter()) is applied to
+    each received message before it is passed to the callback; the filter
+    can be changed at any time with set_filter().  The capture (if any)
+    and the decoder (if any, see trace_decoder.TraceDecoder) always receive
+    all frames.
+
+    Several frames are often received together (separated only by the
+    inter-byte timeout); the end time of each frame is estimated from the
+    receive time of the last byte, less the transmission time of the bytes
+    that follow the frame.
+
+    The capture (if any) records each frame as it was received, flagged
+    as a request or response (see trace_filter.msg_direction(); neither if
+    it cannot be determined), or as failing the CRC/LRC check.
+
+    If a reactor is specified (see reactor.py), the port is read on the
+    reactor thread; the received chunks are still processed (and captured,
+    and the callback is called) on the trace thread, so that they never
+    block the reactor.
+
+    Requests that are not answered are reported to the decoder (see
+    TraceDecoder.expire()) after each received chunk, and when no data
+    is received for the decoder's pairing timeout.
     """
-    def __init__(self, port, baudrate, modbus_mode, serial_mode, serial_term, msg_callback):
+    def __init__(self, port, baudrate, modbus_mode, serial_mode, serial_term, msg_callback, capture=None, msg_filter=None, decoder=None, reactor=None, realtime=None):
         self.logger = logging.getLogger(__name__)
-        self.queue = ModbusQueue(port, baudrate, modbus_mode, serial_mode, serial_term)
+        self.queue = ModbusQueue(port, baudrate, modbus_mode, serial_mode, serial_term, reactor=reactor, realtime=realtime)
+        self.reactor = reactor
+        self.modbus_mode = modbus_mode
+        self.char_time = 10.0 / baudrate # 1 start bit, 8 data bits, 1 stop bit
+        self.decoder = decoder
+        self.check_errors = 0
         self.msg_callback = msg_callback
+        self.capture = capture
+        # Raw frames (and parsed messages) of the chunk being processed, for the capture
+        self.capture_frames = []
+        if capture:
+            self.queue.parser.frame_cb = self.add_capture_frame
+        self.filter_spec = None
+        self.filter = None
+        self.accepted_count = 0
+        self.rejected_count = 0
+        self.set_filter(msg_filter)
         self.running = False
         threading.Thread.__init__(self)
 
+    def set_filter(self, spec):
+        """Set the message filter (None or empty to pass all messages).
+
+        Raises ValueError if the filter specification is invalid (in which
+        case the current filter is not changed).
+        """
+        msg_filter = compile_filter(spec)
+        self.filter_spec = spec or None
+        self.filter = msg_filter
+        self.logger.info('Trace filter set: {}'.format(self.filter_spec))
+
+    def get_filter_stats(self):
+        """Return the current filter specification and the accepted/rejected message counts.
+        """
+        return { 'filter' : self.filter_spec, 'accepted' : self.accepted_count, 'rejected' : self.rejected_count }
+
     def run(self):
+        # Wake up when idle, to expire unanswered requests
+        timeout = self.decoder.pairer.timeout if self.decoder else None
         while self.running:
-            msgs = self.queue.await_modbus_msgs()
-            if msgs and len(msgs) > 0:
-                for m in msgs:
-                    self.logger.debug('Forwarding message to callback.')
-                    self.msg_callback(m)
+            # Drain all received chunks at once, to keep up with bursts
+            chunks = self.queue.await_msgs_timed(timeout)
+            for b, rx_time in chunks:
+                self.process_chunk(b, rx_time)
+            if not chunks:
+                self.expire_requests()
         self.logger.debug('Message receive stopped.')
 
+    def expire_requests(self):
+        """Report the requests that were not answered within the timeout to the decoder.
+        """
+        if self.decoder:
+            self.decoder.expire(monotonic())
+
+    def process_chunk(self, b, rx_time):
+        """Parse, capture, decode and forward the messages in a received chunk
+        """
+        msgs = self.queue.parse_modbus_msgs(b)
+        frames, times = self.frame_times(b, msgs, rx_time)
+        if self.capture:
+            self.capture_msgs(rx_time)
+        if self.decoder:
+            for i, m in enumerate(msgs):
+                self.decoder.add(m, times[i], len(frames[i]))
+            check_errors = self.queue.parser.check_errors
+            if check_errors != self.check_errors:
+                self.decoder.add_check_errors(check_errors - self.check_errors, max(0, len(b) - sum(len(f) for f in frames)))
+                self.check_errors = check_errors
+            self.decoder.expire(rx_time)
+        if msgs and len(msgs) > 0 and self.msg_callback:
+            msg_filter = self.filter
+            for m in msgs:
+                if msg_filter and not msg_filter(m):
+                    self.rejected_count += 1
+                    continue
+                self.accepted_count += 1
+                self.logger.debug('Forwarding message to callback.')
+                self.msg_callback(m)
+
+    def frame_times(self, b, msgs, rx_time):
+        """Estimate the end time of each frame parsed from received bytes
+
+        Returns:
+            Tuple: (frames, times):
+                frames: List of the encoded frame of each message
+                times: List of the estimated (monotonic) end time of each frame,
+                    followed by the end time of any unparsed bytes
+        """
+        frames = [self.queue.encode_modbus_msg(m) for m in msgs]
+        remaining = len(b) - sum(len(f) for f in frames)
+        if not self.modbus_mode or self.modbus_mode <= 0:
+            remaining = 0 # ASCII frames can span received chunks
+        times = [0] * len(frames)
+        t = rx_time - self.char_time * remaining
+        for i in range(len(frames) - 1, -1, -1):
+            times[i] = t
+            t -= self.char_time * len(frames[i])
+        times.append(rx_time)
+        return frames, times
+
+    def add_capture_frame(self, frame, msg):
+        """Collect a raw frame from the parser (see ModbusBaseParser.frame_cb)
+        """
+        self.capture_frames.append((frame, msg))
+
+    def capture_msgs(self, rx_time):
+        """Write the raw frames parsed from received bytes to the capture
+
+        Each frame is captured with its direction flag (if known), or the
+        check error flag if it failed the CRC/LRC check; for RTU, any bytes
+        that could not be parsed are captured as a single frame with the
+        check error flag.  The end time of each frame is estimated from the
+        bytes received after it.
+        """
+        frames = self.capture_frames
+        self.capture_frames = []
+        t = rx_time
+        times = [0] * len(frames)
+        for i in range(len(frames) - 1, -1, -1):
+            times[i] = t
+            t -= self.char_time * len(frames[i][0])
+        for i, (frame, msg) in enumerate(frames):
+            if msg is None:
+                flags = CAPTURE_FLAG_CHECK_ERROR
+            else:
+                direction = msg_direction(msg)
+                flags = CAPTURE_FLAG_REQUEST if direction == DIRECTION_REQUEST else CAPTURE_FLAG_RESPONSE if direction == DIRECTION_RESPONSE else 0
+            self.capture.write_frame(frame, flags, times[i])
+
     def trace_start(self):
         self.running = True
         # Start receiving packets
@@ -38,7 +180,7 @@ class ModbusTrace(threading.Thread):
         self.running = False
         self.queue.receive_stop()
 
-def modbus_trace_start(port, baudrate, modbus_mode, serial_mode, serial_term, msg_callback):
+def modbus_trace_start(port, baudrate, modbus_mode, serial_mode, serial_term, msg_callback, capture=None, msg_filter=None, decoder=None, reactor=None, realtime=None):
     """Starts Modbus Trace function, sniffing for Modbus frames and returning them via callback.
 
     This function listens on a specified serial port for Modbus frames (either ASCII or RTU) and
@@ -52,12 +194,17 @@ def modbus_trace_start(port, baudrate, modbus_mode, serial_mode, serial_term, ms
         serial_mode: 0: RS-232, 1:RS-485/422 half duplex, 2: RS-485/422 full duplex
         serial_term: 0 for no termination, 1 to enable termination (RS485/422 only)
         msg_callback: Callback function to receive frames.  The callback should accept a single argument, a ModbusMessage instance.
+        capture: Optional CaptureWriter instance (see capture.py); all received frames are written to the capture.
+        msg_filter: Optional filter specification (see trace_filter.compile_filter()); only matching messages are passed to the callback.
+        decoder: Optional TraceDecoder instance (see trace_decoder.py); all received messages are passed to the decoder.
+        reactor: Optional Reactor (see reactor.py); the port is read on the reactor thread instead of a reader thread.
+        realtime: Optional RealtimeConfig (see realtime.py); the serial reader runs with real-time scheduling.
 
     Returns:
 
         An object instance to be used in the modbus_trace_*() functions.
     """
-    trace = ModbusTrace(port, baudrate, modbus_mode, serial_mode, serial_term, msg_callback)
+    trace = ModbusTrace(port, baudrate, modbus_mode, serial_mode, serial_term, msg_callback, capture, msg_filter, decoder, reactor, realtime)
     trace.trace_start()
     return trace
 
@@ -66,3 +213,32 @@ def modbus_trace_stop(trace):
     """
     trace.trace_stop()
 
+def modbus_trace_set_filter(trace, msg_filter):
+    """Change the Modbus trace message filter.
+
+    Args:
+
+        trace: The object returned from modbus_trace_start()
+        msg_filter: Filter specification (see trace_filter.compile_filter()), or None to pass all messages
+
+    Raises ValueError if the filter specification is invalid.
+    """
+    trace.set_filter(msg_filter)
+
+def modbus_trace_port_stats(trace):
+    """Return the error statistics for the serial port used by the trace.
+
+    Args:
+
+        trace: The object returned from modbus_trace_start()
+
+    Returns:
+
+        A dictionary containing the kernel serial error counters ('uart'),
+        the count of received data dropped due to a full queue ('queue_drops'),
+        the count of frames that failed the CRC/LRC check ('check_errors'),
+        and the scheduling latency of the reader ('sched_latency'); see
+        SerialQueue.get_port_stats().
+    """
+    return trace.queue.get_port_stats()
+
@@ -0,0 +1,185 @@
+#
+# reactor.py
+#
+# Single-threaded event loop (epoll) for serial ports and timers
+#
+
+from .stats import LatencyHistogram, monotonic
+from .realtime import set_thread_realtime
+import select
+import threading
+import heapq
+import os
+import errno
+import logging
+
+class ReactorTimer:
+    """Handle for a timer scheduled on a Reactor (see Reactor.call_later()).
+    """
+    def __init__(self, deadline, cb, interval=None):
+        self.deadline = deadline
+        self.cb = cb
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+class Reactor(threading.Thread):
+    """An event loop that multiplexes file descriptors and timers on one thread.
+
+    Readers (see add_reader()) are called when their file descriptor is
+    readable, and timers (see call_later()) when they expire; all callbacks
+    are called on the reactor thread, one at a time, so they must not
+    block.  Readers and timers can be added and removed from any thread.
+
+    A SerialQueue created with a reactor (see serial_queue.py) registers
+    its port as a reader, and frames the received data with a timer, so
+    that any number of ports share this thread in place of a reader thread
+    per port.  The consumers of the received data (e.g., Modbus slave and
+    trace) keep their own threads, since they block on serial writes,
+    files and publishing.
+
+    If 'realtime' is specified (see realtime.RealtimeConfig), the reactor
+    thread runs with real-time scheduling.  The lateness of each timer
+    (mostly scheduling latency) is measured in 'timer_latency'.
+    """
+    def __init__(self, realtime=None):
+        self.logger = logging.getLogger(__name__)
+        self.realtime = realtime
+        self.realtime_result = None
+        self.timer_latency = LatencyHistogram()
+        self.epoll = select.epoll()
+        self.readers = {}
+        self.timers = []
+        self.lock = threading.Lock()
+        self.running = False
+        # Pipe used to wake the loop when readers or timers are changed
+        self.wake_r, self.wake_w = os.pipe()
+        self.epoll.register(self.wake_r, select.EPOLLIN)
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def wakeup(self):
+        if threading.current_thread() is not self:
+            os.write(self.wake_w, b'\0')
+
+    def add_reader(self, fd, cb):
+        """Call cb() (with no arguments) whenever 'fd' is readable.
+        """
+        with self.lock:
+            self.readers[fd] = cb
+            self.epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        with self.lock:
+            if self.readers.pop(fd, None):
+                self.epoll.unregister(fd)
+
+    def call_later(self, delay, cb, interval=None):
+        """Call cb() (with no arguments) after 'delay' seconds, then every 'interval' seconds (if specified).
+
+        Returns:
+            A ReactorTimer; call cancel() to cancel the timer.
+        """
+        timer = ReactorTimer(monotonic() + delay, cb, interval)
+        with self.lock:
+            heapq.heappush(self.timers, timer)
+        self.wakeup()
+        return timer
+
+    def call_soon(self, cb):
+        """Call cb() (with no arguments) on the reactor thread, as soon as possible.
+        """
+        return self.call_later(0, cb)
+
+    def reactor_start(self):
+        self.running = True
+        self.start()
+
+    def reactor_stop(self):
+        self.running = False
+        os.write(self.wake_w, b'\0')
+
+    def _next_timeout(self):
+        with self.lock:
+            while self.timers and self.timers[0].cancelled:
+                heapq.heappop(self.timers)
+            if not self.timers:
+                return -1
+            return max(0, self.timers[0].deadline - monotonic())
+
+    def _run_timers(self):
+        now = monotonic()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0].deadline <= now:
+                timer = heapq.heappop(self.timers)
+                if timer.cancelled:
+                    continue
+                due.append(timer)
+                self.timer_latency.add(now - timer.deadline)
+                if timer.interval:
+                    timer.deadline += timer.interval
+                    heapq.heappush(self.timers, timer)
+        for timer in due:
+            self._call(timer.cb)
+
+    def _call(self, cb):
+        try:
+            cb()
+        except Exception as e:
+            self.logger.error('Reactor callback failed: {}'.format(e))
+
+    def run(self):
+        """The method that is run in the thread context; dispatches readers and timers until stopped.
+        """
+        self.logger.info('Starting reactor.')
+        if self.realtime:
+            self.realtime_result = set_thread_realtime(self.realtime)
+        while self.running:
+            try:
+                events = self.epoll.poll(self._next_timeout())
+            except (IOError, OSError) as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            for fd, mask in events:
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 1024)
+                    continue
+                cb = self.readers.get(fd)
+                if cb:
+                    self._call(cb)
+            self._run_timers()
+        self.epoll.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        self.logger.info('Reactor stopped.')
+
+def modbus_reactor_start(realtime=None):
+    """Create and start a reactor, to be shared by the Modbus functions.
+
+    Pass the returned object as the 'reactor' argument to modbus_master_start(),
+    modbus_slave_start() and modbus_trace_start() to read their serial ports on
+    the reactor thread.
+
+    Args:
+
+        realtime: Optional RealtimeConfig (see realtime.py) for the reactor thread
+
+    Returns:
+
+        A Reactor instance, to be used in modbus_reactor_stop().
+    """
+    reactor = Reactor(realtime)
+    reactor.reactor_start()
+    return reactor
+
+def modbus_reactor_stop(reactor):
+    """Stop the reactor (stop the functions using it first).
+    """
+    reactor.reactor_stop()
@@ -0,0 +1,86 @@
+#
+# reactorbench.py
+#
+# Benchmark of the CPU usage of Modbus trace on many ports, with a reader
+# thread per port versus a single reactor thread reading all ports (with a
+# trace thread per port in both cases), using pseudo-terminal pairs in
+# place of the serial ports.
+#
+# Run as: python -m igsdk.modbus.reactorbench [--ports N] [--rate R] [--duration S]
+#
+
+from igsdk.modbus.modbus_trace import ModbusTrace
+from igsdk.modbus.reactor import Reactor
+from igsdk.modbus.message import ModbusMessage
+import argparse
+import os
+import threading
+import time
+import tty
+
+BAUDRATE = 115200
+
+# Request and response, sent as separate frames
+bench_frames = [
+    ModbusMessage(1, ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS, [0, 0, 0, 16]).rtu_frame(),
+    ModbusMessage(1, ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS, [32] + list(range(32))).rtu_frame()
+]
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+def feed(fds, rate, duration, gap):
+    """Write frames to all ports at 'rate' frames per second (per port)"""
+    end = time.time() + duration
+    i = 0
+    while time.time() < end:
+        for fd in fds:
+            os.write(fd, bench_frames[i % len(bench_frames)])
+        i += 1
+        time.sleep(max(gap, 1.0 / rate))
+    return i * len(fds)
+
+def run_mode(use_reactor, ports, rate, duration):
+    counts = [0]
+    def count_msg(msg):
+        counts[0] += 1
+    reactor = Reactor() if use_reactor else None
+    if reactor:
+        reactor.reactor_start()
+    ptys = [os.openpty() for i in range(ports)]
+    traces = []
+    for master_fd, slave_fd in ptys:
+        tty.setraw(master_fd)
+        traces.append(ModbusTrace(os.ttyname(slave_fd), BAUDRATE, 1, 0, 0, count_msg, reactor=reactor))
+    for t in traces:
+        t.trace_start()
+    threads = threading.active_count()
+    start_cpu = cpu_time()
+    # Frames must be separated by more than the inter-byte timeout to be framed separately
+    sent = feed([p[0] for p in ptys], rate, duration, traces[0].queue.inter_byte_timeout * 1.5)
+    time.sleep(0.5)
+    cpu = cpu_time() - start_cpu
+    for t in traces:
+        t.trace_stop()
+    if reactor:
+        reactor.reactor_stop()
+    for master_fd, slave_fd in ptys:
+        os.close(master_fd)
+        os.close(slave_fd)
+    return { 'threads' : threads, 'cpu' : cpu, 'sent' : sent, 'received' : counts[0] }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ports', type=int, default=5, help='Number of ports')
+    parser.add_argument('--rate', type=float, default=5, help='Frames per second, per port')
+    parser.add_argument('--duration', type=float, default=20, help='Duration of each run (seconds)')
+    args = parser.parse_args()
+    print('Trace on {} ports, {} frames/s per port, {} s'.format(args.ports, args.rate, args.duration))
+    print('  mode              threads  CPU (s)  CPU (%)  sent  received')
+    for name, use_reactor in (('thread-per-port', False), ('reactor', True)):
+        r = run_mode(use_reactor, args.ports, args.rate, args.duration)
+        print('  {:16s} {:8d} {:8.2f} {:8.1f} {:5d} {:9d}'.format(name, r['threads'], r['cpu'], 100.0 * r['cpu'] / args.duration, r['sent'], r['received']))
+
+if __name__ == "__main__":
+    main()
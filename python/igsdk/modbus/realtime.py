@@ -0,0 +1,95 @@
+#
+# realtime.py
+#
+# Real-time scheduling for the serial reader thread (Linux)
+#
+
+import ctypes
+import ctypes.util
+import os
+import logging
+
+REALTIME_PRIORITY_DEFAULT = 50
+
+# From <sys/mman.h>
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+_memory_locked = False
+
+class RealtimeConfig:
+    """Real-time settings for a serial reader (or reactor) thread.
+
+    Args:
+        priority: SCHED_FIFO priority (1 - 99)
+        cpus: Set of CPU numbers the thread may run on (None to leave unchanged)
+        mlock: If True, lock the current process pages in memory (mlockall);
+            this is done once per process, and applies to all threads
+        low_latency: If True, request the serial driver low-latency mode
+            (ASYNC_LOW_LATENCY), which passes received bytes to the reader
+            without waiting for the driver's receive buffer to be flushed
+    """
+    def __init__(self, priority=REALTIME_PRIORITY_DEFAULT, cpus=None, mlock=True, low_latency=True):
+        self.priority = priority
+        self.cpus = set(cpus) if cpus is not None else None
+        self.mlock = mlock
+        self.low_latency = low_latency
+
+    @staticmethod
+    def from_str(s):
+        """Create a config from a string '<priority>[:<cpu>,<cpu>...]' (e.g., '50:1'), or None if empty.
+        """
+        if not s:
+            return None
+        parts = s.split(':')
+        cpus = [int(c) for c in parts[1].split(',')] if len(parts) > 1 and parts[1] else None
+        return RealtimeConfig(int(parts[0]), cpus)
+
+def lock_memory():
+    """Lock the pages currently mapped by the process in memory (mlockall).
+
+    Only the current pages are locked (MCL_CURRENT); locking future mappings
+    would also commit the full stack of every thread created later.
+
+    Returns True if the pages are locked.
+    """
+    global _memory_locked
+    if _memory_locked:
+        return True
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if libc.mlockall(MCL_CURRENT) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        _memory_locked = True
+    except (OSError, AttributeError) as e:
+        logging.getLogger(__name__).warning('Cannot lock memory: {}'.format(e))
+    return _memory_locked
+
+def set_thread_realtime(config):
+    """Apply the scheduling settings to the calling thread.
+
+    Each setting that fails (e.g., without CAP_SYS_NICE/CAP_IPC_LOCK, or on
+    Python 2, which lacks os.sched_setscheduler()) is logged and skipped,
+    and the thread continues with the normal scheduling.
+
+    Returns:
+        Dictionary of the settings applied: 'sched_fifo', 'affinity', 'mlock' (True/False)
+    """
+    logger = logging.getLogger(__name__)
+    result = { 'sched_fifo' : False, 'affinity' : False, 'mlock' : False }
+    if config.cpus is not None:
+        try:
+            # On Linux, pid 0 applies to the calling thread only
+            os.sched_setaffinity(0, config.cpus)
+            result['affinity'] = True
+        except (OSError, AttributeError) as e:
+            logger.warning('Cannot set CPU affinity {}: {}'.format(sorted(config.cpus), e))
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(config.priority))
+        result['sched_fifo'] = True
+    except (OSError, AttributeError) as e:
+        logger.warning('Cannot set SCHED_FIFO priority {}: {}'.format(config.priority, e))
+    if config.mlock:
+        result['mlock'] = lock_memory()
+    logger.info('Real-time settings applied: {}'.format(result))
+    return result
@@ -0,0 +1,198 @@
+#
+# replay.py
+#
+# Timed replay of captured Modbus traffic
+#
+# Frames recorded by ModbusTrace (binary capture, see capture.py) or by the
+# text file storage Lambda (CSV: received,address,function,data...) are
+# replayed at their original timing (or scaled by a speed factor) into
+# a file descriptor (e.g., a pseudo-terminal), a SerialQueue/ModbusQueue,
+# or directly into a parser.
+#
+
+from .capture import read_capture_header, read_capture, CAPTURE_FLAG_TX
+from .message import ModbusMessage
+from .asciiparser import ModbusASCIIParser
+from .rtuparser import ModbusRTUParser
+from .stats import LatencyHistogram, monotonic
+import argparse
+import logging
+import os
+import time
+import tty
+
+class ReplayFrame:
+    """Class representing a single frame to replay.
+    """
+    def __init__(self, t, frame, flags=0):
+        self.t = t
+        self.frame = frame
+        self.flags = flags
+
+def read_capture_frames(path, include_tx=True):
+    """Read frames to replay from a binary capture file.
+
+    Args:
+        path: Path to the capture file
+        include_tx: If False, transmitted frames are skipped
+
+    Returns:
+        Tuple: (modbus_mode, baudrate, frames):
+            modbus_mode: Mode recorded in the capture (0 = ASCII, 1 = RTU)
+            baudrate: Baud rate recorded in the capture
+            frames: List of ReplayFrame instances, timed by the monotonic timestamps
+    """
+    frames = []
+    with open(path, 'rb') as f:
+        modbus_mode, baudrate = read_capture_header(f)
+        for r in read_capture(f):
+            if include_tx or not (r.flags & CAPTURE_FLAG_TX):
+                frames.append(ReplayFrame(r.mono_us / 1000000.0, r.frame, r.flags))
+    return modbus_mode, baudrate, frames
+
+def read_csv_frames(path, modbus_mode):
+    """Read frames to replay from a CSV file (as written by the text file storage Lambda).
+
+    Each line contains the received time (milliseconds since the epoch), address,
+    function, and data bytes; the frames are encoded in the specified mode.
+
+    Args:
+        path: Path to the CSV file
+        modbus_mode: 0 for ASCII, 1 for RTU
+
+    Returns:
+        List of ReplayFrame instances
+    """
+    frames = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = [v for v in line.strip().split(',') if v != '']
+            if len(fields) < 3:
+                continue
+            try:
+                values = [int(v) for v in fields]
+            except ValueError:
+                logging.getLogger(__name__).warning('Skipping invalid CSV line: {}'.format(line.strip()))
+                continue
+            msg = ModbusMessage(values[1], values[2], values[3:])
+            frame = msg.rtu_frame() if modbus_mode > 0 else msg.ascii_frame()
+            frames.append(ReplayFrame(values[0] / 1000.0, frame))
+    return frames
+
+class ModbusReplayer:
+    """Replays frames with their original inter-frame gaps.
+
+    The gaps between frames are divided by 'speed' (e.g., 2.0 replays at
+    twice the original rate); a speed of 0 replays without any delay.
+    The lateness of each frame relative to its schedule is recorded in
+    a histogram, so that the fidelity of the replay can be checked.
+    """
+    def __init__(self, frames, speed=1.0):
+        self.logger = logging.getLogger(__name__)
+        self.frames = frames
+        self.speed = speed
+        self.running = False
+        self.frame_count = 0
+        self.byte_count = 0
+        self.lateness = LatencyHistogram()
+
+    def replay(self, sink, loops=1):
+        """Replay all frames into a sink.
+
+        Args:
+            sink: Function that accepts a single argument, the frame bytes
+            loops: Number of times to replay the frames (0 to repeat until stopped)
+        """
+        self.running = True
+        n = 0
+        while self.running and (loops == 0 or n < loops):
+            self._replay_once(sink)
+            n = n + 1
+        self.running = False
+
+    def _replay_once(self, sink):
+        if not self.frames:
+            return
+        t0 = self.frames[0].t
+        start = monotonic()
+        for f in self.frames:
+            if not self.running:
+                break
+            if self.speed > 0:
+                target = start + (f.t - t0) / self.speed
+                delay = target - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.lateness.add(max(0, monotonic() - target))
+            sink(f.frame)
+            self.frame_count += 1
+            self.byte_count += len(f.frame)
+
+    def stop(self):
+        self.running = False
+
+    def get_stats(self):
+        """Return the replay statistics.
+        """
+        return { 'frames' : self.frame_count, 'bytes' : self.byte_count, 'lateness' : self.lateness.summary() }
+
+def fd_sink(fd):
+    """Return a sink that writes frames to a file descriptor (e.g., a pseudo-terminal master).
+    """
+    def sink(frame):
+        os.write(fd, frame)
+    return sink
+
+def queue_sink(queue):
+    """Return a sink that injects frames into a SerialQueue (or ModbusQueue) as received data.
+    """
+    def sink(frame):
+        queue.inject_msg(frame)
+    return sink
+
+def parser_sink(parser, msg_callback=None):
+    """Return a sink that parses frames with a Modbus parser, optionally passing each message to a callback.
+    """
+    def sink(frame):
+        for m in parser.msgs_from_bytes(frame):
+            if msg_callback:
+                msg_callback(m)
+    return sink
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='Capture (.igcap) or CSV file')
+    parser.add_argument('--mode', type=int, default=1, help='Modbus mode for CSV files, 0 = ASCII, 1 = RTU')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed factor (0 = no delay)')
+    parser.add_argument('--loops', type=int, default=1, help='Number of times to replay (0 = forever)')
+    parser.add_argument('--pty', action='store_true', help='Replay into a pseudo-terminal (otherwise, parse only)')
+    args = parser.parse_args()
+    if args.file.endswith('.csv'):
+        mode = args.mode
+        frames = read_csv_frames(args.file, mode)
+    else:
+        mode, baudrate, frames = read_capture_frames(args.file)
+    print('Replaying {} frames from {} ({}), speed={}'.format(len(frames), args.file, 'RTU' if mode else 'ASCII', args.speed))
+    replayer = ModbusReplayer(frames, args.speed)
+    msgcount = [0]
+    def count_msg(msg):
+        msgcount[0] += 1
+    if args.pty:
+        master_fd, slave_fd = os.openpty()
+        tty.setraw(master_fd)
+        print('Replaying into {}; press Enter to start.'.format(os.ttyname(slave_fd)))
+        input()
+        sink = fd_sink(master_fd)
+    else:
+        sink = parser_sink(ModbusRTUParser() if mode else ModbusASCIIParser(), count_msg)
+    start = monotonic()
+    replayer.replay(sink, args.loops)
+    elapsed = monotonic() - start
+    stats = replayer.get_stats()
+    print('Replay complete: {} frames, {} bytes, {} messages parsed in {:.3f} s'.format(stats['frames'], stats['bytes'], msgcount[0], elapsed))
+    if stats['lateness']['count']:
+        print('Lateness (ms): p50={:.3f}, p99={:.3f}, max={:.3f}'.format(stats['lateness']['p50'] * 1000,
+            stats['lateness']['p99'] * 1000, stats['lateness']['max'] * 1000))
+
+if __name__ == "__main__":
+    main()
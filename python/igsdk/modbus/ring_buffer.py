@@ -0,0 +1,253 @@
+#
+# ring_buffer.py
+#
+# Bounded byte ring buffer for received serial data
+#
+
+from .stats import monotonic
+from collections import deque
+import threading
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)
+
+RING_CAPACITY_DEFAULT = 64 * 1024
+RING_MAX_CHUNKS_DEFAULT = 256
+
+class ChunkRing:
+    """A bounded ring buffer of received byte chunks.
+
+    The bytes of each chunk are stored in a single preallocated buffer of
+    'capacity' bytes, and the length and receive time of each chunk are
+    kept (up to 'max_chunks' chunks), so that the framing of the received
+    data is preserved.  When a chunk does not fit, the overflow policy
+    determines what happens:
+
+        OVERFLOW_DROP_OLDEST: The oldest chunks are dropped to make room
+        OVERFLOW_DROP_NEWEST: The new chunk is dropped
+        OVERFLOW_BLOCK: put() waits until the consumer makes room
+
+    A single producer thread calls put(), and consumers call get() (one
+    chunk) or get_many() (all available chunks).  cancel() wakes a waiting
+    consumer, which receives no data.  Counters of the dropped chunks and
+    bytes and the high-water marks are available from get_stats().
+    """
+    def __init__(self, capacity=RING_CAPACITY_DEFAULT, max_chunks=RING_MAX_CHUNKS_DEFAULT, overflow=OVERFLOW_DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid overflow policy: {}'.format(overflow))
+        self.buf = bytearray(capacity)
+        # View used to copy chunks out without allocating a slice of the data
+        self.view = memoryview(self.buf)
+        self.capacity = capacity
+        self.max_chunks = max_chunks
+        self.overflow = overflow
+        self.cond = threading.Condition()
+        self.chunks = deque()
+        self.head = 0
+        self.size = 0
+        self.cancels = 0
+        self.closed = False
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+        self.blocked_count = 0
+        self.high_water_bytes = 0
+        self.high_water_chunks = 0
+
+    def _fits(self, n):
+        return self.size + n <= self.capacity and len(self.chunks) < self.max_chunks
+
+    def _drop_oldest(self):
+        n, rx_time = self.chunks.popleft()
+        self.head = (self.head + n) % self.capacity
+        self.size -= n
+        self.dropped_chunks += 1
+        self.dropped_bytes += n
+
+    def _write(self, data, n):
+        tail = (self.head + self.size) % self.capacity
+        first = min(n, self.capacity - tail)
+        data = memoryview(data)
+        self.view[tail:tail + first] = data[:first]
+        if first < n:
+            self.view[0:n - first] = data[first:n]
+        self.size += n
+
+    def _read(self, n):
+        end = self.head + n
+        if end <= self.capacity:
+            data = self.view[self.head:end].tobytes()
+        else:
+            data = self.view[self.head:].tobytes() + self.view[0:end - self.capacity].tobytes()
+        self.head = end % self.capacity
+        self.size -= n
+        return data
+
+    def put(self, data, rx_time, length=None):
+        """Add a received chunk.
+
+        Args:
+            data: The received bytes (any object supporting the buffer protocol)
+            rx_time: Receive time of the chunk
+            length: Number of bytes of 'data' to add (default is all)
+
+        Returns:
+            True if the chunk was stored, False if it was dropped.
+        """
+        n = len(data) if length is None else length
+        with self.cond:
+            if n > self.capacity or self.closed:
+                self.dropped_chunks += 1
+                self.dropped_bytes += n
+                return False
+            if not self._fits(n):
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    self.dropped_chunks += 1
+                    self.dropped_bytes += n
+                    return False
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    while not self._fits(n):
+                        self._drop_oldest()
+                else:
+                    self.blocked_count += 1
+                    while not self._fits(n) and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        self.dropped_chunks += 1
+                        self.dropped_bytes += n
+                        return False
+            self._write(data, n)
+            self.chunks.append((n, rx_time))
+            self.high_water_bytes = max(self.high_water_bytes, self.size)
+            self.high_water_chunks = max(self.high_water_chunks, len(self.chunks))
+            self.cond.notify_all()
+        return True
+
+    def _wait(self, timeout):
+        # Returns False if cancelled or timed out
+        deadline = monotonic() + timeout if timeout is not None else None
+        while not self.chunks and not self.cancels:
+            if deadline is None:
+                self.cond.wait()
+            else:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+        if self.cancels:
+            self.cancels -= 1
+            return False
+        return len(self.chunks) > 0
+
+    def get(self, timeout=None):
+        """Wait for and remove the oldest chunk.
+
+        Returns:
+            Tuple (data, rx_time), or (None, None) on timeout or cancel.
+        """
+        with self.cond:
+            if not self._wait(timeout):
+                return None, None
+            n, rx_time = self.chunks.popleft()
+            data = self._read(n)
+            self.cond.notify_all()
+        return data, rx_time
+
+    def get_into(self, buf, timeout=None):
+        """Wait for the oldest chunk, and copy it into 'buf' (a writable buffer).
+
+        If the chunk is longer than 'buf', the remainder is left to be
+        returned by the next call.  No objects are allocated for the data.
+
+        Returns:
+            Tuple (length, rx_time), or (0, None) on timeout or cancel.
+        """
+        with self.cond:
+            if not self._wait(timeout):
+                return 0, None
+            n, rx_time = self.chunks[0]
+            count = min(n, len(buf))
+            first = min(count, self.capacity - self.head)
+            buf[0:first] = self.view[self.head:self.head + first]
+            if first < count:
+                buf[first:count] = self.view[0:count - first]
+            self.head = (self.head + count) % self.capacity
+            self.size -= count
+            if count < n:
+                self.chunks[0] = (n - count, rx_time)
+            else:
+                self.chunks.popleft()
+            self.cond.notify_all()
+        return count, rx_time
+
+    def get_many(self, timeout=None, max_bytes=None):
+        """Wait for at least one chunk, and remove all available chunks.
+
+        Args:
+            timeout: Maximum time to wait for the first chunk (None waits forever)
+            max_bytes: Maximum total bytes to remove (at least one chunk is always removed)
+
+        Returns:
+            List of tuples (data, rx_time), oldest first; empty on timeout or cancel.
+        """
+        result = []
+        with self.cond:
+            if not self._wait(timeout):
+                return result
+            total = 0
+            while self.chunks:
+                n, rx_time = self.chunks[0]
+                if result and max_bytes is not None and total + n > max_bytes:
+                    break
+                self.chunks.popleft()
+                result.append((self._read(n), rx_time))
+                total += n
+            self.cond.notify_all()
+        return result
+
+    def cancel(self):
+        """Wake a waiting (or the next) consumer without data.
+        """
+        with self.cond:
+            self.cancels += 1
+            self.cond.notify_all()
+
+    def close(self):
+        """Stop accepting chunks (and release a producer blocked in put()).
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def clear(self):
+        """Remove all stored chunks.
+        """
+        with self.cond:
+            self.chunks.clear()
+            self.head = 0
+            self.size = 0
+            self.cond.notify_all()
+
+    def get_stats(self):
+        """Return the buffer statistics.
+
+        Returns:
+            A dictionary containing the 'overflow' policy, the 'capacity' in
+            bytes and 'max_chunks', the current 'bytes' and 'chunks' stored,
+            their high-water marks, the count of dropped chunks and bytes,
+            and the count of times put() blocked ('blocked').
+        """
+        with self.cond:
+            return {
+                'overflow' : self.overflow,
+                'capacity' : self.capacity,
+                'max_chunks' : self.max_chunks,
+                'bytes' : self.size,
+                'chunks' : len(self.chunks),
+                'high_water_bytes' : self.high_water_bytes,
+                'high_water_chunks' : self.high_water_chunks,
+                'dropped_chunks' : self.dropped_chunks,
+                'dropped_bytes' : self.dropped_bytes,
+                'blocked' : self.blocked_count
+            }
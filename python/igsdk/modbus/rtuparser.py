@@ -6,7 +6,9 @@ from .baseparser import ModbusBaseParser
 from .message import ModbusMessage
 import logging
 import time
-import struct
+import sys
+
+PYTHON3 = sys.version_info >= (3, 0)
 
 class ModbusRTUParser(ModbusBaseParser):
 
@@ -36,7 +38,7 @@ class ModbusRTUParser(ModbusBaseParser):
         msg = None
         rem = b
         if len(b) >= datalen + 4: # Must contain address, function, CRC16
-            msg = ModbusMessage(b[0], b[1], list(bytearray(b[2:2+datalen])), int(time.time() * 1000))
+            msg = ModbusMessage(b[0], b[1], list(b[2:2+datalen]), int(time.time() * 1000))
             msg_crc = b[datalen+2] + 256 * b[datalen+3]
             if msg_crc == msg.compute_crc():
                 rem = b[datalen+4:]
@@ -166,12 +168,27 @@ class ModbusRTUParser(ModbusBaseParser):
         input bytes contain one or more frames, and the end of the buffer is aligned with the end of a
         frame.  Input messages will be parsed until an unparseable RTU message is found, then all
         remaining bytes are discared and all parsed messages are returned.
+
+        The input can be a byte string, bytearray or memoryview; on Python 3 it is
+        parsed in place through a memoryview (without copying).
         """
         msgs = []
-        d = struct.unpack('{}B'.format(len(b)), b)
+        if PYTHON3:
+            d = memoryview(b)
+        else:
+            d = tuple(bytearray(b))
+        start = 0
         msg, rem = self._try_parse_unknown(d)
         while msg:
             msgs.append(msg)
             self.logger.debug('Parsed RTU frame: address={}, function={}, len={}'.format(msg.address, msg.function, len(msg.data) if msg.data else 0))
+            if self.frame_cb:
+                end = len(d) - len(rem)
+                self.frame_cb(b[start:end], msg)
+                start = end
             msg, rem = self._try_parse_unknown(rem)
+        if rem and len(rem) > 0:
+            self.check_errors += 1
+            if self.frame_cb:
+                self.frame_cb(b[start:], None)
         return msgs
@@ -9,16 +9,32 @@ import time
 import os
 import errno
 import termios
+import fcntl
+import struct
 import threading
 import logging
-from ..device import device_init, device_deinit, device_enabled, device_activity, set_serial_port_type, set_serial_termination
+from .stats import LatencyHistogram, monotonic
+from .realtime import set_thread_realtime
+from .utilization import UtilizationMeter, char_time
+from .ring_buffer import ChunkRing, OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK, RING_CAPACITY_DEFAULT
+from .device_hooks import default_device_hooks
 
-import sys
-PYTHON3 = sys.version_info >= (3, 0)
-if PYTHON3:
-    import queue as Queue
-else:
-    import Queue
+# os.readv() (Python 3.3+) reads directly into a buffer
+READV = hasattr(os, 'readv')
+
+# Linux ioctl to read the serial port interrupt counters (struct serial_icounter_struct)
+TIOCGICOUNT = getattr(termios, 'TIOCGICOUNT', 0x545D)
+SERIAL_ICOUNTER_STRUCT = struct.Struct('20i')
+SERIAL_ICOUNTER_FIELDS = ('cts', 'dsr', 'rng', 'dcd', 'rx', 'tx', 'frame', 'overrun', 'parity', 'brk', 'buf_overrun')
+
+# Linux ioctl to read the UART line status; TIOCSER_TEMT is set when the transmitter is empty
+TIOCSERGETLSR = getattr(termios, 'TIOCSERGETLSR', 0x5459)
+TIOCSER_TEMT = getattr(termios, 'TIOCSER_TEMT', 0x01)
+# Maximum time to wait for the UART transmit FIFO after tcdrain(), in characters
+TX_FIFO_MAX_CHARS = 256
+
+# pyserial 3.5 no longer exports portNotOpenError
+PORT_NOT_OPEN_ERROR = 'Attempting to use a port that is not open'
 
 class SerialTimeoutFix(Serial):
     """This class provides an improvement on the Serial class timeout logic.
@@ -39,7 +55,21 @@ class SerialTimeoutFix(Serial):
     initial select(), followed by the 'inter_char_timeout' (for all subsequent
     reads).  read() returns when either the buffer is filled or the initial or
     inter-byte timeout occurs.
+
+    The (monotonic) time at which the last bytes were read is stored in
+    'last_read_time', which approximates the end of a received frame.
+
+    readinto() provides the same behavior, reading directly into a buffer
+    supplied by the caller (so that a single buffer can be reused for all
+    reads, without allocating a new byte string for each).
+
+    If 'timeout_latency' is set to a LatencyHistogram, the lateness of each
+    timeout (the time select() returns after the timeout has expired, which
+    is mostly scheduling latency) is added to it; late timeouts delay the
+    end of a frame, and can merge frames.
     """
+    last_read_time = None
+    timeout_latency = None
 
     def _reconfigure_port(self, force_update=False):
         super(SerialTimeoutFix, self)._reconfigure_port(force_update)
@@ -49,19 +79,102 @@ class SerialTimeoutFix(Serial):
         cc[termios.VTIME] = 0
         termios.tcsetattr(self.fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])        
 
+    def get_icount(self):
+        """Read the kernel serial counters (TIOCGICOUNT).
+
+        Returns:
+            Dictionary of the counters (see SERIAL_ICOUNTER_FIELDS), including
+            the 'frame', 'parity', 'overrun' (UART FIFO) and 'buf_overrun' (TTY
+            buffer) error counts, or None if the port does not support them.
+        """
+        if not self.is_open:
+            return None
+        buf = bytearray(SERIAL_ICOUNTER_STRUCT.size)
+        try:
+            fcntl.ioctl(self.fd, TIOCGICOUNT, buf)
+        except (IOError, OSError):
+            return None
+        return dict(zip(SERIAL_ICOUNTER_FIELDS, SERIAL_ICOUNTER_STRUCT.unpack(bytes(buf))))
+
+    def tx_empty(self):
+        """Return True if the UART transmitter is empty (TIOCSERGETLSR), or None if not supported.
+        """
+        buf = bytearray(4)
+        try:
+            fcntl.ioctl(self.fd, TIOCSERGETLSR, buf)
+        except (IOError, OSError):
+            return None
+        return (struct.unpack('I', bytes(buf))[0] & TIOCSER_TEMT) != 0
+
+    def wait_tx_complete(self):
+        """Wait until all written bytes have left the wire, and return the (monotonic) time.
+
+        tcdrain() returns when the driver has passed all bytes to the UART,
+        but some may still be in the UART transmit FIFO; if the driver
+        reports the line status, it is polled (once per character time)
+        until the transmitter is empty.
+        """
+        if not self.is_open:
+            raise SerialException(PORT_NOT_OPEN_ERROR)
+        termios.tcdrain(self.fd)
+        t_char = char_time(self.baudrate, self.bytesize, self.parity, self.stopbits)
+        end = monotonic() + TX_FIFO_MAX_CHARS * t_char
+        while self.tx_empty() is False and monotonic() < end:
+            time.sleep(t_char)
+        return monotonic()
+
+    def readinto_available(self, b):
+        """\
+        Read the bytes that are immediately available (without waiting) into
+        the writable buffer 'b'.  Returns the number of bytes read (0 if none).
+        Used when the port is read by a reactor (see reactor.py), after it
+        was reported as readable.
+        """
+        try:
+            if READV:
+                n = os.readv(self.fd, [b])
+            else:
+                buf = os.read(self.fd, len(b))
+                n = len(buf)
+                b[:n] = buf
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return 0
+            raise SerialException('read failed: {}'.format(e))
+        if not n:
+            # See read(); readable but no data indicates a disconnected device
+            raise SerialException(
+                'device reports readiness to read but returned no data '
+                '(device disconnected or multiple access on port?)')
+        self.last_read_time = monotonic()
+        return n
+
     def read(self, size=1):
         """\
         Read size bytes from the serial port. If 'timeout' or 'inter_byte_timeout' is set it may
         return less characters as requested. With no timeout it will block
         until the requested number of bytes is read.
         """
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
+
+    def readinto(self, b):
+        """\
+        Read up to len(b) bytes from the serial port into the writable buffer 'b'
+        (e.g., a bytearray or memoryview), with the same timeout behavior as
+        read().  Returns the number of bytes read.
+        """
         if not self.is_open:
-            raise SerialException(portNotOpenError)
-        read = bytearray()
+            raise SerialException(PORT_NOT_OPEN_ERROR)
+        view = memoryview(b)
+        size = len(view)
+        count = 0
         timeout = self._timeout
-        while len(read) < size:
+        while count < size:
             try:
                 start_time = time.time()
+                select_time = monotonic()
                 ready, _, _ = select.select([self.fd, self.pipe_abort_read_r], [], [], timeout)
                 if self.pipe_abort_read_r in ready:
                     os.read(self.pipe_abort_read_r, 1000)
@@ -71,18 +184,26 @@ class SerialTimeoutFix(Serial):
                 # For timeout == 0 (non-blocking operation) also abort when
                 # there is nothing to read.
                 if not ready:
+                    if timeout and self.timeout_latency:
+                        self.timeout_latency.add(max(0, monotonic() - select_time - timeout))
                     break   # timeout
-                buf = os.read(self.fd, size - len(read))
+                if READV:
+                    n = os.readv(self.fd, [view[count:]])
+                else:
+                    buf = os.read(self.fd, size - count)
+                    n = len(buf)
+                    view[count:count + n] = buf
                 # read should always return some data as select reported it was
                 # ready to read when we get to this point.
-                if not buf:
+                if not n:
                     # Disconnected devices, at least on Linux, show the
                     # behavior that they are always ready to read immediately
                     # but reading returns nothing.
                     raise SerialException(
                         'device reports readiness to read but returned no data '
                         '(device disconnected or multiple access on port?)')
-                read.extend(buf)
+                count += n
+                self.last_read_time = monotonic()
             except OSError as e:
                 # this is for Python 3.x where select.error is a subclass of
                 # OSError ignore EAGAIN errors. all other errors are shown
@@ -101,7 +222,7 @@ class SerialTimeoutFix(Serial):
                 timeout -= time.time() - start_time
                 if timeout <= 0:
                     break
-        return bytes(read)
+        return count
         
 class SerialQueue(threading.Thread):
     """A serial queue that uses threads to manage serial data
@@ -109,23 +230,70 @@ class SerialQueue(threading.Thread):
     SerialQueue provides a high-level class that manages continuously
     reading data from a serial port in an IO-bound thread, while returning
     data to a calling thread.  The received data is framed by timeouts, and
-    stored as byte strings in a queue.
+    stored in a bounded ring buffer (see ring_buffer.ChunkRing), along with
+    the time at which the last byte was received.  The 'overflow' policy
+    determines whether the oldest or newest data is dropped when the buffer
+    is full, or the reader waits for the consumer.
+
+    The bytes received and sent are measured against the capacity of the
+    port (at its baud rate and framing) by a UtilizationMeter ('meter'),
+    which can be subscribed to for the utilization time series.  The kernel
+    serial error counters are sampled at the same interval, and data that
+    is dropped because the buffer is full is counted; see get_port_stats().
+
+    If a 'reactor' is specified (see reactor.py), no reader thread is used;
+    the port is read on the reactor thread when it is readable, and the
+    received data is framed by the inter-byte timeout using a reactor timer
+    (so 'inter_byte_timeout' cannot be None).
+    If 'chunk_cb' is set, each received chunk is passed to it on the reactor
+    thread, as chunk_cb(view, rx_time) (the memoryview is only valid during
+    the call), instead of being stored in the ring buffer; like any reactor
+    callback, it must not block (e.g., on serial writes, file writes or
+    publishing), so consumers that do should read the ring buffer on their
+    own thread instead.
+
+    If 'realtime' is specified (see realtime.RealtimeConfig), the reader
+    thread runs with real-time scheduling, and the driver low-latency mode
+    is requested; settings that cannot be applied are logged and skipped.
+    With a reactor, only the low-latency mode applies to the port (the
+    reactor thread has its own real-time settings).  The scheduling latency
+    of the inter-byte timeouts (or reactor timers) is measured in either
+    case, and reported by get_port_stats().
+
+    The port mode and the device LEDs are set through 'device_hooks' (see
+    device_hooks.py); by default, the Sentrius IG Device Service is used
+    if it is available (see set_default_device_hooks()).
     """
     DEFAULT_BREAK_DURATION = 0.25
 
-    def __init__(self, port, baudrate, serial_mode=0, serial_term=0, timeout=None, inter_byte_timeout=0.1, read_buf_size=1024, max_queue_size=256):
+    def __init__(self, port, baudrate, serial_mode=0, serial_term=0, timeout=None, inter_byte_timeout=0.1, read_buf_size=1024, max_queue_size=256,
+            queue_bytes=RING_CAPACITY_DEFAULT, overflow=OVERFLOW_DROP_OLDEST, reactor=None, realtime=None, device_hooks=None):
+        if reactor and overflow == OVERFLOW_BLOCK:
+            raise ValueError('The block overflow policy cannot be used with a reactor')
+        if reactor and inter_byte_timeout is None:
+            raise ValueError('An inter-byte timeout is required with a reactor')
         self.serial = SerialTimeoutFix(port=port, baudrate=baudrate, timeout=timeout, inter_byte_timeout=inter_byte_timeout)
-        self.queue = Queue.Queue(maxsize=max_queue_size)
+        self.queue = ChunkRing(queue_bytes, max_queue_size, overflow)
         self.read_buf_size = read_buf_size
+        # Buffers reused for every read (reader thread) and every message (consumer)
+        self.read_buf = bytearray(read_buf_size)
+        self.msg_buf = bytearray(read_buf_size)
+        self.msg_view = memoryview(self.msg_buf)
         self.logger = logging.getLogger(__name__)
+        self.port = port
         self.running = False
-        self.device = device_init()
-        device_enabled(self.device)
-        self.logger.info('Creating SerialQueue(): port={}, baudrate={}, serial_mode={}, timeout={}, inter_byte_timeout={}, bufsize={}, max_queue={}'.format(port, baudrate, serial_mode, timeout, inter_byte_timeout, read_buf_size, max_queue_size))
-        # Disable termination temporarily to prevent error on setting mode
-        set_serial_termination(self.device, 0)
-        set_serial_port_type(self.device, serial_mode)
-        set_serial_termination(self.device, serial_term)
+        self.uart_counters = None
+        self.reactor = reactor
+        self.realtime = realtime
+        self.realtime_result = None
+        self.serial.timeout_latency = LatencyHistogram()
+        self.chunk_cb = None
+        self.inter_byte_timeout = inter_byte_timeout
+        self.frame_len = 0
+        self.frame_timer = None
+        self.device = device_hooks if device_hooks is not None else default_device_hooks()
+        self.logger.info('Creating SerialQueue(): port={}, baudrate={}, serial_mode={}, timeout={}, inter_byte_timeout={}, bufsize={}, max_queue={}, queue_bytes={}, overflow={}'.format(port, baudrate, serial_mode, timeout, inter_byte_timeout, read_buf_size, max_queue_size, queue_bytes, overflow))
+        self.device.open(serial_mode, serial_term)
         if serial_mode == 0: # RS-232 (disable RS-485)
             self.serial.rs485_mode = None
         elif serial_mode == 1: # RS-485 Half Duplex (assert RTS on Tx only)
@@ -134,65 +302,212 @@ class SerialQueue(threading.Thread):
         elif serial_mode == 2: # RS-485 Full Duplex (assert RTS always)
             # Note - Bug in pySerial 3.1.0 -> set delays to '0' to avoid exception
             self.serial.rs485_mode = RS485Settings(rts_level_for_tx=True, rts_level_for_rx=True, delay_before_tx=0, delay_before_rx=0)
+        self.meter = UtilizationMeter(char_time(baudrate, self.serial.bytesize, self.serial.parity, self.serial.stopbits))
+        self.meter.subscribe(self.sample_uart_counters)
         threading.Thread.__init__(self)
 
     def run(self):
         """The method that is run in the thread context; here we collect serial data (separated by timeouts) and place them on the queue.
         """
+        if self.realtime:
+            self.realtime_result = set_thread_realtime(self.realtime)
+        view = memoryview(self.read_buf)
         while self.running:
-            b = self.serial.read(self.read_buf_size)
-            if b and len(b) > 0:
-                self.queue.put_nowait(b) # NOTE: Can raise Queue.Full
-                device_activity(self.device)
+            n = self.serial.readinto(view)
+            if n > 0:
+                self.meter.add_rx(n)
+                if not self.queue.put(view, self.serial.last_read_time, n) and self.running:
+                    self.logger.warning('Receive buffer full, data dropped.')
+                self.device.activity()
+
+    def on_readable(self):
+        """Read the available bytes (reactor thread), appending them to the current frame.
+        """
+        try:
+            n = self.serial.readinto_available(memoryview(self.read_buf)[self.frame_len:])
+        except SerialException as e:
+            self.logger.error('Serial port {} read failed: {}'.format(self.port, e))
+            self.reactor.remove_reader(self.serial.fd)
+            return
+        if n > 0:
+            self.frame_len += n
+            if self.frame_len >= self.read_buf_size:
+                self.end_frame()
+            elif self.frame_timer is None:
+                self.frame_timer = self.reactor.call_later(self.inter_byte_timeout, self.on_frame_timer)
+
+    def on_frame_timer(self):
+        """Inter-byte timer (reactor thread); ends the frame if no bytes were received within the timeout.
+        """
+        self.frame_timer = None
+        remaining = self.serial.last_read_time + self.inter_byte_timeout - monotonic()
+        if remaining > 0:
+            self.frame_timer = self.reactor.call_later(remaining, self.on_frame_timer)
+        else:
+            self.end_frame()
+
+    def end_frame(self):
+        if self.frame_timer:
+            self.frame_timer.cancel()
+            self.frame_timer = None
+        n = self.frame_len
+        self.frame_len = 0
+        if n == 0:
+            return
+        self.meter.add_rx(n)
+        if self.chunk_cb:
+            self.chunk_cb(memoryview(self.read_buf)[:n], self.serial.last_read_time)
+        elif not self.queue.put(self.read_buf, self.serial.last_read_time, n) and self.running:
+            self.logger.warning('Receive buffer full, data dropped.')
+        self.device.activity()
+
+    def sample_uart_counters(self, sample=None):
+        """Sample the kernel serial counters (called at each utilization interval).
+        """
+        counters = self.serial.get_icount()
+        if counters and self.uart_counters:
+            overruns = (counters['overrun'] - self.uart_counters['overrun']) + (counters['buf_overrun'] - self.uart_counters['buf_overrun'])
+            if overruns > 0:
+                self.logger.warning('Serial port {} overrun: {} new overrun(s).'.format(self.port, overruns))
+        self.uart_counters = counters
+
+    def get_port_stats(self):
+        """Return the error statistics for the port.
+
+        Returns:
+            Dictionary containing the 'port', the most recent sample of the
+            kernel serial counters ('uart', see SerialTimeoutFix.get_icount();
+            None if not supported), the count of received chunks dropped
+            because the buffer was full ('queue_drops'), the receive
+            buffer statistics ('queue', see ChunkRing.get_stats()), the
+            scheduling latency of the inter-byte timeouts ('sched_latency',
+            see LatencyHistogram.summary()), and the real-time settings
+            applied ('realtime', see realtime.set_thread_realtime(); None
+            if not enabled), and the device LED signalling statistics
+            ('led', see DeviceHooks.get_stats()).
+        """
+        queue_stats = self.queue.get_stats()
+        latency = self.reactor.timer_latency if self.reactor else self.serial.timeout_latency
+        return { 'port' : self.port, 'uart' : self.uart_counters, 'queue_drops' : queue_stats['dropped_chunks'], 'queue' : queue_stats,
+            'sched_latency' : latency.summary(), 'realtime' : self.reactor.realtime_result if self.reactor else self.realtime_result,
+            'led' : self.device.get_stats() }
 
     def receive_start(self):
         """Start receiving data packets.
         """
-        self.logger.info('Starting serial queue thread.')
         self.running = True
-        self.start()
+        if self.realtime and self.realtime.low_latency:
+            self.set_low_latency()
+        self.meter.meter_start(self.reactor)
+        if self.reactor:
+            self.logger.info('Starting serial queue on reactor.')
+            self.reactor.add_reader(self.serial.fd, self.on_readable)
+        else:
+            self.logger.info('Starting serial queue thread.')
+            self.start()
         
+    def set_low_latency(self):
+        """Request the driver low-latency mode (ASYNC_LOW_LATENCY) for the port.
+        """
+        try:
+            self.serial.set_low_latency_mode(True)
+            return True
+        except (AttributeError, NotImplementedError, ValueError, IOError, OSError) as e:
+            self.logger.warning('Cannot set low-latency mode on {}: {}'.format(self.port, e))
+            return False
+
     def receive_stop(self):
         """Stop receiving data packets.
         """
         self.logger.info('Stopping serial queue thread.')
         self.running = False
-        self.serial.cancel_read()
-        self.queue.put_nowait(None)
-        device_deinit(self.device)
+        self.meter.meter_stop()
+        if self.reactor:
+            self.reactor.remove_reader(self.serial.fd)
+            if self.frame_timer:
+                self.frame_timer.cancel()
+        else:
+            self.serial.cancel_read()
+        self.queue.close()
+        self.queue.cancel()
+        self.device.close()
         
     def await_msg(self, timeout=None):
         """Await a single message on the queue.
         """
-        msg = None
-        try:
-            self.logger.debug('Awaiting message...')
-            msg = self.queue.get(True, timeout)
-            if msg:
-                self.logger.debug('Returning message from queue.')
-            else:
-                self.logger.debug('Queue receive stopped.')
-        except Queue.Empty:
-            self.logger.debug('Queue is empty.')
+        msg, rx_time = self.await_msg_timed(timeout)
         return msg
 
+    def await_msg_timed(self, timeout=None):
+        """Await a single message on the queue, with its receive time.
+
+        Returns:
+            Tuple: (msg, rx_time):
+                msg: The received bytes, or None
+                rx_time: Monotonic time (see stats.monotonic) at which the last
+                    byte of the message was received, or None
+        """
+        self.logger.debug('Awaiting message...')
+        msg, rx_time = self.queue.get(timeout)
+        if msg is None:
+            self.logger.debug('Queue is empty.')
+        return msg, rx_time
+
+    def await_msg_view(self, timeout=None):
+        """Await a single message on the queue, without allocating a copy.
+
+        The message is copied into a buffer owned by the queue, which is
+        reused by the next call; the returned view is only valid until
+        then, and await_msg_view() must only be called from one thread.
+        Messages longer than 'read_buf_size' are returned in pieces.
+
+        Returns:
+            Tuple: (view, rx_time):
+                view: memoryview of the received bytes, or None
+                rx_time: see await_msg_timed()
+        """
+        n, rx_time = self.queue.get_into(self.msg_view, timeout)
+        if not n:
+            self.logger.debug('Queue is empty.')
+            return None, None
+        return self.msg_view[:n], rx_time
+
+    def await_msgs_timed(self, timeout=None, max_bytes=None):
+        """Await received data, returning all messages available on the queue.
+
+        Returns:
+            List of tuples (msg, rx_time) (see await_msg_timed()), oldest
+            first; the list is empty on timeout or cancel.
+        """
+        return self.queue.get_many(timeout, max_bytes)
+
+    def inject_msg(self, msg, rx_time=None):
+        """Place bytes on the queue as if they were received (e.g., to replay traffic).
+        """
+        self.queue.put(msg, rx_time if rx_time is not None else monotonic())
+
     def await_cancel(self):
-        self.queue.put_nowait(None)
+        self.queue.cancel()
 
     def send_msg(self, msg):
         """Send a message on the serial port.
         """
         self.serial.write(msg)
+        self.meter.add_tx(len(msg))
+
+    def send_drain(self):
+        """Wait until all sent bytes have been transmitted (see SerialTimeoutFix.wait_tx_complete()).
+
+        Returns:
+            The (monotonic) time at which the transmission completed.
+        """
+        return self.serial.wait_tx_complete()
 
     def receive_flush(self):
         """Flush all queued messages and input byte buffer.
         """
         self.serial.reset_input_buffer()
-        try:
-            while True:
-                self.queue.get(False)
-        except Queue.Empty:
-            pass
+        self.queue.clear()
 
     def send_break(self, duration = DEFAULT_BREAK_DURATION):
         self.serial.send_break(duration)
\ No newline at end of file
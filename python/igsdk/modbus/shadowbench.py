@@ -0,0 +1,124 @@
+#
+# shadowbench.py
+#
+# Benchmark of the time the shadow lock of the Modbus Slave Lambda is held
+# for each shadow update document, with the full copy of the state (as
+# before the incremental merge: copy.deepcopy() of the current state with
+# the lock held) versus the delta merge (the delta from the previous
+# document is computed before taking the lock, and only the changed
+# elements are merged into a new snapshot with the lock held; see
+# ModbusSlaveLambda.update_shadow()).
+#
+# Run as: python -m igsdk.modbus.shadowbench [--entries N] [--changes N] [--updates N]
+#
+
+from igsdk.modbus.state_util import merge_state, diff_state
+from igsdk.modbus.stats import LatencyHistogram, monotonic
+import argparse
+import copy
+import threading
+
+REGS_PER_ENTRY = 4
+
+def make_state(entries):
+    """Return a shadow state with 'entries' register map entries, split between the sections"""
+    def section(start, count):
+        return dict(('{:x}'.format((start + i) * REGS_PER_ENTRY), [i & 0xffff] * REGS_PER_ENTRY) for i in range(count))
+    n = entries // 4
+    return {
+        'desired' : {
+            'coil' : section(0, n),
+            'discrete' : section(0, n),
+            'holding' : section(0, n),
+            'input' : section(0, entries - 3 * n)
+        },
+        'reported' : {
+            'holding' : section(0, n)
+        }
+    }
+
+def make_documents(state, updates, changes):
+    """Return 'updates' shadow update documents, each changing 'changes' holding register entries"""
+    docs = []
+    keys = sorted(state['desired']['holding'])
+    for u in range(updates):
+        new_state = copy.deepcopy(state)
+        for c in range(changes):
+            key = keys[(u * changes + c) % len(keys)]
+            new_state['desired']['holding'][key] = [u & 0xffff] * REGS_PER_ENTRY
+        docs.append({ 'previous' : { 'state' : state, 'version' : u + 1 },
+            'current' : { 'state' : new_state, 'version' : u + 2 } })
+        state = new_state
+    return docs
+
+class FullCopyShadow:
+    """Shadow update as before the incremental merge"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shadow = None
+
+    def update(self, doc, hist):
+        self.lock.acquire()
+        t = monotonic()
+        self.shadow = copy.deepcopy(doc['current']['state'])
+        hist.add(monotonic() - t)
+        self.lock.release()
+
+class DeltaShadow:
+    """Shadow update with the delta merge (as ModbusSlaveLambda.update_shadow())"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shadow = None
+        self.version = None
+
+    def update(self, doc, hist):
+        previous = doc['previous']
+        current = doc['current']
+        delta = diff_state(previous['state'], current['state'])
+        self.lock.acquire()
+        t = monotonic()
+        if self.shadow is not None and previous['version'] == self.version:
+            if delta:
+                self.shadow = merge_state(self.shadow, delta)
+        else:
+            self.shadow = current['state']
+        self.version = current['version']
+        hist.add(monotonic() - t)
+        self.lock.release()
+
+def run(shadow, initial, docs):
+    """Apply the documents, returning the lock hold time histogram and the total time per update"""
+    hist = LatencyHistogram()
+    shadow.shadow = copy.deepcopy(initial)
+    if hasattr(shadow, 'version'):
+        shadow.version = docs[0]['previous']['version']
+    t = monotonic()
+    for doc in docs:
+        shadow.update(doc, hist)
+    return hist, (monotonic() - t) / len(docs)
+
+def ms(v):
+    return '{:9.3f}'.format(v * 1000) if v is not None else '        -'
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=5000, help='Register map entries in the shadow state')
+    parser.add_argument('--changes', type=int, default=4, help='Entries changed by each update')
+    parser.add_argument('--updates', type=int, default=200, help='Update documents applied per mode')
+    args = parser.parse_args()
+    initial = make_state(args.entries)
+    docs = make_documents(initial, args.updates, args.changes)
+    results = []
+    for name, shadow in (('full copy', FullCopyShadow()), ('delta merge', DeltaShadow())):
+        hist, per_update = run(shadow, initial, docs)
+        results.append((name, hist.summary(), per_update, shadow.shadow))
+    if results[0][3] != results[1][3]:
+        print('...Final shadow states differ')
+    print('Shadow updates: {} entries, {} changed per update, {} updates'.format(args.entries, args.changes, args.updates))
+    print('               ---------- lock held (ms) ----------     update')
+    print('  mode              p50       p99       max      mean       (ms)')
+    for name, s, per_update, state in results:
+        print('  {:12s} {} {} {} {}  {}'.format(name, ms(s['p50']), ms(s['p99']), ms(s['max']), ms(s['mean']), ms(per_update)))
+
+if __name__ == "__main__":
+    main()
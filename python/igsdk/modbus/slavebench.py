@@ -0,0 +1,131 @@
+#
+# slavebench.py
+#
+# Benchmark of Modbus slave request-to-response turnaround, using
+# a pseudo-terminal pair in place of the serial port.
+#
+# Run as: python -m igsdk.modbus.slavebench [--count N] [--baudrates 9600,19200,115200]
+#
+
+from igsdk.modbus.modbus_slave import ModbusSlave
+from igsdk.modbus.message import ModbusMessage
+from igsdk.modbus.rtuparser import ModbusRTUParser
+from igsdk.modbus.state_util import merge_state
+from igsdk.modbus.stats import LatencyHistogram, monotonic
+import argparse
+import os
+import select
+import time
+import tty
+
+SLAVE_ADDR = 1
+NUM_REGS = 64
+
+bench_state = {
+    'desired' : {
+        'coil' : { '0' : [0, 1] * (NUM_REGS // 2) },
+        'discrete' : { '0' : [1, 0] * (NUM_REGS // 2) },
+        'holding' : { '0' : list(range(NUM_REGS)) },
+        'input' : { '0' : list(range(NUM_REGS, 2 * NUM_REGS)) }
+    },
+    'reported' : {
+        'coil' : { '0' : [0] * NUM_REGS },
+        'holding' : { '0' : [0] * NUM_REGS }
+    }
+}
+
+# Requests for each benchmarked function code (addresses/lengths within the state above)
+bench_requests = [
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_READ_COILS, [0, 0, 0, 16]),
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_READ_DISCRETE_INPUTS, [0, 0, 0, 16]),
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS, [0, 0, 0, 32]),
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_READ_INPUT_REGISTERS, [0, 0, 0, 32]),
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_WRITE_SINGLE_COIL, [0, 3, 0xFF, 0]),
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_WRITE_SINGLE_REGISTER, [0, 3, 0x12, 0x34]),
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_WRITE_MULTIPLE_COILS, [0, 0, 0, 8, 1, 0x55]),
+    ModbusMessage(SLAVE_ADDR, ModbusMessage.FUNCTION_WRITE_MULTIPLE_REGISTERS, [0, 0, 0, 2, 4, 0, 1, 0, 2])
+]
+
+def get_read_cb():
+    return bench_state['desired']
+
+def get_write_cb():
+    return bench_state['reported']
+
+def set_write_cb(delta):
+    bench_state['reported'] = merge_state(bench_state['reported'], delta)
+
+def char_time(baudrate):
+    """Time to transmit a single character (8N1 framing)"""
+    return 10.0 / baudrate
+
+def send_paced(fd, frame, baudrate):
+    """Write a frame, paced at the baud rate (the pseudo-terminal does not limit the rate)"""
+    for b in bytearray(frame):
+        os.write(fd, bytearray([b]))
+        time.sleep(char_time(baudrate))
+
+def await_resp(fd, parser, timeout):
+    """Read until a complete response frame is parsed, returning the time it was completed"""
+    buf = b''
+    end = monotonic() + timeout
+    while monotonic() < end:
+        ready, _, _ = select.select([fd], [], [], max(0, end - monotonic()))
+        if ready:
+            buf += os.read(fd, 1024)
+            t = monotonic()
+            if parser.msgs_from_bytes(buf):
+                return t
+    return None
+
+def run_baudrate(baudrate, count, timeout):
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    slave = ModbusSlave(os.ttyname(slave_fd), baudrate, 1, 0, 0, SLAVE_ADDR, get_read_cb, get_write_cb, set_write_cb)
+    slave.slave_start()
+    parser = ModbusRTUParser()
+    hists = {}
+    try:
+        for req in bench_requests:
+            h = LatencyHistogram()
+            frame = req.rtu_frame()
+            for i in range(count):
+                send_paced(master_fd, frame, baudrate)
+                t_req = monotonic()
+                t_resp = await_resp(master_fd, parser, timeout)
+                if t_resp is None:
+                    print('...Timeout awaiting response to function {}'.format(req.function))
+                else:
+                    h.add(t_resp - t_req)
+                # Inter-frame delay before the next request
+                time.sleep(3.5 * char_time(baudrate))
+            hists[req.function] = h
+    finally:
+        slave.slave_stop()
+        os.close(master_fd)
+        os.close(slave_fd)
+    return hists, slave.get_stats()
+
+def ms(v):
+    return '{:9.3f}'.format(v * 1000) if v is not None else '        -'
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200, help='Requests per function code')
+    parser.add_argument('--baudrates', default='9600,19200,115200', help='Comma-separated baud rates')
+    parser.add_argument('--timeout', type=float, default=2, help='Response timeout (seconds)')
+    args = parser.parse_args()
+    for baudrate in [int(b) for b in args.baudrates.split(',')]:
+        print('Running slave benchmark @ {}, count={}'.format(baudrate, args.count))
+        hists, slave_stats = run_baudrate(baudrate, args.count, args.timeout)
+        print('  function  phase          p50 (ms)  p99 (ms) p999 (ms)')
+        for function in sorted(hists):
+            s = hists[function].summary()
+            print('  {:8d}  {:10s} {} {} {}'.format(function, 'observed', ms(s['p50']), ms(s['p99']), ms(s['p999'])))
+            for phase in ModbusSlave.STATS_PHASES:
+                s = slave_stats.get(function, {}).get(phase)
+                if s:
+                    print('  {:8s}  {:10s} {} {} {}'.format('', phase, ms(s['p50']), ms(s['p99']), ms(s['p999'])))
+
+if __name__ == "__main__":
+    main()
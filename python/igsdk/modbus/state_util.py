@@ -199,3 +199,67 @@ def write_bits(state, addr, new_data, nbits):
             curbit = curbit + 1
         delta = {addr: new_el}
         return delta
+
+def merge_state(state, delta):
+    """Merge a delta into the state, returning a new state
+
+    Args:
+
+        state: The top-level state variable (not modified)
+        delta: Dictionary containing only the changed elements; a value
+               of None removes the element (as in a device shadow update)
+
+    A JSON null value is always treated as a removal, as in a device
+    shadow (where null deletes an element, so a shadow document never
+    contains null values); states with null values should not be merged.
+
+    Returns:
+
+        A new top-level state.  Only the dictionaries along the path of
+        each changed element are copied; all unchanged elements are shared
+        with the original state, so the original state can continue to be
+        read safely (by another thread) while the merge is performed.
+    """
+    new_state = dict(state) if state else {}
+    for k, v in delta.items():
+        if v is None:
+            new_state.pop(k, None)
+        elif isinstance(v, dict):
+            old_v = new_state.get(k)
+            new_state[k] = merge_state(old_v if isinstance(old_v, dict) else None, v)
+        else:
+            new_state[k] = v
+    return new_state
+
+def diff_state(old, new):
+    """Compute the delta between two states
+
+    Args:
+
+        old: The previous top-level state variable
+        new: The current top-level state variable
+
+    Returns:
+
+        A dictionary containing only the elements that differ between
+        the states (removed elements have a value of None), such that
+        merge_state(old, diff_state(old, new)) is equivalent to new.
+
+    As in merge_state(), None means a removal: an element of 'new' with a
+    value of None is removed by the delta (device shadow documents do not
+    contain null values).
+    """
+    delta = {}
+    old = old or {}
+    for k, v in new.items():
+        old_v = old.get(k)
+        if isinstance(v, dict) and isinstance(old_v, dict):
+            sub_delta = diff_state(old_v, v)
+            if sub_delta:
+                delta[k] = sub_delta
+        elif v != old_v or k not in old:
+            delta[k] = v
+    for k in old:
+        if k not in new:
+            delta[k] = None
+    return delta
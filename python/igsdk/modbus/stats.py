@@ -0,0 +1,102 @@
+#
+# stats.py
+#
+# Fixed-memory statistics used to instrument the Modbus modules
+#
+
+import math
+import time
+
+# Monotonic clock for measuring intervals (falls back to wall clock on Python 2)
+monotonic = getattr(time, 'monotonic', time.time)
+
+class LatencyHistogram:
+    """Histogram of time intervals, using fixed memory.
+
+    Intervals are counted in logarithmically-spaced buckets (by default,
+    8 buckets per doubling, from 1 microsecond to approximately 70 seconds),
+    so that percentiles can be computed with a bounded relative error
+    (approximately 9%) regardless of the number of samples.
+
+    A histogram is designed to be updated by a single thread; it can be
+    read from other threads (the results may be off by the samples that
+    are added while reading).
+    """
+    DEFAULT_MIN = 0.000001
+    DEFAULT_BUCKETS_PER_DOUBLING = 8
+    DEFAULT_NUM_BUCKETS = 208
+
+    def __init__(self, min_value=DEFAULT_MIN, buckets_per_doubling=DEFAULT_BUCKETS_PER_DOUBLING, num_buckets=DEFAULT_NUM_BUCKETS):
+        """Construct a LatencyHistogram.
+
+        Args:
+            min_value: Upper bound of the first bucket (in seconds)
+            buckets_per_doubling: Resolution of the buckets
+            num_buckets: Number of buckets (values above the last bucket are counted in it)
+        """
+        self.min_value = min_value
+        self.scale = buckets_per_doubling / math.log(2)
+        self.ratio = 2 ** (1.0 / buckets_per_doubling)
+        self.buckets = [0] * num_buckets
+        self.reset()
+
+    def reset(self):
+        """Clear all samples.
+        """
+        for i in range(len(self.buckets)):
+            self.buckets[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """Add a single sample (in seconds).
+        """
+        if value <= self.min_value:
+            i = 0
+        else:
+            i = min(int(math.ceil(math.log(value / self.min_value) * self.scale)), len(self.buckets) - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return the value at a given percentile (0-100), or None if there are no samples.
+
+        The value returned is the upper bound of the bucket containing the
+        percentile, limited to the maximum sample.
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= rank:
+                return min(self.min_value * (self.ratio ** i), self.max)
+        return self.max
+
+    def mean(self):
+        """Return the mean of all samples, or None if there are no samples.
+        """
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def summary(self):
+        """Return a summary of the histogram as a dictionary (values in seconds).
+        """
+        return {
+            'count' : self.count,
+            'min' : self.min,
+            'max' : self.max,
+            'mean' : self.mean(),
+            'p50' : self.percentile(50),
+            'p99' : self.percentile(99),
+            'p999' : self.percentile(99.9)
+        }
@@ -0,0 +1,263 @@
+#
+# trace_decoder.py
+#
+# Pairs traced Modbus requests with their responses, and decodes them
+# into a live image of the slave registers seen on the bus
+#
+
+from .message import ModbusMessage
+from .trace_filter import msg_direction, DIRECTION_REQUEST, DIRECTION_RESPONSE
+from .stats import monotonic
+import threading
+import logging
+
+TABLE_COIL = 'coil'
+TABLE_DISCRETE = 'discrete'
+TABLE_HOLDING = 'holding'
+TABLE_INPUT = 'input'
+
+PAIR_TIMEOUT_DEFAULT = 1.0
+
+class TracePair:
+    """Class representing a request paired with its response.
+    """
+    def __init__(self, req, req_time, resp, resp_time):
+        self.req = req
+        self.req_time = req_time
+        self.resp = resp
+        self.resp_time = resp_time
+
+    def latency(self):
+        """Return the time from the end of the request to the end of the response.
+        """
+        return self.resp_time - self.req_time
+
+class TracePairer:
+    """Pairs requests with responses.
+
+    A message is considered the response to the outstanding request for
+    the same slave address if it has the same function code (or the
+    exception function code), and it cannot only be a request.  Requests
+    that are not answered within the timeout (or are followed by another
+    request to the same slave) are reported as unanswered.
+    """
+    def __init__(self, timeout=PAIR_TIMEOUT_DEFAULT, unanswered_cb=None):
+        self.timeout = timeout
+        self.unanswered_cb = unanswered_cb
+        self.pending = {}
+
+    def add(self, msg, t):
+        """Add a message, returning a TracePair if it is the response to a pending request.
+
+        Args:
+            msg: ModbusMessage instance
+            t: Monotonic time of the end of the message
+        """
+        pending = self.pending.pop(msg.address, None)
+        if pending and t - pending[1] > self.timeout:
+            self._unanswered(pending)
+            pending = None
+        direction = msg_direction(msg)
+        if pending and direction != DIRECTION_REQUEST and (msg.function & 0x7F) == pending[0].function:
+            return TracePair(pending[0], pending[1], msg, t)
+        if pending:
+            self._unanswered(pending)
+        if direction != DIRECTION_RESPONSE:
+            self.pending[msg.address] = (msg, t)
+        return None
+
+    def expire(self, t):
+        """Report all pending requests that have exceeded the timeout at time t as unanswered.
+        """
+        for address, pending in list(self.pending.items()):
+            if t - pending[1] > self.timeout:
+                del self.pending[address]
+                self._unanswered(pending)
+
+    def _unanswered(self, pending):
+        if self.unanswered_cb:
+            self.unanswered_cb(pending[0], pending[1])
+
+def _unpack_bits(data, count):
+    return [(data[i // 8] >> (i % 8)) & 0x01 for i in range(min(count, 8 * len(data)))]
+
+def _unpack_registers(data, count):
+    return [data[2 * i] * 256 + data[2 * i + 1] for i in range(min(count, len(data) // 2))]
+
+def decode_pair(pair, image=None):
+    """Decode a request/response pair into register values.
+
+    Args:
+        pair: TracePair instance
+        image: RegisterImage (used to obtain the current value for mask write)
+
+    Returns:
+        List of tuples (table, address, values) for each block of
+        consecutive values confirmed by the pair; exception responses
+        and unsupported functions return an empty list.
+    """
+    req = pair.req
+    resp = pair.resp
+    if resp.function & 0x80 or len(req.data) < 4:
+        return []
+    d = req.data
+    addr = d[0] * 256 + d[1]
+    qty = d[2] * 256 + d[3]
+    f = req.function
+    if f in (ModbusMessage.FUNCTION_READ_COILS, ModbusMessage.FUNCTION_READ_DISCRETE_INPUTS):
+        table = TABLE_COIL if f == ModbusMessage.FUNCTION_READ_COILS else TABLE_DISCRETE
+        return [(table, addr, _unpack_bits(resp.data[1:], qty))]
+    if f in (ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS, ModbusMessage.FUNCTION_READ_INPUT_REGISTERS):
+        table = TABLE_HOLDING if f == ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS else TABLE_INPUT
+        return [(table, addr, _unpack_registers(resp.data[1:], qty))]
+    if f == ModbusMessage.FUNCTION_WRITE_SINGLE_COIL:
+        return [(TABLE_COIL, addr, [1 if d[2] else 0])]
+    if f == ModbusMessage.FUNCTION_WRITE_SINGLE_REGISTER:
+        return [(TABLE_HOLDING, addr, [qty])]
+    if f == ModbusMessage.FUNCTION_WRITE_MULTIPLE_COILS and len(d) > 5:
+        return [(TABLE_COIL, addr, _unpack_bits(d[5:], qty))]
+    if f == ModbusMessage.FUNCTION_WRITE_MULTIPLE_REGISTERS and len(d) > 5:
+        return [(TABLE_HOLDING, addr, _unpack_registers(d[5:], qty))]
+    if f == ModbusMessage.FUNCTION_MASK_WRITE_REGISTER and len(d) >= 6 and image:
+        cur = image.get(req.address, TABLE_HOLDING, addr)
+        if cur is not None:
+            and_mask = d[2] * 256 + d[3]
+            or_mask = d[4] * 256 + d[5]
+            return [(TABLE_HOLDING, addr, [(cur & and_mask) | (or_mask & ~and_mask)])]
+    return []
+
+class RegisterImage:
+    """Live image of the register values seen on the bus.
+
+    Values are keyed by (slave, table, address).  When a value is updated,
+    a change is reported only if it differs from the last reported value
+    by more than the deadband for that register (the default deadband of
+    0 reports every change).
+    """
+    def __init__(self, default_deadband=0):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.reported = {}
+        self.default_deadband = default_deadband
+        self.deadbands = []
+        self.deadband_cache = {}
+
+    def set_deadband(self, table, first, last, deadband, slave=None):
+        """Set the deadband for a range of addresses (inclusive) in a table, optionally for a single slave.
+
+        Later settings take precedence over earlier ones.
+        """
+        with self.lock:
+            self.deadbands.insert(0, (slave, table, first, last, deadband))
+            self.deadband_cache = {}
+
+    def get_deadband(self, key):
+        deadband = self.deadband_cache.get(key)
+        if deadband is None:
+            deadband = self.default_deadband
+            slave, table, address = key
+            for (d_slave, d_table, first, last, d) in self.deadbands:
+                if (d_slave is None or d_slave == slave) and d_table == table and first <= address <= last:
+                    deadband = d
+                    break
+            self.deadband_cache[key] = deadband
+        return deadband
+
+    def get(self, slave, table, address):
+        """Return the current value of a register, or None if it has not been seen.
+        """
+        return self.values.get((slave, table, address))
+
+    def update(self, slave, table, address, values):
+        """Update a block of consecutive values.
+
+        Returns:
+            List of changes to report, as dictionaries containing the
+            'slave', 'table', 'address', 'value' and 'previous' (last
+            reported value, or None) elements.
+        """
+        changes = []
+        with self.lock:
+            for i, v in enumerate(values):
+                key = (slave, table, address + i)
+                self.values[key] = v
+                prev = self.reported.get(key)
+                if prev is None or abs(v - prev) > self.get_deadband(key):
+                    self.reported[key] = v
+                    changes.append({ 'slave' : slave, 'table' : table, 'address' : address + i, 'value' : v, 'previous' : prev })
+        return changes
+
+    def snapshot(self):
+        """Return the image as nested dictionaries: { slave : { table : { address : value } } }
+        """
+        result = {}
+        with self.lock:
+            for (slave, table, address), v in self.values.items():
+                result.setdefault(slave, {}).setdefault(table, {})[address] = v
+        return result
+
+class TraceDecoder:
+    """Decodes traced messages into register value changes.
+
+    Messages are paired (see TracePairer), decoded (see decode_pair()), and
+    applied to a RegisterImage; changes are passed to 'change_cb' as a list
+    (see RegisterImage.update()), and each pair is passed to 'pair_cb' (if
+    specified).  If 'stats' is specified (see bus_stats.BusStats), all
+    frames, pairs, unanswered requests and check errors are counted.
+    If 'decode' is False, messages are only paired (for statistics).
+
+    Requests are only reported as unanswered when a later message is
+    added, or when expire() is called; the trace calls expire() after
+    each received chunk and when idle, and it should also be called
+    before the statistics are read.
+    """
+    def __init__(self, change_cb=None, pair_cb=None, image=None, timeout=PAIR_TIMEOUT_DEFAULT, unanswered_cb=None, stats=None, decode=True):
+        self.logger = logging.getLogger(__name__)
+        self.change_cb = change_cb
+        self.pair_cb = pair_cb
+        self.unanswered_cb = unanswered_cb
+        self.stats = stats
+        self.decode = decode
+        self.image = image or RegisterImage()
+        self.pairer = TracePairer(timeout, self._unanswered)
+        self.pair_lock = threading.Lock()
+
+    def _unanswered(self, req, t):
+        if self.stats:
+            self.stats.add_unanswered(req, t)
+        if self.unanswered_cb:
+            self.unanswered_cb(req, t)
+
+    def expire(self, t=None):
+        """Report the pending requests that are not answered within the timeout at (monotonic) time t (default: now).
+        """
+        with self.pair_lock:
+            self.pairer.expire(t if t is not None else monotonic())
+
+    def add_check_errors(self, count, nbytes=0):
+        """Count frames that failed the CRC/LRC check.
+        """
+        if self.stats:
+            self.stats.add_check_errors(count, nbytes)
+
+    def add(self, msg, t, nbytes=0):
+        """Add a traced message, with the (monotonic) time of the end of the message and its frame length.
+        """
+        if self.stats:
+            self.stats.add_frame(nbytes)
+        with self.pair_lock:
+            pair = self.pairer.add(msg, t)
+        if pair is None:
+            return
+        if self.stats:
+            self.stats.add_pair(pair)
+        if self.pair_cb:
+            self.pair_cb(pair)
+        if not self.decode:
+            return
+        changes = []
+        for table, address, values in decode_pair(pair, self.image):
+            changes.extend(self.image.update(pair.req.address, table, address, values))
+        if changes and self.change_cb:
+            self.logger.debug('Register changes: {}'.format(len(changes)))
+            self.change_cb(changes)
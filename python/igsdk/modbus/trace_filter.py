@@ -0,0 +1,152 @@
+#
+# trace_filter.py
+#
+# Declarative filter for Modbus trace messages
+#
+
+from .message import ModbusMessage
+import bisect
+
+DIRECTION_REQUEST = 'request'
+DIRECTION_RESPONSE = 'response'
+
+# Functions where the request (and write response) contain address and quantity
+_ADDR_QTY_FUNCTIONS = (
+    ModbusMessage.FUNCTION_READ_COILS,
+    ModbusMessage.FUNCTION_READ_DISCRETE_INPUTS,
+    ModbusMessage.FUNCTION_READ_HOLDING_REGISTERS,
+    ModbusMessage.FUNCTION_READ_INPUT_REGISTERS,
+    ModbusMessage.FUNCTION_WRITE_MULTIPLE_COILS,
+    ModbusMessage.FUNCTION_WRITE_MULTIPLE_REGISTERS
+)
+
+# Functions where the request (and response) contain a single address
+_ADDR_SINGLE_FUNCTIONS = (
+    ModbusMessage.FUNCTION_WRITE_SINGLE_COIL,
+    ModbusMessage.FUNCTION_WRITE_SINGLE_REGISTER,
+    ModbusMessage.FUNCTION_MASK_WRITE_REGISTER
+)
+
+_READ_FUNCTIONS = _ADDR_QTY_FUNCTIONS[:4]
+_READ_BIT_FUNCTIONS = _ADDR_QTY_FUNCTIONS[:2]
+
+def msg_direction(msg):
+    """Determine whether a message is a request or a response, from its content.
+
+    Returns:
+        DIRECTION_REQUEST, DIRECTION_RESPONSE, or None if the message could be
+        either (e.g., write single register, where the response echoes the request).
+    """
+    if msg.function & 0x80:
+        return DIRECTION_RESPONSE
+    n = len(msg.data)
+    if msg.function in _READ_FUNCTIONS:
+        if n == 4:
+            # A coil/input response with a byte count of 3 has the same length
+            # as a request; register responses always have an even byte count
+            if msg.function in _READ_BIT_FUNCTIONS and msg.data[0] == 3:
+                return None
+            return DIRECTION_REQUEST
+        if n >= 1 and msg.data[0] == n - 1:
+            return DIRECTION_RESPONSE
+        return None
+    if msg.function in (ModbusMessage.FUNCTION_WRITE_MULTIPLE_COILS, ModbusMessage.FUNCTION_WRITE_MULTIPLE_REGISTERS):
+        return DIRECTION_REQUEST if n > 4 else DIRECTION_RESPONSE
+    return None
+
+def msg_address_range(msg):
+    """Return the range of data addresses referenced by a message.
+
+    Returns:
+        Tuple (first, last) of the addresses (inclusive), or None if the
+        message does not contain an address (e.g., read responses).
+    """
+    d = msg.data
+    if msg.function in _ADDR_SINGLE_FUNCTIONS and len(d) >= 4:
+        addr = d[0] * 256 + d[1]
+        return addr, addr
+    # Read requests are 4 bytes; write multiple requests and responses both start with address and quantity
+    if msg.function in _ADDR_QTY_FUNCTIONS and (len(d) == 4 or (len(d) > 4 and msg.function not in _READ_FUNCTIONS)):
+        addr = d[0] * 256 + d[1]
+        qty = d[2] * 256 + d[3]
+        return addr, addr + max(qty, 1) - 1
+    return None
+
+def compile_filter(spec):
+    """Compile a declarative filter specification into a predicate.
+
+    The specification is a dictionary with any of the following keys
+    (all conditions that are present must be met):
+
+        addresses: List of slave addresses
+        functions: List of function codes (exception responses match
+            the function code of the request)
+        registers: List of [first, last] data address ranges (inclusive);
+            messages that reference any address in a range match.  Read
+            responses (which do not contain an address) match if the most
+            recent request from the same slave and function matched.
+        exceptions_only: If true, only exception responses match
+        direction: 'request' or 'response' (messages that cannot be
+            classified, such as write single register, match either)
+
+    Args:
+        spec: The filter specification (None or empty matches all messages)
+
+    Returns:
+        A function that takes a single ModbusMessage argument and returns
+        True if the message matches the filter, or None if the specification
+        is empty.
+
+    Raises ValueError if the specification is invalid.
+    """
+    if not spec:
+        return None
+    if not isinstance(spec, dict):
+        raise ValueError('Invalid filter specification: expected an object, not {}'.format(type(spec).__name__))
+    checks = []
+    try:
+        if spec.get('addresses') is not None:
+            addresses = frozenset(int(a) for a in spec['addresses'])
+            checks.append(lambda m: m.address in addresses)
+        if spec.get('functions') is not None:
+            functions = frozenset(int(f) for f in spec['functions'])
+            checks.append(lambda m: (m.function & 0x7F) in functions)
+        if spec.get('exceptions_only'):
+            checks.append(lambda m: (m.function & 0x80) != 0)
+        direction = spec.get('direction')
+        if direction is not None:
+            if direction not in (DIRECTION_REQUEST, DIRECTION_RESPONSE):
+                raise ValueError('Invalid direction: {}'.format(direction))
+            checks.append(lambda m: msg_direction(m) in (direction, None))
+        if spec.get('registers') is not None:
+            ranges = sorted((int(r[0]), int(r[1])) for r in spec['registers'])
+            checks.append(_registers_check(ranges))
+    except (TypeError, KeyError, IndexError) as e:
+        raise ValueError('Invalid filter specification: {}'.format(e))
+    unknown = set(spec) - set(('addresses', 'functions', 'registers', 'exceptions_only', 'direction'))
+    if unknown:
+        raise ValueError('Unknown filter keys: {}'.format(', '.join(sorted(unknown))))
+    if len(checks) == 1:
+        return checks[0]
+    return lambda m: all(c(m) for c in checks)
+
+def _registers_check(ranges):
+    """Return a check for a sorted list of address ranges.
+    """
+    starts = [r[0] for r in ranges]
+    # Maximum range end up to each index, so that overlapping ranges are handled
+    max_ends = []
+    for r in ranges:
+        max_ends.append(max(r[1], max_ends[-1]) if max_ends else r[1])
+    last_match = {}
+    def check(m):
+        key = (m.address, m.function & 0x7F)
+        rng = msg_address_range(m)
+        if rng is None:
+            return last_match.get(key, False)
+        # Find the last range starting at or before the end of the message range
+        i = bisect.bisect_right(starts, rng[1]) - 1
+        match = i >= 0 and max_ends[i] >= rng[0]
+        last_match[key] = match
+        return match
+    return check
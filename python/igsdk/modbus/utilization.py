@@ -0,0 +1,156 @@
+#
+# utilization.py
+#
+# Serial bus utilization measurement, and poll throttling based on it
+#
+
+from .stats import monotonic
+from collections import deque
+import threading
+import logging
+
+UTILIZATION_INTERVAL_DEFAULT = 1.0
+UTILIZATION_HISTORY_DEFAULT = 60
+
+def char_time(baudrate, bytesize=8, parity='N', stopbits=1):
+    """Return the time to transmit a single character with the given framing.
+
+    Args:
+        baudrate: Baud rate
+        bytesize: Data bits per character
+        parity: Parity ('N' for none, otherwise one parity bit)
+        stopbits: Stop bits (1, 1.5, or 2)
+    """
+    bits = 1 + bytesize + (0 if parity == 'N' else 1) + stopbits
+    return float(bits) / baudrate
+
+class UtilizationSample:
+    """Class representing the bus utilization over a single interval.
+
+    Utilization values are the fraction (0.0 - 1.0) of the interval that
+    would be required to transmit the bytes at the configured baud rate.
+    """
+    def __init__(self, t, interval, rx_bytes, tx_bytes, char_time):
+        self.t = t
+        self.interval = interval
+        self.rx_bytes = rx_bytes
+        self.tx_bytes = tx_bytes
+        self.rx = rx_bytes * char_time / interval if interval > 0 else 0.0
+        self.tx = tx_bytes * char_time / interval if interval > 0 else 0.0
+        self.total = self.rx + self.tx
+
+    def to_obj(self):
+        return { 't' : self.t, 'interval' : self.interval, 'rx_bytes' : self.rx_bytes, 'tx_bytes' : self.tx_bytes,
+            'rx' : self.rx, 'tx' : self.tx, 'total' : self.total }
+
+class UtilizationMeter(threading.Thread):
+    """Measures the utilization of a serial bus in each direction.
+
+    Received and transmitted bytes are counted (add_rx()/add_tx()), and
+    every 'interval' seconds a UtilizationSample is added to a fixed-length
+    history (the time series) and passed to all subscribers.  Subscriber
+    callbacks are called on the meter thread, and should not block.  If a
+    reactor is passed to meter_start(), the samples are taken by a reactor
+    timer instead of the meter thread.
+    """
+    def __init__(self, char_time, interval=UTILIZATION_INTERVAL_DEFAULT, history=UTILIZATION_HISTORY_DEFAULT):
+        self.logger = logging.getLogger(__name__)
+        self.char_time = char_time
+        self.interval = interval
+        self.history = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.last_time = monotonic()
+        self.stop_event = threading.Event()
+        self.timer = None
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def add_rx(self, nbytes):
+        with self.lock:
+            self.rx_bytes += nbytes
+
+    def add_tx(self, nbytes):
+        with self.lock:
+            self.tx_bytes += nbytes
+
+    def subscribe(self, cb):
+        """Subscribe to utilization samples; 'cb' is called with each UtilizationSample.
+        """
+        self.subscribers = self.subscribers + [cb]
+
+    def unsubscribe(self, cb):
+        self.subscribers = [s for s in self.subscribers if s != cb]
+
+    def sample(self):
+        """Complete the current interval, returning its UtilizationSample.
+        """
+        now = monotonic()
+        with self.lock:
+            s = UtilizationSample(now, now - self.last_time, self.rx_bytes, self.tx_bytes, self.char_time)
+            self.rx_bytes = 0
+            self.tx_bytes = 0
+            self.last_time = now
+        self.history.append(s)
+        for cb in self.subscribers:
+            try:
+                cb(s)
+            except Exception as e:
+                self.logger.error('Utilization subscriber failed: {}'.format(e))
+        return s
+
+    def get_history(self):
+        """Return the utilization time series, oldest first (list of UtilizationSample).
+        """
+        return list(self.history)
+
+    def meter_start(self, reactor=None):
+        self.last_time = monotonic()
+        if reactor:
+            self.timer = reactor.call_later(self.interval, self.sample, self.interval)
+        else:
+            self.start()
+
+    def meter_stop(self):
+        if self.timer:
+            self.timer.cancel()
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+class PollThrottle:
+    """Stretches poll periods when the bus utilization exceeds a threshold.
+
+    The throttle subscribes to a UtilizationMeter, and keeps a smoothed
+    (exponentially-weighted) total utilization.  While the smoothed
+    utilization is above 'threshold', poll periods are stretched by the
+    ratio of the utilization to the threshold (up to 'max_stretch'), so
+    that pollers sharing the bus reduce their load proportionally.
+    """
+    def __init__(self, meter, threshold=0.7, max_stretch=4.0, smoothing=0.5):
+        self.meter = meter
+        self.threshold = threshold
+        self.max_stretch = max_stretch
+        self.smoothing = smoothing
+        self.utilization = 0.0
+        self.stretch = 1.0
+        meter.subscribe(self.on_sample)
+
+    def on_sample(self, sample):
+        self.utilization = self.smoothing * sample.total + (1 - self.smoothing) * self.utilization
+        if self.utilization > self.threshold:
+            self.stretch = min(self.max_stretch, self.utilization / self.threshold)
+        else:
+            self.stretch = 1.0
+
+    def period(self, base_period):
+        """Return the poll period to use in place of 'base_period'.
+        """
+        return base_period * self.stretch
+
+    def close(self):
+        self.meter.unsubscribe(self.on_sample)
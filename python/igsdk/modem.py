@@ -6,16 +6,12 @@
 import dbus
 import dbus.exceptions
 import threading
-import dbus.mainloop.glib
 import logging
+import time
+from collections import deque
 
-import sys
-PYTHON3 = sys.version_info >= (3, 0)
-if PYTHON3:
-    from gi.repository import GObject as gobject
-    from gi.repository import GLib as glib
-else:
-    import gobject
+from .runtime import get_runtime
+from .properties import OfonoPropertyStore
 
 OFONO='org.ofono'
 OFONO_MANAGER_IFACE='org.ofono.Manager'
@@ -25,61 +21,490 @@ OFONO_CONNMAN_IFACE='org.ofono.ConnectionManager'
 OFONO_CONNECTION_IFACE='org.ofono.ConnectionContext'
 OFONO_NETREG_IFACE='org.ofono.NetworkRegistration'
 
+# Modem interfaces monitored (in addition to OFONO_MODEM_IFACE)
+MODEM_MONITOR_IFACES = [OFONO_SIM_IFACE, OFONO_NETREG_IFACE, OFONO_CONNMAN_IFACE]
+
+#
+# Signal quality history
+#
+SIGNAL_INTERVAL_DEFAULT = 10.0 # Seconds between samples
+SIGNAL_CAPACITY_DEFAULT = 8640 # Samples (one day at the default interval)
+SIGNAL_STRENGTH_DELTA_DEFAULT = 5 # Strength change (percent) that is published
+
 def _get_ofono_proxy(path, iface):
-    return dbus.Interface(dbus.SystemBus().get_object(OFONO, path), iface)
+    return get_runtime().get_interface(OFONO, path, iface)
 
 # Query LTE modem, SIM, and network properties using Ofono APIs
 # For more information, see:
 # https://git.kernel.org/pub/scm/network/ofono/ofono.git/tree/doc
 
-def get_modem_info():
-    result = None
-    try:
-        manager = _get_ofono_proxy('/', OFONO_MANAGER_IFACE)
-        modems = manager.GetModems()
-        if modems is None or len(modems) < 1:
-            return None
-        modem = _get_ofono_proxy(modems[0][0], OFONO_MODEM_IFACE)
-        modem_props = modem.GetProperties()
-        modem_interfaces = modem_props['Interfaces']
-        result = {}
-        result['modem'] = {}
-        result['modem']['IMEI'] = '%s' % modem_props.get('Serial', '')
-        if OFONO_SIM_IFACE in modem_interfaces:
-            sim = _get_ofono_proxy(modems[0][0], OFONO_SIM_IFACE)
-            sim_props = sim.GetProperties()
-            result['sim'] = {}
-            result['sim']['IMSI'] = '%s' % sim_props.get('SubscriberIdentity', '')
-            result['sim']['ICCID'] = '%s' % sim_props.get('CardIdentifier', '')
-            result['sim']['MobileCountryCode'] = '%s' % sim_props.get('MobileCountryCode', '')
-            result['sim']['MobileNetworkCode'] = '%s' % sim_props.get('MobileNetworkCode', '')
-            result['sim']['Numbers'] =  []
-            for n in sim_props.get('SubscriberNumbers', [])[:]:
-                result['sim']['Numbers'].append('%s' % n)
-        if OFONO_NETREG_IFACE in modem_interfaces:
-            net = _get_ofono_proxy(modems[0][0], OFONO_NETREG_IFACE)
-            net_props = net.GetProperties()
-            result['net'] = {}
-            result['net']['Operator'] = '%s' % net_props.get('Name', '')
-            result['net']['Technology'] = '%s' % net_props.get('Technology', '')
-            result['net']['Strength'] = int(net_props.get('Strength', 0))
-            result['net']['MobileCountryCode'] = '%s' % net_props.get('MobileCountryCode', '')
-            result['net']['MobileNetworkCode'] = '%s' % net_props.get('MobileNetworkCode', '')
-            result['net']['LocationAreaCode'] = '%s' % int(net_props.get('LocationAreaCode', -1))
-            result['net']['CellId'] = '%s' % int(net_props.get('CellId', -1))
-        if OFONO_CONNMAN_IFACE in modem_interfaces:
-            connman = _get_ofono_proxy(modems[0][0], OFONO_CONNMAN_IFACE)
-            connman_props = connman.GetProperties()
-            result['connection'] = {}
-            result['connection']['Attached'] = bool(connman_props['Attached'])
-            ctxs = connman.GetContexts()
-            if ctxs and len(ctxs) > 0:
-                ctx = _get_ofono_proxy(ctxs[0][0], OFONO_CONNECTION_IFACE)
-                ctx_props = ctx.GetProperties()
-                result['connection']['APN'] = '%s' % ctx_props.get('AccessPointName', '')
-                if 'Settings' in ctx_props:
-                    if 'Address' in ctx_props['Settings']:
-                        result['connection']['Address'] = '%s' % ctx_props['Settings']['Address']
-    except dbus.exceptions.DBusException as e:
-        pass
+def _build_modem_info(modem_props, sim_props, net_props, connman_props, ctx_props):
+    """Build the modem information (see get_modem_info()) from the oFono properties
+    """
+    result = {}
+    result['modem'] = {}
+    result['modem']['IMEI'] = '%s' % modem_props.get('Serial', '')
+    if sim_props is not None:
+        result['sim'] = {}
+        result['sim']['IMSI'] = '%s' % sim_props.get('SubscriberIdentity', '')
+        result['sim']['ICCID'] = '%s' % sim_props.get('CardIdentifier', '')
+        result['sim']['MobileCountryCode'] = '%s' % sim_props.get('MobileCountryCode', '')
+        result['sim']['MobileNetworkCode'] = '%s' % sim_props.get('MobileNetworkCode', '')
+        result['sim']['Numbers'] =  []
+        for n in sim_props.get('SubscriberNumbers', [])[:]:
+            result['sim']['Numbers'].append('%s' % n)
+    if net_props is not None:
+        result['net'] = {}
+        result['net']['Operator'] = '%s' % net_props.get('Name', '')
+        result['net']['Technology'] = '%s' % net_props.get('Technology', '')
+        result['net']['Strength'] = int(net_props.get('Strength', 0))
+        result['net']['MobileCountryCode'] = '%s' % net_props.get('MobileCountryCode', '')
+        result['net']['MobileNetworkCode'] = '%s' % net_props.get('MobileNetworkCode', '')
+        result['net']['LocationAreaCode'] = '%s' % int(net_props.get('LocationAreaCode', -1))
+        result['net']['CellId'] = '%s' % int(net_props.get('CellId', -1))
+    if connman_props is not None:
+        result['connection'] = {}
+        result['connection']['Attached'] = bool(connman_props.get('Attached', False))
+        if ctx_props is not None:
+            result['connection']['APN'] = '%s' % ctx_props.get('AccessPointName', '')
+            if 'Settings' in ctx_props:
+                if 'Address' in ctx_props['Settings']:
+                    result['connection']['Address'] = '%s' % ctx_props['Settings']['Address']
     return result
+
+def _diff_modem_info(old, new):
+    """Return the changes from 'old' to 'new', as { section : { key : value } } (None for a removed section)
+    """
+    changes = {}
+    old = old or {}
+    new = new or {}
+    for section in set(old) | set(new):
+        if section not in new:
+            changes[section] = None
+            continue
+        old_section = old.get(section, {})
+        changed = dict((k, v) for k, v in new[section].items() if old_section.get(k) != v)
+        for k in old_section:
+            if k not in new[section]:
+                changed[k] = None
+        if changed:
+            changes[section] = changed
+    return changes
+
+class ModemMonitor:
+    """Keeps the modem information current from the oFono signals
+
+    The properties of the first modem (and its SIM, network registration,
+    connection manager and first context) are loaded once, and then
+    updated from the PropertyChanged signals (see OfonoPropertyStore);
+    modems and contexts being added or removed cause a reload.  The
+    information (see get_modem_info()) is read from memory.
+
+    Subscribers (see subscribe()) are called with the new information and
+    the changes, as cb(info, changes), where 'changes' is a dictionary of
+    the changed keys by section ('modem', 'sim', 'net', 'connection'; a
+    section that was removed is None).  Callbacks are called on the main
+    loop thread, so they must not block.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.runtime = get_runtime()
+        self.lock = threading.RLock()
+        self.subscribers = []
+        self.stores = {}
+        self.modem_path = None
+        self.context_path = None
+        self.info = None
+        self.reads = 0
+        self.reloads = 0
+        self.updates = 0
+        self.notifications = 0
+        manager = self.runtime.get_interface(OFONO, '/', OFONO_MANAGER_IFACE)
+        self.signals = [
+            manager.connect_to_signal('ModemAdded', self._structure_changed),
+            manager.connect_to_signal('ModemRemoved', self._structure_changed)
+        ]
+        self.connman_signals = []
+        self.runtime.register(self, on_stop=self._remove_signals)
+        self.reload()
+
+    def _structure_changed(self, *args):
+        self.reload()
+
+    def _store(self, path, iface):
+        key = (path, iface)
+        store = self.stores.get(key)
+        if store is None:
+            store = OfonoPropertyStore(OFONO, path, iface)
+            store.add_listener(self._props_changed)
+            self.stores[key] = store
+        return store
+
+    def _close_stores(self, keep):
+        for key in [k for k in self.stores if k not in keep]:
+            self.stores.pop(key).close()
+
+    def _watch_connman(self, path):
+        for match in self.connman_signals:
+            match.remove()
+        self.connman_signals = []
+        if path:
+            connman = _get_ofono_proxy(path, OFONO_CONNMAN_IFACE)
+            self.connman_signals = [
+                connman.connect_to_signal('ContextAdded', self._structure_changed),
+                connman.connect_to_signal('ContextRemoved', self._structure_changed)
+            ]
+
+    def reload(self):
+        """Reload the modems, contexts and all their properties from oFono.
+        """
+        with self.lock:
+            self.reloads += 1
+            try:
+                modems = _get_ofono_proxy('/', OFONO_MANAGER_IFACE).GetModems()
+                modem_path = modems[0][0] if modems else None
+                keep = []
+                context_path = None
+                if modem_path:
+                    modem = self._store(modem_path, OFONO_MODEM_IFACE)
+                    modem.load()
+                    keep.append((modem_path, OFONO_MODEM_IFACE))
+                    interfaces = modem.get('Interfaces', [])
+                    for iface in MODEM_MONITOR_IFACES:
+                        if iface in interfaces:
+                            self._store(modem_path, iface).load()
+                            keep.append((modem_path, iface))
+                    if OFONO_CONNMAN_IFACE in interfaces:
+                        ctxs = _get_ofono_proxy(modem_path, OFONO_CONNMAN_IFACE).GetContexts()
+                        if ctxs:
+                            context_path = ctxs[0][0]
+                            self._store(context_path, OFONO_CONNECTION_IFACE).load()
+                            keep.append((context_path, OFONO_CONNECTION_IFACE))
+                        if modem_path != self.modem_path or not self.connman_signals:
+                            self._watch_connman(modem_path)
+                    else:
+                        self._watch_connman(None)
+                else:
+                    self._watch_connman(None)
+                self._close_stores(keep)
+                self.modem_path = modem_path
+                self.context_path = context_path
+            except dbus.exceptions.DBusException as e:
+                self.logger.warning('Cannot read modem properties: {}'.format(e))
+                self.modem_path = None
+            self._rebuild()
+
+    def _props_changed(self, store, changed, invalidated):
+        if store.iface == OFONO_MODEM_IFACE and 'Interfaces' in changed:
+            # Interfaces added or removed (e.g., SIM inserted)
+            self.reload()
+        else:
+            self._rebuild()
+
+    def _props(self, path, iface):
+        store = self.stores.get((path, iface))
+        return store.get_all() if store else None
+
+    def _rebuild(self):
+        with self.lock:
+            self.updates += 1
+            info = None
+            if self.modem_path:
+                try:
+                    info = _build_modem_info(self._props(self.modem_path, OFONO_MODEM_IFACE),
+                        self._props(self.modem_path, OFONO_SIM_IFACE),
+                        self._props(self.modem_path, OFONO_NETREG_IFACE),
+                        self._props(self.modem_path, OFONO_CONNMAN_IFACE),
+                        self._props(self.context_path, OFONO_CONNECTION_IFACE) if self.context_path else None)
+                except dbus.exceptions.DBusException as e:
+                    self.logger.warning('Cannot read modem properties: {}'.format(e))
+            changes = _diff_modem_info(self.info, info)
+            self.info = info
+            subscribers = list(self.subscribers) if changes else []
+        for cb in subscribers:
+            self.notifications += 1
+            try:
+                cb(info, changes)
+            except Exception as e:
+                self.logger.error('Modem subscriber failed: {}'.format(e))
+
+    def get_info(self):
+        """Return the modem information (see get_modem_info()), or None if no modem is available.
+        """
+        with self.lock:
+            self.reads += 1
+            if self.info is None:
+                # oFono (or the modem) was not available; try again
+                self.reload()
+            return _copy_info(self.info)
+
+    def subscribe(self, cb):
+        """Call cb(info, changes) when the modem information changes.
+        """
+        with self.lock:
+            self.subscribers.append(cb)
+
+    def unsubscribe(self, cb):
+        with self.lock:
+            if cb in self.subscribers:
+                self.subscribers.remove(cb)
+
+    def stop(self):
+        """Stop monitoring, and release the shared main loop.
+        """
+        with self.lock:
+            self._close_stores([])
+        self.runtime.unregister(self)
+
+    def _remove_signals(self):
+        for match in self.signals + self.connman_signals:
+            match.remove()
+        self.signals = []
+        self.connman_signals = []
+
+    def get_stats(self):
+        """Return the monitor statistics.
+
+        Returns:
+            A dictionary containing the count of reads, reloads, updates
+            (rebuilds of the information) and subscriber notifications,
+            and the property cache statistics of each oFono object and
+            interface ('props', by '<path>:<interface>').
+        """
+        with self.lock:
+            stores = list(self.stores.items())
+            return {
+                'reads' : self.reads,
+                'reloads' : self.reloads,
+                'updates' : self.updates,
+                'notifications' : self.notifications,
+                'props' : dict(('{}:{}'.format(path, iface), store.get_stats()) for (path, iface), store in stores)
+            }
+
+def _copy_info(info):
+    if info is None:
+        return None
+    return dict((section, dict(values)) for section, values in info.items())
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+def modem_monitor_start():
+    """Start (or return) the modem monitor, used by get_modem_info().
+
+    Returns:
+        The ModemMonitor instance (see subscribe() for change notifications),
+        or None if D-Bus is not available.
+    """
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            try:
+                _monitor = ModemMonitor()
+            except dbus.exceptions.DBusException as e:
+                logging.getLogger(__name__).error('Cannot start modem monitor: {}'.format(e))
+        return _monitor
+
+def modem_monitor_stop():
+    """Stop the modem monitor (if started).
+    """
+    global _monitor
+    with _monitor_lock:
+        monitor = _monitor
+        _monitor = None
+    if monitor:
+        monitor.stop()
+
+def get_modem_props_stats():
+    """Return the modem monitor statistics (see ModemMonitor.get_stats()), or None if not started.
+    """
+    monitor = _monitor
+    return monitor.get_stats() if monitor else None
+
+def get_modem_info():
+    """Return the modem, SIM, network and connection information.
+
+    The information is returned from memory, kept current by the modem
+    monitor (which is started on the first call).
+
+    Returns:
+        Dictionary of sections ('modem', 'sim', 'net', 'connection'), or
+        None if no modem is available.
+    """
+    monitor = modem_monitor_start()
+    if monitor is None:
+        return None
+    return monitor.get_info()
+
+class SignalHistory(threading.Thread):
+    """Records the cellular signal quality into a fixed-size history
+
+    Every 'interval' seconds, the signal strength (percent), access
+    technology and cell ID are sampled from the modem monitor (from
+    memory; see ModemMonitor), and added to a ring buffer of 'capacity'
+    samples, so the oldest samples are dropped.  Samples are tuples of
+    (time, strength, technology, cell ID), where the time is the system
+    (epoch) time; the strength is None if no modem is registered.
+
+    If 'publish_cb' is specified, it is called (on the history thread)
+    only when the signal changes: with a delta containing the time ('t')
+    and the changed values ('strength', if it changed by 'strength_delta'
+    or more since it was last published; 'technology'; 'cell'), and, if
+    'summary_interval' is specified, with a summary (see get_summary())
+    of the samples since the previous summary, as { 'summary' : ... }.
+    """
+    def __init__(self, interval=SIGNAL_INTERVAL_DEFAULT, capacity=SIGNAL_CAPACITY_DEFAULT, publish_cb=None,
+            strength_delta=SIGNAL_STRENGTH_DELTA_DEFAULT, summary_interval=None, monitor=None):
+        self.logger = logging.getLogger(__name__)
+        self.interval = interval
+        self.samples = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.publish_cb = publish_cb
+        self.strength_delta = strength_delta
+        self.summary_interval = summary_interval
+        self.monitor = monitor
+        self.published = {}
+        self.summary_start = None
+        self.publish_count = 0
+        self.stop_event = threading.Event()
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def history_start(self):
+        if self.monitor is None:
+            self.monitor = modem_monitor_start()
+        self.start()
+
+    def history_stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        """The method that is run in the thread context; samples the signal until stopped.
+        """
+        self.logger.info('Starting signal history.')
+        self.summary_start = time.time()
+        while True:
+            self.sample()
+            if self.stop_event.wait(self.interval):
+                break
+        self.logger.info('Signal history stopped.')
+
+    def sample(self):
+        """Take a sample of the signal quality (called at each interval).
+        """
+        info = self.monitor.get_info() if self.monitor else None
+        net = info.get('net') if info else None
+        t = time.time()
+        if net:
+            sample = (t, net['Strength'], net['Technology'], net['CellId'])
+        else:
+            sample = (t, None, None, None)
+        with self.lock:
+            self.samples.append(sample)
+        if self.publish_cb:
+            self.publish_delta(sample)
+            if self.summary_interval and t - self.summary_start >= self.summary_interval:
+                # The sample at 't' starts the next summary
+                self.publish({ 'summary' : self.get_summary(self.summary_start, t, end_exclusive=True) })
+                self.summary_start = t
+        return sample
+
+    def publish_delta(self, sample):
+        t, strength, technology, cell = sample
+        delta = {}
+        last = self.published.get('strength')
+        if (strength is None) != (last is None) or (strength is not None and abs(strength - last) >= self.strength_delta):
+            delta['strength'] = strength
+        if technology != self.published.get('technology', ''):
+            delta['technology'] = technology
+        if cell != self.published.get('cell', ''):
+            delta['cell'] = cell
+        if delta:
+            self.published.update(delta)
+            delta['t'] = t
+            self.publish(delta)
+
+    def publish(self, obj):
+        self.publish_count += 1
+        try:
+            self.publish_cb(obj)
+        except Exception as e:
+            self.logger.error('Signal history publish failed: {}'.format(e))
+
+    def query(self, start=None, end=None, end_exclusive=False):
+        """Return the samples taken from 'start' to 'end' (epoch times; None for no limit).
+
+        Samples taken at 'end' are included, unless 'end_exclusive' is True
+        (for consecutive ranges, so that each sample is in only one range).
+
+        Returns:
+            List of (time, strength, technology, cell ID) tuples, oldest first
+        """
+        with self.lock:
+            samples = list(self.samples)
+        return [s for s in samples if (start is None or s[0] >= start) and
+            (end is None or s[0] < end or (s[0] == end and not end_exclusive))]
+
+    def get_summary(self, start=None, end=None, end_exclusive=False):
+        """Return the rollup of the samples taken from 'start' to 'end' (see query()).
+
+        Returns:
+            A dictionary containing the time range and count of samples,
+            the minimum, maximum and mean strength (None if not registered
+            in any sample), the count of samples not registered, the count
+            of samples by technology, the distinct cell IDs, and the count
+            of cell and technology changes.
+        """
+        samples = self.query(start, end, end_exclusive)
+        strengths = [s[1] for s in samples if s[1] is not None]
+        technologies = {}
+        cells = []
+        cell_changes = 0
+        technology_changes = 0
+        prev = None
+        for s in samples:
+            if s[2] is not None:
+                technologies[s[2]] = technologies.get(s[2], 0) + 1
+            if s[3] is not None and s[3] not in cells:
+                cells.append(s[3])
+            if prev is not None:
+                cell_changes += 1 if s[3] != prev[3] else 0
+                technology_changes += 1 if s[2] != prev[2] else 0
+            prev = s
+        return {
+            'start' : samples[0][0] if samples else start,
+            'end' : samples[-1][0] if samples else end,
+            'count' : len(samples),
+            'min' : min(strengths) if strengths else None,
+            'max' : max(strengths) if strengths else None,
+            'mean' : float(sum(strengths)) / len(strengths) if strengths else None,
+            'unregistered' : len(samples) - len(strengths),
+            'technologies' : technologies,
+            'cells' : cells,
+            'cell_changes' : cell_changes,
+            'technology_changes' : technology_changes
+        }
+
+def signal_history_start(interval=SIGNAL_INTERVAL_DEFAULT, capacity=SIGNAL_CAPACITY_DEFAULT, publish_cb=None,
+        strength_delta=SIGNAL_STRENGTH_DELTA_DEFAULT, summary_interval=None):
+    """Start recording the cellular signal quality history.
+
+    Args:
+        interval: Time between samples (seconds)
+        capacity: Number of samples kept (the oldest are dropped)
+        publish_cb: Optional callback for the deltas and summaries (see SignalHistory)
+        strength_delta: Minimum change of strength (percent) that is published
+        summary_interval: Optional time between published summaries (seconds)
+
+    Returns:
+        A SignalHistory instance, to be used for queries (query(), get_summary())
+        and in signal_history_stop().
+    """
+    history = SignalHistory(interval, capacity, publish_cb, strength_delta, summary_interval)
+    history.history_start()
+    return history
+
+def signal_history_stop(history):
+    """Stop recording the signal quality history.
+    """
+    history.history_stop()
@@ -0,0 +1,226 @@
+#
+# properties.py
+#
+# Cached D-Bus properties, kept current from property change signals
+#
+
+import threading
+import logging
+
+from .runtime import get_runtime, monotonic
+
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+
+class PropertyStore:
+    """A memory copy of the properties of one interface of a remote object
+
+    The properties are loaded with one GetAll call (on the first read),
+    and then updated from the PropertiesChanged signal, so that reads do
+    not call the remote service.  A property that is invalidated (sent
+    without its value) is read again when it is next requested.
+
+    Changes received while the properties are being loaded (during the
+    GetAll round trip) are recorded, and applied again to the loaded
+    properties, since they may be newer than the values returned.
+
+    If 'max_age' (seconds) is specified, the properties are reloaded when
+    they have not been loaded or updated for longer; a maximum age can
+    also be passed to each read.  The store registers with the shared
+    main loop (see runtime.py) to receive the signals, until close() is
+    called.
+    """
+    def __init__(self, service, path, iface, max_age=None):
+        self.logger = logging.getLogger(__name__)
+        self.service = service
+        self.path = path
+        self.iface = iface
+        self.max_age = max_age
+        self.runtime = get_runtime()
+        self.lock = threading.Lock()
+        self.props = None
+        self.invalidated = set()
+        self.updated = None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.changes = 0
+        self.loading = 0
+        self.load_changes = []
+        self.listeners = []
+        self.signal = self._subscribe()
+        self.runtime.register(self, on_stop=self._remove_signal)
+
+    def _subscribe(self):
+        props = self.runtime.get_interface(self.service, self.path, DBUS_PROP_IFACE)
+        return props.connect_to_signal('PropertiesChanged', self._properties_changed, arg0=self.iface)
+
+    def _get_all(self):
+        props = self.runtime.get_interface(self.service, self.path, DBUS_PROP_IFACE)
+        return props.GetAll(self.iface)
+
+    def _get(self, name):
+        props = self.runtime.get_interface(self.service, self.path, DBUS_PROP_IFACE)
+        return props.Get(self.iface, name)
+
+    def _properties_changed(self, iface, changed, invalidated):
+        if iface == self.iface:
+            self.update(changed, invalidated)
+
+    def update(self, changed, invalidated=()):
+        """Apply changed (and invalidated) properties, e.g., from the owner's own signal handler.
+
+        The store is updated from the signals on the main loop thread; an
+        owner that handles the same signal can call this first, so that
+        its reads in the handler see the new values (applying the same
+        change twice has no effect).
+        """
+        with self.lock:
+            self.changes += 1
+            if self.loading:
+                # Applied again to the properties being loaded (see load())
+                self.load_changes.append((dict(changed), list(invalidated)))
+            if self.props is None:
+                return
+            self.props.update(changed)
+            self.invalidated.difference_update(changed)
+            for name in invalidated:
+                self.props.pop(name, None)
+                self.invalidated.add(name)
+            self.updated = monotonic()
+            listeners = list(self.listeners)
+        for cb in listeners:
+            try:
+                cb(self, changed, invalidated)
+            except Exception as e:
+                self.logger.error('Property listener failed: {}'.format(e))
+
+    def add_listener(self, cb):
+        """Call cb(store, changed, invalidated) after each update of the loaded properties.
+        """
+        with self.lock:
+            self.listeners.append(cb)
+
+    def remove_listener(self, cb):
+        with self.lock:
+            if cb in self.listeners:
+                self.listeners.remove(cb)
+
+    def _is_stale(self, max_age):
+        if self.props is None:
+            return True
+        if max_age is None:
+            max_age = self.max_age
+        return max_age is not None and monotonic() - self.updated > max_age
+
+    def load(self):
+        """Load (or reload) all the properties from the remote object.
+        """
+        with self.lock:
+            self.loading += 1
+        try:
+            props = dict(self._get_all())
+        finally:
+            with self.lock:
+                self.loading -= 1
+                load_changes = self.load_changes
+                if not self.loading:
+                    self.load_changes = []
+        with self.lock:
+            # Changes received during the call may be newer than the values returned
+            invalidated = set()
+            for changed, names in load_changes:
+                props.update(changed)
+                invalidated.difference_update(changed)
+                for name in names:
+                    props.pop(name, None)
+                    invalidated.add(name)
+            self.props = props
+            self.invalidated = invalidated
+            self.updated = monotonic()
+            self.loads += 1
+
+    def get(self, name, default=None, max_age=None):
+        """Return the value of a property (or 'default' if the object does not have it).
+
+        Args:
+            name: Property name
+            default: Value returned if the property does not exist
+            max_age: Maximum age (seconds) of the cached value (overrides the store 'max_age')
+        """
+        with self.lock:
+            if not self._is_stale(max_age) and name not in self.invalidated:
+                self.hits += 1
+                return self.props.get(name, default)
+            self.misses += 1
+            reload = self._is_stale(max_age)
+        if reload:
+            self.load()
+        else:
+            value = self._get(name)
+            with self.lock:
+                if name not in self.invalidated:
+                    # Changed (or reloaded) during the call: the store has a newer value
+                    return self.props.get(name, default)
+                self.props[name] = value
+                self.invalidated.discard(name)
+            return value
+        with self.lock:
+            return self.props.get(name, default)
+
+    def get_all(self, max_age=None):
+        """Return a dictionary of all the property values.
+        """
+        with self.lock:
+            stale = self._is_stale(max_age) or bool(self.invalidated)
+            if stale:
+                self.misses += 1
+            else:
+                self.hits += 1
+                return dict(self.props)
+        self.load()
+        with self.lock:
+            return dict(self.props)
+
+    def close(self):
+        """Stop updating the properties, and release the shared main loop.
+        """
+        self.runtime.unregister(self)
+
+    def _remove_signal(self):
+        if self.signal:
+            self.signal.remove()
+            self.signal = None
+
+    def get_stats(self):
+        """Return the cache statistics.
+
+        Returns:
+            A dictionary containing the count of reads served from memory
+            ('hits') and from the remote object ('misses'), the count of
+            (re)loads and change signals received, and the age of the
+            properties (seconds, or None if not loaded).
+        """
+        with self.lock:
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'loads' : self.loads,
+                'changes' : self.changes,
+                'age' : monotonic() - self.updated if self.updated is not None else None
+            }
+
+class OfonoPropertyStore(PropertyStore):
+    """A PropertyStore for oFono interfaces, which use GetProperties and the PropertyChanged signal.
+    """
+    def _subscribe(self):
+        intf = self.runtime.get_interface(self.service, self.path, self.iface)
+        return intf.connect_to_signal('PropertyChanged', self._property_changed)
+
+    def _get_all(self):
+        return self.runtime.get_interface(self.service, self.path, self.iface).GetProperties()
+
+    def _get(self, name):
+        return self._get_all().get(name)
+
+    def _property_changed(self, name, value):
+        self.update({ name : value })
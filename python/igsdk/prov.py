@@ -6,18 +6,10 @@
 
 import dbus
 import dbus.exceptions
-import threading
-import dbus.mainloop.glib
 import logging
 import json
 
-import sys
-PYTHON3 = sys.version_info >= (3, 0)
-if PYTHON3:
-    from gi.repository import GObject as gobject
-    from gi.repository import GLib as glib
-else:
-    import gobject
+from .runtime import get_runtime
 
 PROV_SVC = 'com.lairdtech.IG.ProvService'
 PROV_IFACE = 'com.lairdtech.IG.ProvInterface'
@@ -38,48 +30,38 @@ PROV_FAILED_TIMEOUT = -4
 PROV_FAILED_NOT_FOUND = -5
 PROV_FAILED_BAD_CONFIG = -6
 
-class ProvManager(threading.Thread):
+class ProvManager:
     """
     Class that encapsulates the prov API functionality
     """
     def __init__(self, provisioning_status_callback = None):
         self.logger = logging.getLogger(__name__)
-        self.loop = None
 
-        # Set up DBus loop
-        dbus.mainloop.glib.threads_init()
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        if PYTHON3:
-            self.loop = glib.MainLoop()
-        else:
-            self.loop = gobject.MainLoop()
-            gobject.threads_init()
+        self.runtime = get_runtime()
 
         # Get DBus objects
-        self.prov = dbus.Interface(dbus.SystemBus().get_object(PROV_SVC, PROV_OBJ), PROV_IFACE)
+        self.prov = self.runtime.get_interface(PROV_SVC, PROV_OBJ, PROV_IFACE)
 
         # Register signal handlers if using callback
-        self.prov.connect_to_signal('StateChanged', self.state_changed)
+        self.signal = self.prov.connect_to_signal('StateChanged', self.state_changed)
 
         self.logger.info('Prov Manager starting.')
-        super(ProvManager, self).__init__()
 
         # Save custom callbacks with the client
         self.provisioning_status_callback = provisioning_status_callback
-        # Run main loop if using callback
-        self.start()
-
-    def run(self):
-        """Method to run the DBus main loop (on a thread)
-        """
-        self.logger.info('Starting main loop.')
-        self.loop.run()
-        self.logger.info('Main loop has exited.')
+        # Run the shared main loop to receive the signals
+        self.runtime.register(self, on_stop=self.remove_signals)
 
     def quit_loop(self):
+        """Remove the signal handlers, and release the shared main loop
+        """
         self.logger.info('Quitting')
-        if self.loop:
-            self.loop.quit()
+        self.runtime.unregister(self)
+
+    def remove_signals(self):
+        if self.signal:
+            self.signal.remove()
+            self.signal = None
 
     def state_changed(self, state):
         if state == PROV_COMPLETE_SUCCESS:
@@ -126,6 +108,23 @@ class ProvManager(threading.Thread):
         self.logger.info('Performing the core update')
         return self.prov.PerformCoreUpdate()
 
+    def start_core_download_async(self, data):
+        """
+        Start a download of the green grass core (see start_core_download()), without waiting
+        Returns a DBusFuture (see runtime.py) for the result of StartCoreDownload
+        """
+        self.logger.info('Starting the core download')
+        data = json.loads(data)
+        return self.runtime.call_async(self.prov.StartCoreDownload, (data['url'], data))
+
+    def perform_core_update_async(self):
+        """
+        Install the greengrass core binary, without waiting
+        Returns a DBusFuture (see runtime.py) for the result of PerformCoreUpdate
+        """
+        self.logger.info('Performing the core update')
+        return self.runtime.call_async(self.prov.PerformCoreUpdate)
+
 
 
 
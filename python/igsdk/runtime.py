@@ -0,0 +1,347 @@
+#
+# runtime.py
+#
+# Shared D-Bus connection and GLib main loop for the igsdk managers
+#
+
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import threading
+import logging
+import time
+
+import sys
+PYTHON3 = sys.version_info >= (3, 0)
+if PYTHON3:
+    from gi.repository import GObject as gobject
+    from gi.repository import GLib as glib
+else:
+    import gobject
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+def rss_kb():
+    """Return the resident set size of the process, in KB (or None if not available).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+class DBusFuture:
+    """The result of an asynchronous D-Bus call (see DBusRuntime.call_async()).
+
+    The result can be waited for from any thread (result()), handled with
+    a callback (add_done_callback(), called on the main loop thread, or at
+    once if already done), or awaited in an asyncio coroutine (Python 3).
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+        self.t_start = monotonic()
+        self.latency = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def _finish(self, value, error):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.value = value
+            self.error = error
+            self.latency = monotonic() - self.t_start
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for cb in callbacks:
+            try:
+                cb(self)
+            except Exception as e:
+                logging.getLogger(__name__).error('Callback for {} failed: {}'.format(self.name, e))
+
+    def set_result(self, value):
+        self._finish(value, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def add_done_callback(self, cb):
+        """Call cb(future) when the call is complete.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(cb)
+                return
+        cb(self)
+
+    def result(self, timeout=None):
+        """Wait for the call to complete, and return its result (or raise its error).
+
+        Raises:
+            DBusTimeoutError if the call is not complete after 'timeout' seconds.
+        """
+        if not self.event.wait(timeout):
+            raise DBusTimeoutError('{} not complete after {} s'.format(self.name, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        """Wait for the call to complete, and return its error (or None).
+        """
+        if not self.event.wait(timeout):
+            raise DBusTimeoutError('{} not complete after {} s'.format(self.name, timeout))
+        return self.error
+
+    def wrap_asyncio(self, loop=None):
+        """Return an asyncio future for the result, completed on 'loop' (default: the current event loop).
+        """
+        import asyncio
+        loop = loop or asyncio.get_event_loop()
+        af = loop.create_future()
+        def copy(f):
+            if af.done():
+                return
+            if f.error is not None:
+                af.set_exception(f.error)
+            else:
+                af.set_result(f.value)
+        self.add_done_callback(lambda f: loop.call_soon_threadsafe(copy, f))
+        return af
+
+    def __await__(self):
+        return self.wrap_asyncio().__await__()
+
+class DBusTimeoutError(Exception):
+    """Raised by DBusFuture.result() when the call is not complete in time.
+    """
+    pass
+
+def completed_future(value, name=None):
+    """Return a DBusFuture that is already complete with 'value'.
+    """
+    f = DBusFuture(name)
+    f.set_result(value)
+    return f
+
+class DBusRuntime:
+    """A single system bus connection and GLib main loop for all managers
+
+    Managers (DeviceMgr, BtMgr, ConfigManager, ProvManager) obtain their
+    proxies from the runtime (see get_interface()), which caches them, so
+    that each remote object is only looked up (and introspected) once per
+    process.  Managers that receive signals register with the runtime
+    (see register()); the main loop runs on a single thread while at least
+    one manager is registered.
+
+    Each registered manager can provide lifecycle hooks: 'on_start' is
+    called on the main loop thread once the loop is running, and 'on_stop'
+    is called when the manager is unregistered (or the runtime is stopped).
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        t_start = monotonic()
+        rss_start = rss_kb()
+        # The main loop must be the default before the bus connection is made
+        dbus.mainloop.glib.threads_init()
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        if not PYTHON3:
+            gobject.threads_init()
+        self.bus = dbus.SystemBus()
+        self.lock = threading.RLock()
+        self.objects = {}
+        self.interfaces = {}
+        self.clients = {}
+        self.loop = None
+        self.thread = None
+        self.proxy_hits = 0
+        self.proxy_misses = 0
+        self.calls_completed = 0
+        self.calls_failed = 0
+        self.startup = { 'connect_time' : monotonic() - t_start, 'connect_rss_kb' : self._rss_delta(rss_start) }
+        self.logger.info('D-Bus runtime connected in {:.3f} s.'.format(self.startup['connect_time']))
+
+    @staticmethod
+    def _rss_delta(rss_start):
+        rss = rss_kb()
+        return rss - rss_start if rss is not None and rss_start is not None else None
+
+    def get_object(self, service, path):
+        """Return the (cached) proxy for a remote object.
+        """
+        key = (service, path)
+        with self.lock:
+            obj = self.objects.get(key)
+            if obj is None:
+                self.proxy_misses += 1
+                obj = self.bus.get_object(service, path)
+                self.objects[key] = obj
+            else:
+                self.proxy_hits += 1
+        return obj
+
+    def get_interface(self, service, path, iface):
+        """Return the (cached) interface proxy for a remote object.
+        """
+        key = (service, path, iface)
+        with self.lock:
+            intf = self.interfaces.get(key)
+            if intf is None:
+                intf = dbus.Interface(self.get_object(service, path), iface)
+                self.interfaces[key] = intf
+            else:
+                self.proxy_hits += 1
+        return intf
+
+    def forget(self, service, path):
+        """Remove the cached proxies for a remote object and its children (e.g., when it is removed).
+        """
+        def match(key):
+            return key[0] == service and (key[1] == path or key[1].startswith(path + '/'))
+        with self.lock:
+            for cache in (self.objects, self.interfaces):
+                for key in [k for k in cache if match(k)]:
+                    del cache[key]
+
+    def register(self, client, on_start=None, on_stop=None):
+        """Register a manager that requires the main loop (to receive signals).
+
+        The main loop thread is started when the first manager is registered.
+        """
+        with self.lock:
+            self.clients[id(client)] = (client, on_stop)
+            if self.thread is None:
+                self.loop = glib.MainLoop() if PYTHON3 else gobject.MainLoop()
+                self.thread = threading.Thread(target=self._run, args=(self.loop,))
+                self.thread.daemon = True
+                self.thread.start()
+        if on_start:
+            self.call_on_loop(on_start)
+
+    def unregister(self, client):
+        """Unregister a manager, calling its 'on_stop' hook.
+
+        The main loop is stopped when the last manager is unregistered.
+        """
+        with self.lock:
+            entry = self.clients.pop(id(client), None)
+            loop = None
+            if not self.clients and self.thread is not None:
+                loop = self.loop
+                self.loop = None
+                self.thread = None
+        if entry and entry[1]:
+            entry[1]()
+        if loop:
+            gobject.timeout_add(0, loop.quit)
+
+    def call_async(self, method, args=(), timeout=None):
+        """Call a D-Bus method without waiting for the reply.
+
+        The main loop runs while the call is pending, to receive the reply.
+
+        Args:
+            method: Method of an interface or object proxy (e.g., intf.Reboot)
+            args: Tuple of the method arguments
+            timeout: Optional D-Bus timeout (seconds) of the call
+
+        Returns:
+            A DBusFuture for the reply (the return value of the method, or
+            None if it returns nothing) or the DBusException.
+        """
+        f = DBusFuture(getattr(method, '_method_name', None))
+        kwargs = { 'reply_handler' : lambda *values: self._call_done(f, values, None),
+                   'error_handler' : lambda e: self._call_done(f, None, e) }
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        self.register(f)
+        try:
+            method(*args, **kwargs)
+        except dbus.exceptions.DBusException as e:
+            self._call_done(f, None, e)
+        return f
+
+    def _call_done(self, f, values, error):
+        self.unregister(f)
+        with self.lock:
+            self.calls_completed += 1
+            if error is not None:
+                self.calls_failed += 1
+        if error is not None:
+            f.set_exception(error)
+        else:
+            f.set_result(values[0] if len(values) == 1 else (tuple(values) if values else None))
+
+    def call_on_loop(self, cb, *args):
+        """Call cb(*args) on the main loop thread.
+        """
+        def idle():
+            cb(*args)
+            return False
+        gobject.idle_add(idle)
+
+    def _run(self, loop):
+        self.logger.info('Starting main loop.')
+        loop.run()
+        self.logger.info('Main loop has exited.')
+
+    def stop(self):
+        """Unregister all managers (calling their 'on_stop' hooks), and stop the main loop.
+        """
+        with self.lock:
+            clients = [entry[0] for entry in self.clients.values()]
+        for client in clients:
+            self.unregister(client)
+
+    def get_stats(self):
+        """Return the runtime statistics.
+
+        Returns:
+            A dictionary containing the count of registered managers, whether
+            the main loop is running, the count of cached objects and proxy
+            cache hits/misses, the count of asynchronous calls completed and
+            failed, the startup time and RSS increase of the bus
+            connection, and the current RSS of the process (in KB).
+        """
+        with self.lock:
+            return {
+                'clients' : len(self.clients),
+                'loop_running' : self.thread is not None,
+                'objects' : len(self.objects),
+                'proxy_hits' : self.proxy_hits,
+                'proxy_misses' : self.proxy_misses,
+                'calls_completed' : self.calls_completed,
+                'calls_failed' : self.calls_failed,
+                'startup' : dict(self.startup),
+                'rss_kb' : rss_kb()
+            }
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+def get_runtime():
+    """Return the process-wide D-Bus runtime (created on first use).
+    """
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = DBusRuntime()
+        return _runtime
+
+def runtime_stop():
+    """Stop the process-wide D-Bus runtime main loop (if it was created).
+    """
+    with _runtime_lock:
+        runtime = _runtime
+    if runtime:
+        runtime.stop()
@@ -0,0 +1,165 @@
+#
+# runtimebench.py
+#
+# Measurement of the startup time and memory (RSS) of the igsdk managers
+# on the shared D-Bus runtime, e.g., one device instance per serial port
+# (as created by SerialQueue) plus the config and provisioning managers,
+# compared with a baseline where each manager sets up its own D-Bus main
+# loop, proxies and main loop thread (as before the shared runtime).
+# Each mode runs in a new interpreter.
+#
+# Run as: python -m igsdk.runtimebench [--ports N] [--config] [--prov] [--mode shared|baseline]
+#
+
+from igsdk.runtime import rss_kb, monotonic, PYTHON3
+import argparse
+import subprocess
+import sys
+import threading
+
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+
+MODES = ('baseline', 'shared')
+
+class Totals:
+    def __init__(self):
+        self.time = 0.0
+        self.rss_start = rss_kb()
+
+    def measure(self, name, fn):
+        rss_start = rss_kb()
+        t_start = monotonic()
+        result = fn()
+        t = monotonic() - t_start
+        self.time += t
+        rss = rss_kb()
+        print('  {:24s} {:10.3f} {:12s} {:8d}'.format(name, t,
+            str(rss - rss_start) if rss is not None and rss_start is not None else '-', threading.active_count()))
+        return result
+
+    def report(self):
+        rss = rss_kb()
+        # Parsed by the parent process (see compare())
+        print('TOTAL {:.6f} {} {}'.format(self.time,
+            rss - self.rss_start if rss is not None and self.rss_start is not None else -1, threading.active_count()))
+
+class BaselineManager(threading.Thread):
+    """A manager as created before the shared runtime.
+
+    Each manager set up the GLib D-Bus main loop, looked up (and
+    introspected) its own proxies, and, if it received signals, ran its
+    own main loop on its own thread.
+    """
+    def __init__(self, service, path, iface, signal=None, prop=None):
+        import dbus
+        import dbus.mainloop.glib
+        if PYTHON3:
+            from gi.repository import GLib as glib
+        else:
+            import gobject as glib
+        dbus.mainloop.glib.threads_init()
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self.loop = None
+        if signal:
+            self.loop = glib.MainLoop()
+            if not PYTHON3:
+                glib.threads_init()
+        self.intf = dbus.Interface(dbus.SystemBus().get_object(service, path), iface)
+        self.props = dbus.Interface(dbus.SystemBus().get_object(service, path), DBUS_PROP_IFACE)
+        if prop:
+            self.props.Get(iface, prop)
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if signal:
+            self.match = self.props.connect_to_signal(signal, lambda *args: None)
+            self.start()
+
+    def run(self):
+        self.loop.run()
+
+    def stop(self):
+        if self.loop:
+            self.loop.quit()
+
+def run_baseline(args):
+    from igsdk.device import DEVICE_SERVICE, DEVICE_SERVICE_OBJ_PATH, DEVICE_SERVICE_PUBLIC_IFACE, EXT_STORAGE_STATUS_PROP
+    totals = Totals()
+    print('Startup with a main loop per manager (baseline)')
+    print('  step                     time (s)  RSS (KB)     threads')
+    def device(callback):
+        return BaselineManager(DEVICE_SERVICE, DEVICE_SERVICE_OBJ_PATH, DEVICE_SERVICE_PUBLIC_IFACE,
+            'PropertiesChanged' if callback else None, EXT_STORAGE_STATUS_PROP)
+    mgrs = totals.measure('device_init() x {}'.format(args.ports), lambda: [device(False) for i in range(args.ports)])
+    mgrs.append(totals.measure('device_init(callback)', lambda: device(True)))
+    if args.config:
+        from igsdk.config import IGCONFD_SVC, IGCONFD_OBJ, IGCONFD_IFACE
+        mgrs.append(totals.measure('ConfigManager', lambda: BaselineManager(IGCONFD_SVC, IGCONFD_OBJ, IGCONFD_IFACE, 'PropertiesChanged')))
+    if args.prov:
+        from igsdk.prov import PROV_SVC, PROV_OBJ, PROV_IFACE
+        mgrs.append(totals.measure('ProvManager', lambda: BaselineManager(PROV_SVC, PROV_OBJ, PROV_IFACE, 'PropertiesChanged')))
+    totals.report()
+    for mgr in mgrs:
+        mgr.stop()
+
+def run_shared(args):
+    from igsdk.runtime import get_runtime, runtime_stop
+    from igsdk.device import device_init, device_deinit
+    totals = Totals()
+    print('Startup on the shared D-Bus runtime')
+    print('  step                     time (s)  RSS (KB)     threads')
+    totals.measure('runtime', get_runtime)
+    devs = totals.measure('device_init() x {}'.format(args.ports), lambda: [device_init() for i in range(args.ports)])
+    totals.measure('device_init(callback)', lambda: device_init(lambda available, path: None))
+    if args.config:
+        from igsdk.config import ConfigManager
+        totals.measure('ConfigManager', ConfigManager)
+    if args.prov:
+        from igsdk.prov import ProvManager
+        totals.measure('ProvManager', ProvManager)
+    print('Runtime: {}'.format(get_runtime().get_stats()))
+    totals.report()
+    for dev in devs:
+        device_deinit(dev)
+    runtime_stop()
+
+def compare(args):
+    """Run each mode in a new interpreter, and report the change.
+    """
+    totals = {}
+    for mode in MODES:
+        cmd = [sys.executable, '-m', 'igsdk.runtimebench', '--mode', mode, '--ports', str(args.ports)]
+        if args.config:
+            cmd.append('--config')
+        if args.prov:
+            cmd.append('--prov')
+        out = subprocess.check_output(cmd).decode()
+        for line in out.splitlines():
+            if line.startswith('TOTAL '):
+                t, rss, threads = line.split()[1:]
+                totals[mode] = (float(t), int(rss), int(threads))
+            else:
+                print(line)
+    base = totals['baseline']
+    shared = totals['shared']
+    print('Change (shared - baseline):')
+    print('  startup time   {:+.3f} s ({:.3f} -> {:.3f})'.format(shared[0] - base[0], base[0], shared[0]))
+    if base[1] >= 0 and shared[1] >= 0:
+        print('  RSS            {:+d} KB ({} -> {})'.format(shared[1] - base[1], base[1], shared[1]))
+    print('  threads        {:+d} ({} -> {})'.format(shared[2] - base[2], base[2], shared[2]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ports', type=int, default=8, help='Number of device instances (serial ports)')
+    parser.add_argument('--config', action='store_true', help='Also start a ConfigManager')
+    parser.add_argument('--prov', action='store_true', help='Also start a ProvManager')
+    parser.add_argument('--mode', choices=MODES, default=None, help='Run only one mode (default: compare both)')
+    args = parser.parse_args()
+    if args.mode == 'baseline':
+        run_baseline(args)
+    elif args.mode == 'shared':
+        run_shared(args)
+    else:
+        compare(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#
+# codec.py
+#
+# Streaming compression codecs for managed files
+#
+
+import time
+import zlib
+
+# CPU time of the calling thread (process CPU time on older Pythons)
+cpu_time = getattr(time, 'thread_time', None) or getattr(time, 'clock', None) or time.time
+
+COMPRESS_LEVEL_DEFAULT = 6
+
+class ZlibStream:
+    """A compression stream of a ZlibCodec (one per file).
+    """
+    def __init__(self, level, wbits):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        # End the block: all the data so far can be decompressed from the output
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+class ZlibCodec:
+    """zlib (deflate) compression, in the zlib format.
+
+    A codec creates a stream for each file (see stream()); the stream
+    compresses data (compress()), ends a block so that all the data
+    compressed so far can be read from the file (flush()), and ends the
+    file (finish()).  Other codecs can be used by implementing the same
+    methods (see register_codec()).
+    """
+    name = 'zlib'
+    suffix = '.z'
+    wbits = zlib.MAX_WBITS
+
+    def __init__(self, level=COMPRESS_LEVEL_DEFAULT):
+        self.level = level
+
+    def stream(self):
+        return ZlibStream(self.level, self.wbits)
+
+    def bound(self, n):
+        """Return the maximum size of 'n' bytes compressed, flushed and finished.
+        """
+        return n + (n >> 12) + (n >> 14) + 64
+
+    def decompress(self, data):
+        """Return the data that can be decompressed from a file (which may be truncated).
+        """
+        return zlib.decompressobj(self.wbits).decompress(data)
+
+class GzipCodec(ZlibCodec):
+    """zlib (deflate) compression, in the gzip format (readable with gunzip/zcat).
+    """
+    name = 'gzip'
+    suffix = '.gz'
+    wbits = zlib.MAX_WBITS | 16
+
+_codecs = {
+    ZlibCodec.name : ZlibCodec,
+    GzipCodec.name : GzipCodec
+}
+
+def register_codec(name, factory):
+    """Add a compression codec.
+
+    Args:
+        name: Codec name (see get_codec())
+        factory: Callable creating the codec, with the compression level
+            as its optional argument
+    """
+    _codecs[name] = factory
+
+def get_codec(name, level=None):
+    """Create a compression codec by name ('zlib', 'gzip', or registered with register_codec()).
+
+    Raises:
+        ValueError if the codec is not known.
+    """
+    factory = _codecs.get(name)
+    if factory is None:
+        raise ValueError('Unknown compression codec: {}'.format(name))
+    return factory(level) if level is not None else factory()
+
+def codec_from_str(s):
+    """Create a codec from a string '<name>[:<level>]' (e.g., 'gzip:6'), or None if empty.
+    """
+    if not s:
+        return None
+    parts = s.split(':')
+    return get_codec(parts[0], int(parts[1]) if len(parts) > 1 and parts[1] else None)
@@ -0,0 +1,141 @@
+#
+# filebench.py
+#
+# Benchmark of the managed file write modes: direct writes (each record
+# written to a buffered file, as ManagedFile does by default, or flushed
+# to the kernel each time) and write-behind writes with each fsync
+# policy, and with compression.  Reports the records per second, the
+# write and fsync operations issued to storage (write system calls from
+# /proc/self/io), and the compression ratio and CPU time.
+#
+# Run as: python -m igsdk.storage.filebench [--records N] [--dir PATH]
+#
+# Use a directory on the SD card (e.g., /media/sdcard) to measure the
+# actual card; the default is a temporary directory.
+#
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from .write_behind import WriteBehindConfig, WriteBehindFile, FSYNC_NONE, FSYNC_PERIODIC, FSYNC_RECORDS
+from .codec import get_codec
+
+# A Modbus text storage record (see TextFileStorageLambda.py)
+RECORD = '{},1,3,0,1,0,2,0,{},0,4,0,5,0,6,0,{},0,8\n'
+
+def proc_io():
+    """Return the I/O counters of the process (dictionary), or an empty dictionary if not available.
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+class DirectWriter:
+    """Rotating writer with direct writes to a buffered file (as ManagedFile without write-behind).
+    """
+    def __init__(self, flush):
+        self.flush = flush
+        self.file = None
+        self.fsyncs = 0
+        self.compression = None
+
+    def open(self, filename):
+        if self.file:
+            self.file.close()
+        self.file = open(filename, 'wb')
+
+    def size(self):
+        return self.file.tell()
+
+    def write(self, data):
+        self.file.write(data.encode())
+        if self.flush:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class WriteBehindWriter:
+    """Rotating writer using a WriteBehindFile.
+    """
+    def __init__(self, config, codec=None):
+        self.writer = WriteBehindFile(config, codec)
+        self.writer.writer_start()
+        self.fsyncs = 0
+        self.compression = None
+
+    def open(self, filename):
+        self.writer.open(filename)
+
+    def size(self):
+        return self.writer.size()
+
+    def write(self, data):
+        self.writer.write(data.encode())
+
+    def close(self):
+        self.writer.writer_stop()
+        stats = self.writer.get_stats()
+        self.fsyncs = stats['fsyncs']
+        self.compression = stats.get('compression')
+
+def run(writer, path, records, maxsize):
+    files = 0
+    io_start = proc_io()
+    t_start = time.time()
+    writer.open('{}/bench-{}.csv'.format(path, files))
+    t = 1577836800000
+    for i in range(records):
+        record = RECORD.format(t + i * 10, i & 0xff, i % 7)
+        if writer.size() + len(record) > maxsize:
+            files += 1
+            writer.open('{}/bench-{}.csv'.format(path, files))
+        writer.write(record)
+    writer.close()
+    elapsed = time.time() - t_start
+    io_end = proc_io()
+    writes = io_end['syscw'] - io_start['syscw'] if 'syscw' in io_start else None
+    disk = io_end['write_bytes'] - io_start['write_bytes'] if 'write_bytes' in io_start else None
+    sizes = [os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)]
+    return records / elapsed, writes, writer.fsyncs, disk, files + 1, max(sizes), writer.compression
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=500000, help='Records written per mode')
+    parser.add_argument('--maxsize', type=int, default=4 * 1024 * 1024, help='Maximum file size (bytes), to include rotation')
+    parser.add_argument('--dir', default=None, help='Directory for the files (default: a temporary directory)')
+    args = parser.parse_args()
+    modes = [
+        ('direct', lambda: DirectWriter(False)),
+        ('direct, flush each', lambda: DirectWriter(True)),
+        ('write-behind, none', lambda: WriteBehindWriter(WriteBehindConfig(fsync=FSYNC_NONE))),
+        ('write-behind, periodic', lambda: WriteBehindWriter(WriteBehindConfig(fsync=FSYNC_PERIODIC, fsync_interval=1.0))),
+        ('write-behind, records', lambda: WriteBehindWriter(WriteBehindConfig(fsync=FSYNC_RECORDS, fsync_records=10000))),
+        ('write-behind, gzip:1', lambda: WriteBehindWriter(WriteBehindConfig(), get_codec('gzip', 1))),
+        ('write-behind, gzip:6', lambda: WriteBehindWriter(WriteBehindConfig(), get_codec('gzip', 6)))
+    ]
+    print('{} records, files of up to {} bytes:'.format(args.records, args.maxsize))
+    print('  mode                      records/s   writes   fsyncs   disk KB  files  max size   ratio  CPU s/MB')
+    for name, create in modes:
+        path = tempfile.mkdtemp(dir=args.dir)
+        try:
+            rate, writes, fsyncs, disk, files, max_size, compression = run(create(), path, args.records, args.maxsize)
+        finally:
+            shutil.rmtree(path)
+        print('  {:24s} {:10.0f} {:>8s} {:8d} {:>9s} {:6d} {:9d} {:>7s} {:>9s}'.format(name, rate,
+            str(writes) if writes is not None else 'n/a', fsyncs,
+            str(disk // 1024) if disk is not None else 'n/a', files, max_size,
+            '{:.1f}'.format(compression['ratio']) if compression else '-',
+            '{:.4f}'.format(compression['cpu_per_mb']) if compression else '-'))
+
+if __name__ == '__main__':
+    main()
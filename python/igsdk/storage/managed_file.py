@@ -6,6 +6,7 @@
 # and sequenced filenames.)
 #
 from ..device import device_init, device_deinit, get_int_storage_path, get_ext_storage_available, get_storage_status, EXT_STORAGE_AVAILABLE
+from .write_behind import WriteBehindFile, WriteBehindConfig
 import threading
 import datetime
 import os
@@ -43,9 +44,22 @@ class ManagedFile():
     Manages writing to storage files, on either external media (SD card)
     or internal storage, handles swapping operation by copying
     files to external storage when available, and limits file
-    size by writing to a sequence of files.
+    size by writing to a sequence of files.  If a header is specified,
+    it is written at the start of each file in the sequence.
+
+    If 'write_behind' (a WriteBehindConfig) is specified, the files are
+    written by a WriteBehindFile: writes are buffered in memory, and
+    written to storage in large chunks by a background thread, with the
+    configured fsync policy.
+
+    If 'compression' (a codec, see codec.py) is specified, the files are
+    compressed as they are written (with the codec suffix added to their
+    names), and 'maxsize' applies to the compressed size.  Compression
+    requires write-behind (with the default WriteBehindConfig, unless
+    'write_behind' is specified).
     """
-    def __init__(self, unit, basename, suffix, maxsize, extstorage_status_callback = None, filemove_status_callback = None):
+    def __init__(self, unit, basename, suffix, maxsize, extstorage_status_callback = None, filemove_status_callback = None, header = None,
+            write_behind = None, compression = None):
         self.logger = logging.getLogger(__name__)
         self.extstorage_status_callback = extstorage_status_callback
         self.filemove_status_callback = filemove_status_callback
@@ -58,17 +72,23 @@ class ManagedFile():
         self.unit = unit
         self.basename = basename
         self.suffix = suffix
+        self.file_suffix = (suffix or '') + (compression.suffix if compression is not None else '')
         self.maxsize = maxsize
+        self.header = header
         self.basepath = None
         self.filemover = None
+        self.writer = None
+        if compression is not None and write_behind is None:
+            write_behind = WriteBehindConfig()
+        if write_behind is not None:
+            self.writer = WriteBehindFile(write_behind, compression)
+            self.writer.writer_start()
         self.start_file()
 
-        # Run main loop if using callback
-        self.start()
-
-
     def deinit(self):
         with self.flock:
+            if self.writer:
+                self.writer.writer_stop()
             if self.file and not self.file.closed:
                 self.file.close()
                 self.file = None
@@ -106,12 +126,25 @@ class ManagedFile():
                 os.makedirs(self.basepath)
             # Create unique filename
             self.filename = '{}/{}-{:%Y%m%d%H%M%S}{}'.format(self.basepath,
-                self.basename, datetime.datetime.today(), self.suffix or '')
+                self.basename, datetime.datetime.today(), self.file_suffix)
             self.logger.info('Creating file {}'.format(self.filename))
+            if self.writer:
+                self.writer.open(self.filename, self.header)
+                return
             self.file = open(self.filename, 'wb')
+            if self.header:
+                self.file.write(self.header)
 
-    def write(self, data):
+    def write(self, data, records = 1):
         with self.flock:
+            if self.writer:
+                if isinstance(data, str):
+                    data = data.encode()
+                # Open a new file if this write will exceed the max size
+                if self.writer.size() + len(data) > self.maxsize:
+                    self.start_file()
+                self.writer.write(data, records)
+                return
             # Open a new file if this write will exceed the max size
             if self.file.tell() + len(data) > self.maxsize:
                 self.start_file()
@@ -121,23 +154,36 @@ class ManagedFile():
                 self.file.write(data)
 
     def get_storage_status(self):
-        return get_storage_status(self.device)
+        status = get_storage_status(self.device)
+        if self.writer:
+            status = dict(status or {})
+            status['write_behind'] = self.writer.get_stats()
+            if 'compression' in status['write_behind']:
+                status['compression'] = status['write_behind'].pop('compression')
+        return status
 
 def managed_file_init(unit, basename, suffix, maxsize = MANAGED_FILE_MAX_SIZE_DEFAULT, extstorage_status_callback = None,
-        filemove_status_callback = None):
+        filemove_status_callback = None, header = None, write_behind = None, compression = None):
     """Initializes a managed file for storage.
+
+    Args:
+        write_behind: Optional WriteBehindConfig, to buffer writes in memory
+            and write them in large chunks from a background thread
+        compression: Optional codec (e.g., get_codec('gzip')), to compress the
+            files as they are written; 'maxsize' applies to the compressed size
     """
-    return ManagedFile(unit, basename, suffix, maxsize, extstorage_status_callback, filemove_status_callback)
+    return ManagedFile(unit, basename, suffix, maxsize, extstorage_status_callback, filemove_status_callback, header,
+        write_behind, compression)
 
 def managed_file_deinit(f):
     if f:
         f.deinit()
 
-def managed_file_write(f, data):
-    """Writes data to a managed file.
+def managed_file_write(f, data, records = 1):
+    """Writes data (containing 'records' records, for the write-behind fsync policy) to a managed file.
     """
     if f:
-        f.write(data)
+        f.write(data, records)
 
 def get_storage_status(f):
     """Gets the storage status
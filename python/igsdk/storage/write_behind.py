@@ -0,0 +1,416 @@
+#
+# write_behind.py
+#
+# Buffered (write-behind) file writer: records are collected in memory
+# and written to storage in large, block-aligned chunks by a background
+# thread, to reduce the write operations on the SD card
+#
+
+from ..modbus.stats import monotonic
+from .codec import cpu_time
+import threading
+import logging
+import os
+import os.path
+
+FSYNC_NONE = 'none' # Only when the file is closed (or rotated)
+FSYNC_PERIODIC = 'periodic' # Every 'fsync_interval' seconds (if data was written)
+FSYNC_RECORDS = 'records' # Every 'fsync_records' records
+
+WRITE_BLOCK_SIZE_DEFAULT = 4096
+WRITE_BUFFER_SIZE_DEFAULT = (64 * 1024)
+WRITE_MAX_BUFFER_DEFAULT = (1024 * 1024)
+WRITE_FLUSH_INTERVAL_DEFAULT = 5.0
+FSYNC_INTERVAL_DEFAULT = 30.0
+FSYNC_RECORDS_DEFAULT = 1000
+
+class WriteBehindConfig:
+    """Settings of a write-behind file.
+
+    Args:
+        buffer_size: Buffered bytes that cause a write (of the whole blocks buffered)
+        flush_interval: Maximum time (seconds) data is buffered before it is written
+        max_buffer: Maximum buffered bytes; writers wait for the flusher above this
+        block_size: Writes are multiples of this size, aligned in the file
+            (except when all the buffered data is written)
+        fsync: Policy for synchronizing the file to storage (FSYNC_*)
+        fsync_interval: Interval (seconds) of FSYNC_PERIODIC
+        fsync_records: Count of records of FSYNC_RECORDS
+    """
+    def __init__(self, buffer_size=WRITE_BUFFER_SIZE_DEFAULT, flush_interval=WRITE_FLUSH_INTERVAL_DEFAULT,
+            max_buffer=WRITE_MAX_BUFFER_DEFAULT, block_size=WRITE_BLOCK_SIZE_DEFAULT, fsync=FSYNC_PERIODIC,
+            fsync_interval=FSYNC_INTERVAL_DEFAULT, fsync_records=FSYNC_RECORDS_DEFAULT):
+        if fsync not in (FSYNC_NONE, FSYNC_PERIODIC, FSYNC_RECORDS):
+            raise ValueError('Invalid fsync policy: {}'.format(fsync))
+        self.buffer_size = max(buffer_size, block_size)
+        self.flush_interval = flush_interval
+        self.max_buffer = max(max_buffer, self.buffer_size)
+        self.block_size = block_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.fsync_records = fsync_records
+
+    @staticmethod
+    def from_str(s):
+        """Create a config from a string '<fsync>[:<interval or records>]' (e.g., 'periodic:10'), or None if empty.
+        """
+        if not s:
+            return None
+        parts = s.split(':')
+        config = WriteBehindConfig(fsync=parts[0])
+        if len(parts) > 1 and parts[1]:
+            if config.fsync == FSYNC_PERIODIC:
+                config.fsync_interval = float(parts[1])
+            elif config.fsync == FSYNC_RECORDS:
+                config.fsync_records = int(parts[1])
+        return config
+
+def fsync_dir(path):
+    """Synchronize a directory (so that a file created in it survives a power failure).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+class WriteBehindFile(threading.Thread):
+    """A file written from an in-memory buffer by a background thread
+
+    write() appends a record to the buffer, and returns without any I/O
+    (unless the buffer holds 'max_buffer' bytes, in which case the writer
+    waits for the flusher).  The flusher thread writes the whole blocks of
+    'block_size' bytes that are buffered when 'buffer_size' bytes are
+    buffered, and all the buffered data when the oldest data has waited
+    'flush_interval' seconds, or the file must be synchronized according
+    to the fsync policy (see WriteBehindConfig).
+
+    open() makes the rotation crash-safe: the current file is written
+    completely, synchronized and closed before the new file is created,
+    and the directory is synchronized after the new file is created.
+    close() also writes and synchronizes all the buffered data.
+
+    If a 'codec' is specified (see codec.py), the file is compressed by
+    the flusher thread: the data taken from the buffer is compressed as a
+    block that is flushed, so the file can be decompressed up to the last
+    block written (e.g., after a power failure), and the compressed data
+    is written in whole blocks of 'block_size' bytes.  size() is then the
+    compressed size, with the buffered data counted at its maximum
+    compressed size.
+    """
+    def __init__(self, config=None, codec=None):
+        self.logger = logging.getLogger(__name__)
+        self.config = config or WriteBehindConfig()
+        self.codec = codec
+        self.stream = None
+        self.out = bytearray() # Compressed data not yet written (with 'io_lock' held)
+        self.out_offset = 0
+        self.out_time = None
+        self.encoding = 0
+        self.encoded = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock() # Held (before 'cond') while buffered data is written
+        self.running = False
+        self.fd = None
+        self.filename = None
+        self.offset = 0
+        self.pending = bytearray()
+        self.pending_time = None
+        self.unsynced_records = 0
+        self.unsynced_bytes = 0
+        self.last_fsync = monotonic()
+        self.records = 0
+        self.bytes = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.files = 0
+        self.waits = 0
+        self.errors = 0
+        self.max_pending = 0
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def writer_start(self):
+        self.running = True
+        self.start()
+
+    def writer_stop(self):
+        """Stop the flusher, and close the file (writing all the buffered data).
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join()
+        self.close()
+
+    def open(self, filename, header=None):
+        """Close the current file (crash-safe), and create a new file.
+        """
+        with self.io_lock:
+            with self.cond:
+                self._close()
+                self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                self.filename = filename
+                self.offset = 0
+                self.files += 1
+                if self.codec:
+                    self.stream = self.codec.stream()
+                    self.out = bytearray()
+                    self.out_offset = 0
+                    self.out_time = None
+                    self.encoded = 0
+                fsync_dir(os.path.dirname(filename) or '.')
+                if header:
+                    self._append(header, 0)
+
+    def close(self):
+        """Write all the buffered data, synchronize and close the file.
+        """
+        with self.io_lock:
+            with self.cond:
+                self._close()
+
+    def _close(self):
+        # Called with 'io_lock' and 'cond' held
+        if self.fd is None:
+            return
+        records = self.unsynced_records
+        chunk = self._take(len(self.pending)) if self.pending else None
+        if self.codec:
+            chunk = self._encode(chunk, True, True)
+        if chunk:
+            self._write(chunk)
+        self._fsync(records)
+        os.close(self.fd)
+        self.fd = None
+        self.cond.notify_all()
+
+    def size(self):
+        """Return the size of the current file, including the buffered data.
+        """
+        with self.cond:
+            return self._size()
+
+    def _size(self):
+        if self.codec:
+            return self.encoded + self.codec.bound(self.encoding + len(self.pending))
+        return self.offset + len(self.pending)
+
+    def write(self, data, records=1):
+        """Append data (bytes) containing 'records' records to the file.
+        """
+        with self.cond:
+            while self.running and len(self.pending) >= self.config.max_buffer:
+                self.waits += 1
+                self.cond.notify_all()
+                self.cond.wait()
+            self._append(data, records)
+            self.records += records
+            if (len(self.pending) >= self.config.buffer_size or
+                    (self.config.fsync == FSYNC_RECORDS and self.unsynced_records >= self.config.fsync_records)):
+                self.cond.notify_all()
+        if not self.running:
+            self.flush(True)
+
+    def _append(self, data, records):
+        if not self.pending:
+            # The flusher waits for the flush interval from now
+            self.pending_time = monotonic()
+            self.cond.notify_all()
+        self.pending.extend(data)
+        self.unsynced_records += records
+        self.max_pending = max(self.max_pending, len(self.pending))
+
+    def _take(self, n):
+        chunk = bytes(self.pending[:n])
+        del self.pending[:n]
+        self.offset += n
+        if self.codec:
+            self.encoding += n
+        if not self.pending:
+            self.pending_time = None
+        self.cond.notify_all()
+        return chunk
+
+    def _encode(self, raw, whole, finish=False):
+        # Called with 'io_lock' held: compress the data taken from the buffer,
+        # and return the compressed data to write (whole blocks only, unless 'whole')
+        t_start = cpu_time()
+        out = b''
+        if raw:
+            out = self.stream.compress(raw) + self.stream.flush()
+        if finish:
+            out += self.stream.finish()
+        t = cpu_time() - t_start
+        self.out.extend(out)
+        with self.cond:
+            if self.out and self.out_time is None:
+                self.out_time = monotonic()
+            self.encoding -= len(raw) if raw else 0
+            self.encoded += len(out)
+            self.raw_bytes += len(raw) if raw else 0
+            self.compressed_bytes += len(out)
+            self.compress_time += t
+        if whole:
+            n = len(self.out)
+        else:
+            block = self.config.block_size
+            n = ((self.out_offset + len(self.out)) // block) * block - self.out_offset
+        if n <= 0:
+            return None
+        chunk = bytes(self.out[:n])
+        del self.out[:n]
+        self.out_offset += n
+        if not self.out:
+            with self.cond:
+                self.out_time = None
+        return chunk
+
+    def _write(self, chunk):
+        done = 0
+        try:
+            while done < len(chunk):
+                done += os.write(self.fd, chunk[done:])
+                self.writes += 1
+            error = None
+        except OSError as e:
+            error = e
+            self.logger.error('Write to {} failed: {}'.format(self.filename, e))
+        with self.cond:
+            self.bytes += done
+            self.unsynced_bytes += done
+            if error:
+                self.errors += 1
+
+    def _fsync(self, records):
+        # Called with 'io_lock' held; 'records' is the count of records written since the last fsync
+        error = None
+        if self.unsynced_bytes or records:
+            try:
+                os.fsync(self.fd)
+            except OSError as e:
+                error = e
+                self.logger.error('Sync of {} failed: {}'.format(self.filename, e))
+        with self.cond:
+            if self.unsynced_bytes or records:
+                self.fsyncs += 1
+                if error:
+                    self.errors += 1
+            self.unsynced_bytes = 0
+            self.unsynced_records -= records
+            self.last_fsync = monotonic()
+
+    def _fsync_due(self, now):
+        if self.config.fsync == FSYNC_RECORDS:
+            return self.unsynced_records >= self.config.fsync_records
+        if self.config.fsync == FSYNC_PERIODIC:
+            return bool(self.unsynced_bytes or self.unsynced_records) and now - self.last_fsync >= self.config.fsync_interval
+        return False
+
+    def flush(self, full=False):
+        """Write the buffered data: whole blocks only, unless 'full' is True or it is due.
+
+        The file is also synchronized if required by the fsync policy.
+        """
+        with self.io_lock:
+            with self.cond:
+                if self.fd is None:
+                    return
+                now = monotonic()
+                sync = self._fsync_due(now)
+                records = self.unsynced_records
+                oldest = self.pending_time if self.out_time is None else self.out_time
+                whole = full or sync or (oldest is not None and now - oldest >= self.config.flush_interval)
+                if whole or self.codec:
+                    # (Compressed data is written in whole blocks when not 'whole')
+                    n = len(self.pending)
+                else:
+                    # Whole blocks, aligned at the file offset
+                    block = self.config.block_size
+                    n = ((self.offset + len(self.pending)) // block) * block - self.offset
+                chunk = self._take(n) if n > 0 else None
+            if self.codec:
+                chunk = self._encode(chunk, whole)
+            if chunk:
+                self._write(chunk)
+            if sync:
+                self._fsync(records)
+
+    def _due(self, now):
+        # Called with 'cond' held: return the time to wait (seconds), or 0 if a flush is due
+        if self.fd is None:
+            return None
+        if len(self.pending) >= self.config.buffer_size or self._fsync_due(now):
+            return 0
+        timeout = None
+        oldest = self.pending_time if self.out_time is None else self.out_time
+        if oldest is not None:
+            timeout = max(0, oldest + self.config.flush_interval - now)
+        if self.config.fsync == FSYNC_PERIODIC and (self.unsynced_bytes or self.unsynced_records):
+            t = max(0, self.last_fsync + self.config.fsync_interval - now)
+            timeout = t if timeout is None else min(timeout, t)
+        return timeout
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    timeout = self._due(monotonic())
+                    if timeout == 0:
+                        break
+                    self.cond.wait(timeout)
+                if not self.running:
+                    return
+            self.flush()
+
+    def get_stats(self):
+        """Return the writer statistics.
+
+        Returns:
+            A dictionary containing the current file name, its size as
+            limited by the managed file 'maxsize' ('file_size', see size();
+            compressed, if a codec is used) and the bytes written to it
+            before compression ('file_raw_size'), both including the
+            buffered data, the buffered bytes, the count of records and
+            bytes written to storage, of
+            write and fsync operations, of files created, of writers that
+            waited for buffer space, of I/O errors, the maximum buffered
+            bytes, and the fsync policy.  If the file is compressed,
+            'compression' contains the codec name, the bytes before and
+            after compression, the compression ratio, and the CPU time of
+            the compression (seconds, in total and per MB before
+            compression).
+        """
+        with self.cond:
+            stats = {
+                'filename' : self.filename,
+                'file_size' : self._size(),
+                'file_raw_size' : self.offset + len(self.pending),
+                'pending' : len(self.pending),
+                'records' : self.records,
+                'bytes' : self.bytes,
+                'writes' : self.writes,
+                'fsyncs' : self.fsyncs,
+                'files' : self.files,
+                'waits' : self.waits,
+                'errors' : self.errors,
+                'max_pending' : self.max_pending,
+                'fsync' : self.config.fsync
+            }
+            if self.codec:
+                stats['compression'] = {
+                    'codec' : self.codec.name,
+                    'raw_bytes' : self.raw_bytes,
+                    'compressed_bytes' : self.compressed_bytes,
+                    'ratio' : float(self.raw_bytes) / self.compressed_bytes if self.compressed_bytes else None,
+                    'cpu_time' : self.compress_time,
+                    'cpu_per_mb' : self.compress_time * 1048576 / self.raw_bytes if self.raw_bytes else None
+                }
+            return stats
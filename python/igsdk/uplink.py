@@ -0,0 +1,381 @@
+#
+# uplink.py
+#
+# Publish scheduling based on the cost of the active uplink (Ethernet,
+# Wi-Fi or LTE)
+#
+
+from .batcher import MessageBatcher
+from .modbus.stats import monotonic
+import threading
+import logging
+import zlib
+
+LINK_ETHERNET = 'ethernet'
+LINK_WIFI = 'wifi'
+LINK_LTE = 'lte'
+LINK_UNKNOWN = 'unknown'
+
+# Cellular access technologies (as reported by oFono); on LTE links, a
+# policy for the technology (if any) is used instead of the LTE policy
+TECH_GSM = 'gsm'
+TECH_EDGE = 'edge'
+TECH_UMTS = 'umts'
+TECH_HSPA = 'hspa'
+TECH_LTE = 'lte'
+
+# Interface name prefixes of each link type (for the default route)
+LINK_IFACE_PREFIXES = [
+    ('eth', LINK_ETHERNET),
+    ('en', LINK_ETHERNET),
+    ('wlan', LINK_WIFI),
+    ('wl', LINK_WIFI),
+    ('wwan', LINK_LTE),
+    ('ppp', LINK_LTE),
+    ('rmnet', LINK_LTE),
+    ('usb', LINK_LTE)
+]
+
+PROC_NET_ROUTE = '/proc/net/route'
+LINK_CHECK_INTERVAL_DEFAULT = 10.0
+
+PRIORITY_ALARM = 0 # Published immediately, on any link
+PRIORITY_LOW = 1 # Published according to the link policy
+
+class LinkPolicy:
+    """How low-priority messages are published on a link type.
+
+    Args:
+        max_age: Maximum time (seconds) a message waits in a batch
+        max_count: Maximum messages per batch
+        compress: If True, batches are compressed (zlib)
+    """
+    def __init__(self, max_age, max_count, compress=False):
+        self.max_age = max_age
+        self.max_count = max_count
+        self.compress = compress
+
+LINK_POLICIES_DEFAULT = {
+    LINK_ETHERNET : LinkPolicy(1.0, 100),
+    LINK_WIFI : LinkPolicy(1.0, 100),
+    LINK_LTE : LinkPolicy(60.0, 1000, compress=True),
+    LINK_UNKNOWN : LinkPolicy(1.0, 100),
+    # Slower (and costlier per byte) fallback technologies of the cellular link
+    TECH_GSM : LinkPolicy(300.0, 1000, compress=True),
+    TECH_EDGE : LinkPolicy(300.0, 1000, compress=True),
+    TECH_UMTS : LinkPolicy(120.0, 1000, compress=True),
+    TECH_HSPA : LinkPolicy(120.0, 1000, compress=True)
+}
+
+def default_route_iface(path=PROC_NET_ROUTE):
+    """Return the name of the interface of the default IPv4 route (or None).
+    """
+    try:
+        with open(path) as f:
+            next(f)
+            best = None
+            for line in f:
+                fields = line.split()
+                # Destination 0.0.0.0, with the lowest metric
+                if len(fields) > 6 and fields[1] == '00000000' and (best is None or int(fields[6]) < best[1]):
+                    best = (fields[0], int(fields[6]))
+            return best[0] if best else None
+    except (IOError, OSError, StopIteration, ValueError):
+        return None
+
+def iface_link_type(iface):
+    """Return the link type of a network interface, from its name.
+    """
+    if iface:
+        for prefix, link in LINK_IFACE_PREFIXES:
+            if iface.startswith(prefix):
+                return link
+    return LINK_UNKNOWN
+
+class LinkMonitor:
+    """Determines the active uplink type.
+
+    The link type is that of the interface of the default route; if it
+    cannot be determined, the link is LTE if the modem is attached (see
+    modem.ModemMonitor) and the LTE activation did not fail (reported by
+    the Config Service, see config.ConfigManager, if 'use_config' is True).
+    The cellular access technology is also reported.  The route is checked
+    at most every 'check_interval' seconds (see get_link()), and whenever
+    the modem or LTE status changes; 'change_cb' is called with
+    (link, technology) when the link type (or, on LTE links, the access
+    technology) changes, on the thread that
+    checked the link (e.g., the D-Bus main loop thread for modem and LTE
+    status changes).  A ModemMonitor (or an object with the same
+    get_info(), subscribe() and unsubscribe() methods) can be passed as
+    'modem' instead of starting one, and the routing table read from
+    'route_path'.
+    """
+    def __init__(self, change_cb=None, check_interval=LINK_CHECK_INTERVAL_DEFAULT, use_modem=True, use_config=False,
+            modem=None, route_path=PROC_NET_ROUTE):
+        self.logger = logging.getLogger(__name__)
+        self.change_cb = change_cb
+        self.check_interval = check_interval
+        self.route_path = route_path
+        self.lock = threading.Lock()
+        self.link = None
+        self.technology = None
+        self.link_technology = None
+        self.attached = False
+        self.lte_status = None
+        self.last_check = None
+        self.modem = modem
+        self.config = None
+        if self.modem is None and use_modem:
+            from .modem import modem_monitor_start
+            self.modem = modem_monitor_start()
+        if self.modem:
+            self.modem.subscribe(self.modem_changed)
+            self.modem_changed(self.modem.get_info(), None)
+        if use_config:
+            from .config import ConfigManager
+            self.config = ConfigManager(self.lte_status_changed)
+        self.check()
+
+    def modem_changed(self, info, changes):
+        connection = info.get('connection', {}) if info else {}
+        net = info.get('net', {}) if info else {}
+        with self.lock:
+            self.attached = bool(connection.get('Attached', False))
+            self.technology = net.get('Technology') or None
+        if changes is not None:
+            self.check()
+
+    def lte_status_changed(self, status):
+        with self.lock:
+            self.lte_status = status
+        self.check()
+
+    def check(self):
+        """Determine the link type now (calling 'change_cb' if it changed).
+        """
+        from_route = iface_link_type(default_route_iface(self.route_path))
+        with self.lock:
+            self.last_check = monotonic()
+            link = from_route
+            if link == LINK_UNKNOWN and self.attached and (self.lte_status is None or self.lte_status >= 0):
+                link = LINK_LTE
+            technology = self.technology if link == LINK_LTE else None
+            changed = link != self.link or technology != self.link_technology
+            self.link = link
+            self.link_technology = technology
+        if changed:
+            self.logger.info('Uplink is {} ({})'.format(link, technology))
+            if self.change_cb:
+                self.change_cb(link, technology)
+        return link
+
+    def get_link(self):
+        """Return the link type (checked again if the last check is older than 'check_interval').
+        """
+        if self.last_check is None or monotonic() - self.last_check >= self.check_interval:
+            return self.check()
+        return self.link
+
+    def stop(self):
+        if self.modem:
+            self.modem.unsubscribe(self.modem_changed)
+        if self.config:
+            self.config.quit_loop()
+
+class UplinkBatcher(MessageBatcher):
+    """MessageBatcher that passes the messages of each batch to the callback, as publish_cb(payload, msgs).
+    """
+    def publish(self, payload, msgs):
+        self.publish_cb(payload, msgs)
+
+class UplinkScheduler:
+    """Publishes messages according to the cost of the active uplink
+
+    Alarms (PRIORITY_ALARM) are published immediately, on any link.
+    Low-priority messages (telemetry) are batched (see MessageBatcher)
+    according to the LinkPolicy of the current link type: by default,
+    short batches on Ethernet and Wi-Fi, and long, compressed batches on
+    LTE, with even longer batches when the modem falls back to a 2G/3G
+    technology ('policies' is keyed by link type, or by cellular technology
+    (TECH_*) for LTE links).  When the policy changes, the current batch is
+    published on
+    the batcher thread (the link monitor may report the change on the
+    D-Bus main loop thread, which must not block on the publish callback),
+    and the new policy then applies.
+
+    The publish callback is called as publish_cb(payload, compressed):
+    alarms and uncompressed batches are strings, and compressed batches
+    are zlib-compressed UTF-8 bytes.  For each link type, the bytes of
+    the messages (each with 'overhead' bytes, the estimated protocol
+    overhead of a single publish) and the bytes actually published are
+    counted when each batch is published, under the link it was published
+    on, to report the bytes saved (see get_stats()).  'link_monitor' can
+    be any object with get_link() and stop(), and optionally 'technology'
+    (see LinkMonitor); by default, a LinkMonitor is created.  The
+    monitor's 'change_cb' is set to link_changed().
+    """
+    def __init__(self, publish_cb, policies=None, link_monitor=None, overhead=0):
+        self.logger = logging.getLogger(__name__)
+        self.publish_cb = publish_cb
+        self.policies = dict(LINK_POLICIES_DEFAULT)
+        if policies:
+            self.policies.update(policies)
+        self.overhead = overhead
+        self.lock = threading.Lock()
+        self.link_stats = {}
+        self.link_changes = 0
+        self.link = None
+        self.technology = None
+        self.next_link = None
+        self.policy = self.policies[LINK_UNKNOWN]
+        self.batcher = UplinkBatcher(self.publish_batch, self.policy.max_count, self.policy.max_age)
+        self.link_monitor = link_monitor or LinkMonitor()
+        self.link_monitor.change_cb = self.link_changed
+
+    def scheduler_start(self):
+        # No batch yet: apply the policy of the initial link directly
+        with self.lock:
+            self.next_link = self._link_key(self.link_monitor.get_link(), getattr(self.link_monitor, 'technology', None))
+        self._apply_link()
+        self.batcher.batch_start()
+
+    def scheduler_stop(self):
+        """Stop the scheduler, publishing any remaining messages.
+        """
+        self.link_monitor.stop()
+        self.batcher.batch_stop()
+
+    def _stats(self, link):
+        stats = self.link_stats.get(link)
+        if stats is None:
+            stats = { 'msgs' : 0, 'alarms' : 0, 'batches' : 0, 'msg_bytes' : 0, 'sent_bytes' : 0 }
+            self.link_stats[link] = stats
+        return stats
+
+    def _link_key(self, link, technology):
+        # The technology only selects the policy on LTE links
+        return (link, technology if link == LINK_LTE else None)
+
+    def get_policy(self, link, technology=None):
+        """Return the LinkPolicy of a link type (and cellular technology, on LTE links).
+        """
+        if link == LINK_LTE and technology in self.policies:
+            return self.policies[technology]
+        return self.policies.get(link, self.policies[LINK_UNKNOWN])
+
+    def link_changed(self, link, technology):
+        """Apply the policy of the link type and technology (called by the link monitor, on any thread).
+
+        The batch collected under the previous policy is published on the
+        batcher thread, which then applies the new policy.
+        """
+        key = self._link_key(link, technology)
+        with self.lock:
+            if key == self.next_link:
+                return
+            self.next_link = key
+        self.batcher.flush_async('stop', self._apply_link)
+
+    def _apply_link(self):
+        with self.lock:
+            link, technology = self.next_link
+            if link == self.link and technology == self.technology:
+                return
+            policy = self.get_policy(link, technology)
+            if link != self.link:
+                self.link_changes += 1
+            self.link = link
+            self.technology = technology
+            self.policy = policy
+            with self.batcher.cond:
+                self.batcher.max_age = policy.max_age
+                self.batcher.max_count = policy.max_count
+                self.batcher.cond.notify()
+
+    def publish(self, msg, priority=PRIORITY_LOW):
+        """Publish an encoded message (JSON string).
+        """
+        self.link_changed(self.link_monitor.get_link(), getattr(self.link_monitor, 'technology', None))
+        if priority == PRIORITY_ALARM:
+            with self.lock:
+                stats = self._stats(self.link)
+                stats['alarms'] += 1
+                stats['msg_bytes'] += len(msg) + self.overhead
+                stats['sent_bytes'] += len(msg) + self.overhead
+            self.publish_cb(msg, False)
+        else:
+            # Counted when the batch is published (see publish_batch())
+            self.batcher.add(msg)
+
+    def publish_batch(self, payload, msgs):
+        """Publish a batch (called by the batcher), compressed if required by the policy.
+
+        The messages of the batch are counted under the same link as the
+        published bytes (a link change may be pending when they are added).
+        """
+        with self.lock:
+            compressed = self.policy.compress
+            link = self.link
+        if compressed:
+            payload = zlib.compress(payload.encode('utf-8'))
+        with self.lock:
+            stats = self._stats(link)
+            stats['msgs'] += len(msgs)
+            stats['msg_bytes'] += sum(len(msg) for msg in msgs) + self.overhead * len(msgs)
+            stats['batches'] += 1
+            stats['sent_bytes'] += len(payload) + self.overhead
+        self.publish_cb(payload, compressed)
+
+    def get_stats(self):
+        """Return the scheduler statistics.
+
+        Returns:
+            A dictionary containing the current 'link' and cellular
+            'technology' (if known), the technology of the current policy
+            ('policy_technology', on LTE links), the count of link
+            changes, the statistics of each link type ('links': count of
+            low-priority messages, alarms and batches, bytes of the messages
+            and bytes published, and 'bytes_saved'), and the batcher
+            statistics ('batcher', see MessageBatcher.get_stats()).
+        """
+        # Not with the lock held: the batcher holds its publish lock while calling publish_batch()
+        batcher_stats = self.batcher.get_stats()
+        with self.lock:
+            links = {}
+            for link, stats in self.link_stats.items():
+                links[link] = dict(stats)
+                links[link]['bytes_saved'] = stats['msg_bytes'] - stats['sent_bytes']
+            return {
+                'link' : self.link,
+                'technology' : getattr(self.link_monitor, 'technology', None),
+                'policy_technology' : self.technology,
+                'link_changes' : self.link_changes,
+                'links' : links,
+                'batcher' : batcher_stats
+            }
+
+def uplink_scheduler_start(publish_cb, policies=None, overhead=0, use_config=False):
+    """Start publishing messages according to the cost of the active uplink.
+
+    Args:
+        publish_cb: Callback to publish a payload, as publish_cb(payload, compressed)
+        policies: Optional dictionary of LinkPolicy by link type (LINK_*) or cellular technology (TECH_*), overriding the defaults
+        overhead: Estimated protocol overhead of a single publish (bytes), for the statistics
+        use_config: If True, the LTE status from the Config Service is also used
+
+    Returns:
+        An UplinkScheduler instance, to be used in uplink_publish() and uplink_scheduler_stop().
+    """
+    scheduler = UplinkScheduler(publish_cb, policies, LinkMonitor(use_config=use_config), overhead)
+    scheduler.scheduler_start()
+    return scheduler
+
+def uplink_publish(scheduler, msg, priority=PRIORITY_LOW):
+    """Publish an encoded message (JSON string) with the given priority (PRIORITY_*).
+    """
+    scheduler.publish(msg, priority)
+
+def uplink_scheduler_stop(scheduler):
+    """Stop the scheduler, publishing any remaining messages.
+    """
+    scheduler.scheduler_stop()
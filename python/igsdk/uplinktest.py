@@ -0,0 +1,231 @@
+#
+# uplinktest.py
+#
+# Checks of the uplink scheduler policy switching (by link type and
+# cellular technology) and per-link byte statistics, with stand-ins for
+# the modem monitor (see modem.ModemMonitor) and the Config Service LTE
+# status (see config.ConfigManager), which report changes on their own
+# thread as the D-Bus main loop does.
+#
+# Run as: python -m igsdk.uplinktest
+#
+
+from .uplink import (LinkMonitor, LinkPolicy, UplinkScheduler, PRIORITY_ALARM,
+    LINK_ETHERNET, LINK_LTE, LINK_UNKNOWN, TECH_UMTS, LINK_POLICIES_DEFAULT)
+from .modbus.stats import monotonic
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+OVERHEAD = 100
+
+ROUTE_HEADER = 'Iface\tDestination\tGateway\tFlags\tRefCnt\tUse\tMetric\tMask\tMTU\tWindow\tIRTT\n'
+ROUTE_DEFAULT = '{}\t00000000\t0102A8C0\t0003\t0\t0\t{}\t00000000\t0\t0\t0\n'
+
+failures = 0
+
+def check(name, value, expected):
+    global failures
+    if value == expected:
+        print('  ok    {}'.format(name))
+    else:
+        failures += 1
+        print('  FAIL  {}: {!r} (expected {!r})'.format(name, value, expected))
+
+def on_loop_thread(fn, *args):
+    """Call fn(*args) on another thread (as a D-Bus signal handler), and wait for it.
+    """
+    t = threading.Thread(target=fn, args=args, name='loop')
+    t.start()
+    t.join()
+
+def wait_for(fn, timeout=2.0):
+    t_end = monotonic() + timeout
+    while not fn() and monotonic() < t_end:
+        time.sleep(0.01)
+    return fn()
+
+class FakeModemMonitor:
+    """Stand-in for the ModemMonitor of the oFono modem service.
+    """
+    def __init__(self):
+        self.info = { 'connection' : { 'Attached' : False }, 'net' : {} }
+        self.cbs = []
+
+    def get_info(self):
+        return self.info
+
+    def subscribe(self, cb):
+        self.cbs.append(cb)
+
+    def unsubscribe(self, cb):
+        self.cbs.remove(cb)
+
+    def set_attached(self, attached, technology):
+        self.info = { 'connection' : { 'Attached' : attached }, 'net' : { 'Technology' : technology } }
+        for cb in list(self.cbs):
+            on_loop_thread(cb, self.info, { 'connection' : { 'Attached' : attached } })
+
+class FakeConfigManager:
+    """Stand-in for the ConfigManager LTE status of the Config Service.
+    """
+    def __init__(self, lte_status_cb):
+        self.lte_status_cb = lte_status_cb
+
+    def set_lte_status(self, status):
+        on_loop_thread(self.lte_status_cb, status)
+
+    def quit_loop(self):
+        pass
+
+class Publisher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = []
+
+    def publish(self, payload, compressed):
+        with self.lock:
+            self.published.append((payload, compressed, threading.current_thread().name))
+
+    def count(self):
+        with self.lock:
+            return len(self.published)
+
+def write_route(path, iface):
+    with open(path, 'w') as f:
+        f.write(ROUTE_HEADER)
+        if iface:
+            f.write(ROUTE_DEFAULT.format(iface, 0))
+
+def msg_bytes(msgs):
+    return sum(len(msg) + OVERHEAD for msg in msgs)
+
+def check_scheduler(path):
+    print('Policy switching and bytes per link:')
+    route = os.path.join(path, 'route')
+    write_route(route, 'eth0')
+    modem = FakeModemMonitor()
+    monitor = LinkMonitor(check_interval=3600.0, use_modem=False, modem=modem, route_path=route)
+    config = FakeConfigManager(monitor.lte_status_changed)
+    publisher = Publisher()
+    policies = {
+        LINK_ETHERNET : LinkPolicy(60.0, 2),
+        LINK_LTE : LinkPolicy(60.0, 1000, compress=True)
+    }
+    scheduler = UplinkScheduler(publisher.publish, policies, monitor, overhead=OVERHEAD)
+    scheduler.scheduler_start()
+    check('Starts on Ethernet', scheduler.get_stats()['link'], LINK_ETHERNET)
+
+    # Ethernet: batches of 2, alarms immediately
+    eth_msgs = ['{{"t":{},"v":[1,2,3]}}'.format(i) for i in range(3)]
+    for msg in eth_msgs:
+        scheduler.publish(msg)
+    alarm = '{"alarm":"overcurrent"}'
+    scheduler.publish(alarm, PRIORITY_ALARM)
+    check('Count flush and alarm published', publisher.count(), 2)
+    check('Alarm not compressed', publisher.published[1][:2], (alarm, False))
+
+    # Failover to LTE, reported on the modem monitor thread
+    write_route(route, None)
+    modem.set_attached(True, 'lte')
+    check('Switched to LTE', wait_for(lambda: scheduler.get_stats()['link'] == LINK_LTE), True)
+    check('Pending Ethernet batch published', publisher.count(), 3)
+    payload, compressed, thread = publisher.published[2]
+    check('Pending batch not compressed', (payload, compressed), ('{"msgs":[' + eth_msgs[2] + ']}', False))
+    check('Not published on the monitor thread', 'loop' in [p[2] for p in publisher.published], False)
+
+    # LTE: long, compressed batches
+    lte_msgs = ['{{"t":{},"v":[1,2,3]}}'.format(i) for i in range(100, 150)]
+    for msg in lte_msgs:
+        scheduler.publish(msg)
+    check('LTE batch still pending', publisher.count(), 3)
+    # LTE activation failure, reported by the Config Service
+    config.set_lte_status(-1)
+    check('Switched to unknown link', wait_for(lambda: scheduler.get_stats()['link'] == LINK_UNKNOWN), True)
+    check('LTE batch published', publisher.count(), 4)
+    payload, compressed, thread = publisher.published[3]
+    check('LTE batch compressed', compressed, True)
+    check('LTE batch contents', zlib.decompress(payload).decode('utf-8'), '{"msgs":[' + ','.join(lte_msgs) + ']}')
+    scheduler.scheduler_stop()
+
+    stats = scheduler.get_stats()
+    check('Link changes', stats['link_changes'], 3)
+    eth = stats['links'][LINK_ETHERNET]
+    check('Ethernet messages and alarms', (eth['msgs'], eth['alarms'], eth['batches']), (3, 1, 2))
+    check('Ethernet message bytes', eth['msg_bytes'], msg_bytes(eth_msgs + [alarm]))
+    check('Ethernet sent bytes', eth['sent_bytes'], msg_bytes([p[0] for p in publisher.published[:3]]))
+    check('Ethernet bytes saved', eth['bytes_saved'], eth['msg_bytes'] - eth['sent_bytes'])
+    lte = stats['links'][LINK_LTE]
+    check('LTE messages and batches', (lte['msgs'], lte['alarms'], lte['batches']), (50, 0, 1))
+    check('LTE message bytes', lte['msg_bytes'], msg_bytes(lte_msgs))
+    check('LTE sent bytes', lte['sent_bytes'], len(publisher.published[3][0]) + OVERHEAD)
+    check('LTE bytes saved', lte['bytes_saved'], lte['msg_bytes'] - lte['sent_bytes'])
+    check('LTE saves more than Ethernet', lte['bytes_saved'] > eth['bytes_saved'] > 0, True)
+
+def check_technology(path):
+    print('Policy by cellular technology:')
+    route = os.path.join(path, 'route')
+    write_route(route, None)
+    modem = FakeModemMonitor()
+    modem.info = { 'connection' : { 'Attached' : True }, 'net' : { 'Technology' : 'lte' } }
+    monitor = LinkMonitor(check_interval=3600.0, use_modem=False, modem=modem, route_path=route)
+    publisher = Publisher()
+    scheduler = UplinkScheduler(publisher.publish, None, monitor, overhead=OVERHEAD)
+    scheduler.scheduler_start()
+    check('Starts on LTE', scheduler.get_stats()['link'], LINK_LTE)
+    check('LTE policy', scheduler.batcher.max_age, LINK_POLICIES_DEFAULT[LINK_LTE].max_age)
+    msg = '{"t":1,"v":[1,2,3]}'
+    scheduler.publish(msg)
+    # Fallback to 3G on the same link
+    modem.set_attached(True, TECH_UMTS)
+    check('3G policy applied', wait_for(lambda: scheduler.get_stats()['policy_technology'] == TECH_UMTS), True)
+    check('3G policy', scheduler.batcher.max_age, LINK_POLICIES_DEFAULT[TECH_UMTS].max_age)
+    check('LTE batch published', [p[1] for p in publisher.published], [True])
+    check('Not a link change', scheduler.get_stats()['link_changes'], 1)
+    scheduler.scheduler_stop()
+
+def check_pending_change(path):
+    print('Messages added while a link change is pending:')
+    route = os.path.join(path, 'route')
+    write_route(route, 'eth0')
+    modem = FakeModemMonitor()
+    monitor = LinkMonitor(check_interval=3600.0, use_modem=False, modem=modem, route_path=route)
+    publisher = Publisher()
+    scheduler = UplinkScheduler(publisher.publish, None, monitor, overhead=OVERHEAD)
+    scheduler.scheduler_start()
+    eth_msg = '{"t":1,"v":[1,2,3]}'
+    lte_msg = '{"t":2,"v":[4,5,6,7,8,9]}'
+    scheduler.publish(eth_msg)
+    # Hold the batcher while it publishes the Ethernet batch, so that the
+    # next message is added before the LTE policy is applied
+    with scheduler.batcher.publish_lock:
+        write_route(route, None)
+        modem.set_attached(True, 'lte')
+        wait_for(lambda: not scheduler.batcher.msgs)
+        scheduler.publish(lte_msg)
+    check('Switched to LTE', wait_for(lambda: scheduler.get_stats()['link'] == LINK_LTE), True)
+    scheduler.scheduler_stop()
+    links = scheduler.get_stats()['links']
+    check('Ethernet message bytes', (links[LINK_ETHERNET]['msgs'], links[LINK_ETHERNET]['msg_bytes']), (1, msg_bytes([eth_msg])))
+    check('LTE message bytes', (links[LINK_LTE]['msgs'], links[LINK_LTE]['msg_bytes']), (1, msg_bytes([lte_msg])))
+    check('LTE sent bytes', links[LINK_LTE]['sent_bytes'], len(publisher.published[1][0]) + OVERHEAD)
+
+def main():
+    path = tempfile.mkdtemp()
+    try:
+        check_scheduler(path)
+        check_technology(path)
+        check_pending_change(path)
+    finally:
+        shutil.rmtree(path)
+    if failures:
+        print('{} check(s) failed.'.format(failures))
+        sys.exit(1)
+    print('All checks passed.')
+
+if __name__ == '__main__':
+    main()